@@ -0,0 +1,291 @@
+import os
+import gzip
+import json
+import zlib
+import shutil
+import struct
+import zipfile
+import posixpath
+import threading
+from IndexCache import IndexCache
+
+
+# IOError like a missing or unreadable archive
+class ArchiveExtractionError(IOError):
+    pass
+
+
+# size of the chunks decompressed at once
+default_buffer_size = 16 * 1024 * 1024
+
+
+def get_manifest_path(out_path):
+    return out_path + '.manifest'
+
+
+def is_extracted(archive, out_path, member=None):
+    """
+    Check the manifest written by extract_file, so an archive isn't extracted again.
+
+    :param archive: path to the archive
+    :param out_path: path of the extracted file
+    :param member: name of the extracted zip member, None for gzip files
+    :return: True if out_path is a complete extraction of the current archive
+    """
+    try:
+        with open(get_manifest_path(out_path), 'rb') as f:
+            manifest = json.load(f)
+        out_stat = os.stat(out_path)
+        return manifest['archive'] == IndexCache.get_file_key(archive) and \
+            manifest.get('member') == member and \
+            manifest['size'] == out_stat.st_size and manifest['mtime'] == out_stat.st_mtime
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        return False
+
+
+def extract_file(archive, open_archive, out_path, buffer_size, member=None):
+    """
+    Decompress a file chunk by chunk to a temp file, which is renamed to out_path when it is
+    complete, and write the manifest checked by is_extracted.
+
+    :param archive: path to the archive
+    :param open_archive: function returning the decompressed file object
+    :param out_path: path of the extracted file
+    :param buffer_size: chunk size in bytes
+    :param member: name of the zip member, None for gzip files
+    :return: path of the extracted file
+    """
+    # extract to a temp file, so an interrupted extraction doesn't leave a truncated file
+    # unique per thread, archives can be extracted in parallel (see PeakListParser.open_readers)
+    tmp_path = '%s.%s.%s.tmp' % (out_path, os.getpid(), threading.current_thread().ident)
+    try:
+        in_f = open_archive()
+        try:
+            with open(tmp_path, 'wb') as out_f:
+                shutil.copyfileobj(in_f, out_f, buffer_size)
+        finally:
+            in_f.close()
+        os.rename(tmp_path, out_path)
+    except (IOError, OSError, EOFError, zlib.error, zipfile.BadZipfile) as e:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        archive_kind = 'Gzip' if member is None else 'Zip'
+        raise ArchiveExtractionError('%s archive error: %s - %s' % (archive_kind, archive, e))
+
+    out_stat = os.stat(out_path)
+    try:
+        with open(get_manifest_path(out_path), 'wb') as f:
+            json.dump({
+                'archive': IndexCache.get_file_key(archive),
+                'member': member,
+                'size': out_stat.st_size,
+                'mtime': out_stat.st_mtime
+            }, f)
+    except (IOError, OSError, ValueError):
+        pass    # it will just be extracted again next time
+
+    return out_path
+
+
+def extract_gz(archive, out_path=None, buffer_size=None):
+    """
+    Decompress a gzip file chunk by chunk, so memory use doesn't depend on the file size.
+    Skipped if the manifest shows the archive has already been extracted to out_path.
+
+    :param archive: path to .gz file
+    :param out_path: path of the extracted file, the archive path without '.gz' if None
+    :param buffer_size: chunk size in bytes, module default if None
+    :return: path of the extracted file
+    """
+    if not archive.endswith('.gz'):
+        raise ArchiveExtractionError('unsupported file extension for: %s' % archive)
+    if out_path is None:
+        out_path = archive[:-len('.gz')]
+    if buffer_size is None:
+        buffer_size = default_buffer_size
+
+    if is_extracted(archive, out_path):
+        return out_path
+
+    return extract_file(archive, lambda: gzip.open(archive, 'rb'), out_path, buffer_size)
+
+
+def open_stream(path):
+    """
+    Open a file for reading front to back, decompressing gzip files on the fly.
+    For consumers that don't need to seek (seeking backwards in a gzip stream restarts
+    decompression from the beginning).
+
+    :param path: path to file, optionally gzip compressed (.gz)
+    :return: binary file object
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+class MemberFile(object):
+    """
+    Read only file object for a stored (uncompressed) zip member, reading it in place in the
+    archive. Positions are relative to the start of the member.
+    """
+
+    def __init__(self, archive, offset, size):
+        """
+
+        :param archive: path to the zip archive
+        :param offset: offset of the member data in the archive
+        :param size: size of the member
+        """
+        self.file = open(archive, 'rb')
+        self.offset = offset
+        self.size = size
+        self.position = 0
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.position
+        elif whence == 2:
+            offset += self.size
+        if offset < 0:
+            raise IOError('invalid seek position: %s' % offset)
+        self.position = offset
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        end = self.size if size is None or size < 0 else min(self.size, self.position + size)
+        if end <= self.position:
+            return b''
+        self.file.seek(self.offset + self.position, 0)
+        data = self.file.read(end - self.position)
+        self.position += len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+class ZipMember(str):
+    """
+    Path of a stored zip member that is read in place (see MemberFile). The string is
+    <archive>/<member name>, so it can be used like the path of an extracted file in messages.
+    """
+
+    def __new__(cls, archive, name, offset, size):
+        member = str.__new__(cls, '%s/%s' % (archive, name))
+        member.archive = archive
+        member.name = name
+        member.offset = offset
+        member.size = size
+        return member
+
+    def open(self):
+        return MemberFile(self.archive, self.offset, self.size)
+
+
+class ZipArchive(object):
+    """
+    Files in a zip archive that are only extracted when they are requested (see get_path),
+    instead of extracting the whole archive up front. Members are looked up by their file name,
+    so they can be in sub folders of the archive.
+    """
+
+    def __init__(self, archive, out_dir=None, buffer_size=None):
+        """
+
+        :param archive: path to the zip archive
+        :param out_dir: dir to extract the members to, <archive>_unzip/ if None
+        :param buffer_size: chunk size in bytes, module default if None
+        """
+        if not archive.endswith('.zip'):
+            raise ArchiveExtractionError('unsupported file extension for: %s' % archive)
+        if out_dir is None:
+            out_dir = archive + '_unzip/'
+        if buffer_size is None:
+            buffer_size = default_buffer_size
+
+        self.archive = archive
+        self.out_dir = out_dir
+        self.buffer_size = buffer_size
+        # opened from the path, ZipFile.open opens a new file handle for each member, so
+        # members can be extracted in parallel
+        self.zip_file = zipfile.ZipFile(archive, 'r')
+
+        self.members = {}   # file name -> ZipInfo
+        for info in self.zip_file.infolist():
+            file_name = posixpath.basename(info.filename)
+            # skip folders and hidden files (e.g. __MACOSX/._<file name>)
+            if file_name == '' or file_name.startswith('.'):
+                continue
+            if isinstance(file_name, unicode):
+                file_name = file_name.encode('utf-8')
+            # members closer to the top level take precedence
+            member = self.members.get(file_name)
+            if member is None or member.filename.count('/') > info.filename.count('/'):
+                self.members[file_name] = info
+
+    def get_file_names(self):
+        return sorted(self.members.keys())
+
+    def get_path(self, file_name, in_place=True):
+        """
+        :param file_name: file name of the member
+        :param in_place: return a ZipMember for stored (uncompressed) members instead of
+            extracting them
+        :return: ZipMember or path of the extracted member
+        """
+        info = self.members.get(file_name)
+        if info is None:
+            raise ArchiveExtractionError('%s not found in zip archive: %s' % (
+                file_name, self.archive))
+
+        if in_place and info.compress_type == zipfile.ZIP_STORED and not info.flag_bits & 0x1:
+            return ZipMember(self.archive, file_name, self.get_data_offset(info), info.file_size)
+        return self.extract(file_name)
+
+    def get_data_offset(self, info):
+        """
+        :return: offset of the member data, following the local file header (whose extra field
+            can differ from the one in the central directory)
+        """
+        with open(self.archive, 'rb') as f:
+            f.seek(info.header_offset, 0)
+            header = f.read(zipfile.sizeFileHeader)
+        if len(header) != zipfile.sizeFileHeader or header[0:4] != zipfile.stringFileHeader:
+            raise ArchiveExtractionError('Zip archive error: %s - bad local file header for %s' % (
+                self.archive, info.filename))
+        header = struct.unpack(zipfile.structFileHeader, header)
+        return info.header_offset + zipfile.sizeFileHeader + \
+            header[zipfile._FH_FILENAME_LENGTH] + header[zipfile._FH_EXTRA_FIELD_LENGTH]
+
+    def extract(self, file_name):
+        """
+        Extract a member to out_dir, skipped if it has already been extracted.
+
+        :param file_name: file name of the member
+        :return: path of the extracted file
+        """
+        info = self.members.get(file_name)
+        if info is None:
+            raise ArchiveExtractionError('%s not found in zip archive: %s' % (
+                file_name, self.archive))
+
+        out_path = os.path.join(self.out_dir, file_name)
+        if is_extracted(self.archive, out_path, file_name):
+            return out_path
+
+        try:
+            os.makedirs(self.out_dir)
+        except OSError:
+            if not os.path.isdir(self.out_dir):
+                raise
+
+        return extract_file(self.archive, lambda: self.zip_file.open(info), out_path,
+                            self.buffer_size, file_name)
+
+    def close(self):
+        self.zip_file.close()
@@ -0,0 +1,70 @@
+import os
+import json
+from IndexCache import IndexCache
+from NumpyEncoder import NumpyEncoder
+
+
+class Checkpoint(object):
+    """
+    Progress of an upload, saved after each batch of rows written to the database so an
+    interrupted upload can be resumed instead of parsed again from the start.
+
+    The checkpoint file is only valid for the file it was written for (see
+    IndexCache.get_file_key), it is replaced atomically so a crash while saving leaves the
+    previous checkpoint.
+    """
+
+    def __init__(self, path, file_path):
+        """
+
+        :param path: path of the checkpoint file
+        :param file_path: path of the parsed file
+        """
+        self.path = path
+        self.file_path = file_path
+        self._file_key = None
+
+    def get_file_key(self):
+        if self._file_key is None:
+            self._file_key = IndexCache.get_file_key(self.file_path)
+        return self._file_key
+
+    def load(self):
+        """
+        :return: the saved state or None if there is no valid checkpoint for the file
+        """
+        try:
+            with open(self.path, 'rb') as f:
+                checkpoint = json.load(f)
+            if checkpoint['key'] != self.get_file_key():
+                return None
+            return checkpoint['state']
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def save(self, state):
+        """
+        Failing to write the checkpoint is not an error, the upload can still be resumed from
+        the previous one.
+
+        :param state: json serializable state
+        :return: True if the checkpoint was written
+        """
+        tmp_path = '%s.%s.tmp' % (self.path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as f:
+                json.dump({'key': self.get_file_key(), 'state': state}, f, cls=NumpyEncoder)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError):
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return False
+        return True
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
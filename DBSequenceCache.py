@@ -0,0 +1,82 @@
+from lxml import etree
+import ArchiveExtractor
+
+
+class DBSequenceCache(object):
+    """
+    Lookup of the DBSequence fields needed after parse_db_sequences (accession and name by id).
+
+    Filled while the DBSequences are parsed anyway (parse_db_sequences or MzIdStreamReader),
+    or by a scan of the SequenceCollection that only reads the element attributes (build) if
+    they aren't parsed (xiSPEC_MzIdParser).
+    Sequences aren't kept, they are read on request through the offset index of the mzid_reader.
+    """
+
+    def __init__(self, mzid_reader=None):
+        """
+
+        :param mzid_reader: pyteomics MzIdentML reader used for reading sequences on request
+        """
+        self.mzid_reader = mzid_reader
+        self.entries = {}   # id -> (accession, name)
+        # set once all DBSequences of the file have been added
+        self.complete = False
+
+    def __contains__(self, db_sequence_id):
+        return db_sequence_id in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, db_sequence_id, accession, name=None):
+        self.entries[db_sequence_id] = (accession, name)
+
+    def add_element(self, elem):
+        """
+        :param elem: lxml DBSequence element
+        """
+        self.add(elem.get('id'), elem.get('accession'), elem.get('name'))
+
+    def accession(self, db_sequence_id):
+        return self.entries[db_sequence_id][0]
+
+    def name(self, db_sequence_id):
+        """
+        :return: name of the DBSequence, its accession if it has no name
+        """
+        accession, name = self.entries[db_sequence_id]
+        if name is None:
+            return accession
+        return name
+
+    def sequence(self, db_sequence_id):
+        """
+        Read the sequence of a DBSequence from the mzid file.
+
+        :return: sequence or None if the DBSequence has no Seq
+        """
+        if self.mzid_reader is None or not self.mzid_reader._use_index:
+            raise KeyError('no random access to DBSequence %s' % db_sequence_id)
+        db_sequence = self.mzid_reader.get_by_id(db_sequence_id, tag_id='DBSequence', detailed=True)
+        if "Seq" in db_sequence and isinstance(db_sequence["Seq"], basestring):
+            return db_sequence["Seq"]
+        return None
+
+    def build(self, mzid_path):
+        """
+        Add all DBSequences of an mzid file by reading the attributes of the DBSequence elements.
+        Stops reading at the end of the SequenceCollection.
+
+        :param mzid_path: path to mzidentML file
+        """
+        with ArchiveExtractor.open_stream(mzid_path) as f:
+            for event, elem in etree.iterparse(f, tag=['{*}DBSequence', '{*}SequenceCollection'],
+                                               remove_comments=True, huge_tree=True):
+                if etree.QName(elem).localname == 'SequenceCollection':
+                    break
+                self.add_element(elem)
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+
+        self.complete = True
@@ -0,0 +1,104 @@
+import sys
+import threading
+import Queue
+
+
+class DBWriterClosed(Exception):
+    pass
+
+
+class DBWriter(object):
+    """
+    Writes batches of rows to the database in a background thread, so parsing the next batch
+    overlaps with the database round trip.
+
+    The writer owns the connection while it is running: the db module's write function and
+    con.commit() are called from the writer thread only. Use flush() before using the
+    connection from another thread.
+    The queue is bounded, write() blocks when the writer falls behind (backpressure).
+    An error in the writer thread is raised again in the parser thread by the next write(),
+    flush() or close(); batches queued after the error are dropped.
+    """
+
+    def __init__(self, db, cur, con, max_queued_batches=4):
+        """
+
+        :param db: database python module to use (SQLite or PostgreSQL)
+        :param cur: db cursor
+        :param con: db connection
+        :param max_queued_batches: number of batches that can be waiting to be written
+        """
+        self.db = db
+        self.cur = cur
+        self.con = con
+        self.queue = Queue.Queue(max_queued_batches)
+        self.error = None   # sys.exc_info() of the first failed write
+        self.thread = threading.Thread(target=self._run, name='DBWriter')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                if self.error is not None:
+                    continue
+                function, args = item
+                try:
+                    function(*args)
+                except Exception:
+                    self.error = sys.exc_info()
+            finally:
+                self.queue.task_done()
+
+    def _write_rows(self, function_name, rows):
+        getattr(self.db, function_name)(rows, self.cur, self.con)
+        self.con.commit()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error_type, error, traceback = self.error
+            raise error_type, error, traceback
+
+    def write(self, function_name, rows):
+        """
+        Queue rows to be written by a write function of the db module, blocks while the queue
+        is full.
+
+        :param function_name: name of the db module function, e.g. 'write_peptides'
+        :param rows: list of rows, mustn't be changed afterwards
+        """
+        self._raise_error()
+        self.queue.put((self._write_rows, (function_name, rows)))
+
+    def call(self, function, *args):
+        """
+        Queue a function call, it is run by the writer thread once the rows queued before it
+        are written (e.g. saving a checkpoint). Errors are handled like write errors.
+
+        :param function: function to call with args
+        """
+        self._raise_error()
+        self.queue.put((function, args))
+
+    def flush(self):
+        """
+        Wait until all queued rows are written.
+        """
+        self.queue.join()
+        self._raise_error()
+
+    def close(self, discard=False):
+        """
+        Stop the writer thread.
+
+        :param discard: drop the batches that haven't been written yet (on parse errors)
+        """
+        if discard and self.error is None:
+            self.error = (DBWriterClosed, DBWriterClosed(), None)
+        self.queue.put(None)
+        self.thread.join()
+        if not discard:
+            self._raise_error()
@@ -0,0 +1,193 @@
+import os
+import sys
+import json
+import hashlib
+import threading
+from array import array
+
+
+class IndexCache(object):
+    """
+    Persistent store for file indices (e.g. byte offsets of elements) so they don't have to be
+    rebuilt every time the same file is read.
+
+    Entries are keyed by the path, size and mtime of the indexed file and a hash of its first
+    and last block (hashing all of a multi-GB file would defeat the purpose).
+    Without a cache_dir entries are stored next to the indexed file (<file>.<suffix>).
+    With a cache_dir the total size of the directory is kept below max_size by removing the
+    least recently used entries.
+    """
+
+    hash_block_size = 1024 * 1024
+
+    def __init__(self, cache_dir=None, max_size=1024 * 1024 * 1024, suffix='idx'):
+        """
+
+        :param cache_dir: directory to store the entries in, None for storing next to the file
+        :param max_size: max size of cache_dir in bytes
+        :param suffix: file extension of the entries
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.suffix = suffix
+
+        if self.cache_dir is not None and not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def get_cache_path(self, file_path):
+        if self.cache_dir is None:
+            return '%s.%s' % (file_path, self.suffix)
+        file_name = hashlib.sha1(os.path.abspath(file_path)).hexdigest()
+        return os.path.join(self.cache_dir, '%s.%s' % (file_name, self.suffix))
+
+    @classmethod
+    def get_file_key(cls, file_path):
+        stat = os.stat(file_path)
+        sha1 = hashlib.sha1()
+        with open(file_path, 'rb') as f:
+            sha1.update(f.read(cls.hash_block_size))
+            if stat.st_size > cls.hash_block_size:
+                f.seek(max(cls.hash_block_size, stat.st_size - cls.hash_block_size))
+                sha1.update(f.read(cls.hash_block_size))
+
+        return {
+            'path': os.path.abspath(file_path),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'hash': sha1.hexdigest()
+        }
+
+    def load(self, file_path):
+        """
+        :param file_path: path of the indexed file
+        :return: the stored index or None if there is no valid entry for the file
+        """
+        cache_path = self.get_cache_path(file_path)
+        try:
+            with open(cache_path, 'rb') as f:
+                entry = json.load(f)
+            if entry['key'] != self.get_file_key(file_path):
+                return None
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return None
+
+        self.touch(cache_path)
+        return entry['index']
+
+    def load_array(self, file_path, typecode):
+        """
+        Load an index stored by save_array.
+
+        :param file_path: path of the indexed file
+        :param typecode: expected typecode of the array
+        :return: the stored array or None if there is no valid entry for the file
+        """
+        cache_path = self.get_cache_path(file_path)
+        try:
+            with open(cache_path, 'rb') as f:
+                header = json.loads(f.readline())
+                if header['key'] != self.get_file_key(file_path) or \
+                        header['typecode'] != typecode or \
+                        header['itemsize'] != array(typecode).itemsize or \
+                        header['byteorder'] != sys.byteorder:
+                    return None
+                index = array(str(typecode))
+                index.fromfile(f, header['count'])
+        except (IOError, OSError, EOFError, ValueError, KeyError, TypeError):
+            return None
+
+        self.touch(cache_path)
+        return index
+
+    @staticmethod
+    def touch(cache_path):
+        # mark as recently used for eviction
+        try:
+            os.utime(cache_path, None)
+        except OSError:
+            pass
+
+    def save(self, file_path, index):
+        """
+        Store an index for a file. Failing to write the entry is not an error,
+        the index will just be rebuilt the next time.
+
+        :param file_path: path of the indexed file
+        :param index: json serializable index data
+        :return: True if the entry was written
+        """
+        entry = {'key': self.get_file_key(file_path), 'index': index}
+        return self.write_entry(file_path, lambda f: json.dump(entry, f))
+
+    def save_array(self, file_path, index):
+        """
+        Store an array index for a file: a json header line with the file key, followed by the
+        packed array (machine byte order, which is checked by load_array).
+
+        :param file_path: path of the indexed file
+        :param index: array.array
+        :return: True if the entry was written
+        """
+        header = {
+            'key': self.get_file_key(file_path),
+            'typecode': index.typecode,
+            'itemsize': index.itemsize,
+            'byteorder': sys.byteorder,
+            'count': len(index)
+        }
+
+        def write(f):
+            f.write(json.dumps(header) + '\n')
+            index.tofile(f)
+
+        return self.write_entry(file_path, write)
+
+    def write_entry(self, file_path, write):
+        """
+        Write an entry atomically (to a temporary file that replaces the entry).
+
+        :param file_path: path of the indexed file
+        :param write: function writing the entry to a file object
+        :return: True if the entry was written
+        """
+        cache_path = self.get_cache_path(file_path)
+        tmp_path = '%s.%s.%s.tmp' % (cache_path, os.getpid(), threading.current_thread().ident)
+        try:
+            with open(tmp_path, 'wb') as f:
+                write(f)
+            os.rename(tmp_path, cache_path)
+        except (IOError, OSError):
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return False
+
+        self.evict()
+        return True
+
+    def evict(self):
+        """
+        Remove the least recently used entries until cache_dir is smaller than max_size.
+        """
+        if self.cache_dir is None:
+            return
+
+        entries = []
+        for file_name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, file_name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total_size = sum([size for mtime, size, path in entries])
+        for mtime, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total_size -= size
@@ -25,6 +25,8 @@ import codecs
 
 from collections import defaultdict as ddict
 
+import PeakListIndex
+
 
 class ParseError(Exception):
     pass
@@ -42,6 +44,10 @@ class Reader(object):
                         path obsolete, seeking is disabled
     :type file_object: File_object like
 
+    :param index_cache: IndexCache to load the scan index from and store it in,
+                        the index is built every time if None
+    :type index_cache: IndexCache
+
     Example:
 
     """
@@ -50,6 +56,7 @@ class Reader(object):
             self,
             path=None,
             file_object=None,
+            index_cache=None,
     ):
 
         # self.info contains information extracted from the mgf file
@@ -65,6 +72,9 @@ class Reader(object):
         assert path is not None or file_object is not None, \
             'Must provide either a path or a file object to parse'
 
+        # IndexCache for storing the scan offsets (see PeakListIndex.save_offset_list)
+        self.index_cache = index_cache
+
         self.info['fileObject'], self.info['seekable'] = self.__open_file(
             path,
             file_object
@@ -73,6 +83,9 @@ class Reader(object):
 
         self.seeker = self._build_index()
 
+        # index of the scans by their params, built on first use (see get_param_index)
+        self.info['paramIndex'] = None
+
         self.spectrum = {}
 
         return
@@ -93,10 +106,8 @@ class Reader(object):
                     gzip.open(path)
                 )
             else:
-                file_object = codecs.open(
-                    path,
-                    mode='r'
-                )
+                # path can be a stored zip member (see ArchiveExtractor.ZipMember)
+                file_object = PeakListIndex.open_file(path)
                 seekable = True
 
         return file_object, seekable
@@ -112,51 +123,58 @@ class Reader(object):
                   seeking to a particular offset for the file.
         """
 
-        # Declare the seeker
-        seeker = open(self.info['filename'], 'rb')
+        # Declare the seeker, it's kept open for reading the scans
+        seeker = PeakListIndex.open_file(self.info['filename'])
 
         self.info['offsets'] = None
-        seeker.seek(0, 2)  # what's this for? - cc
 
-        self._build_index_from_scratch(seeker)
+        offset_list = None
+        if self.index_cache is not None:
+            offset_list = PeakListIndex.load_offset_list(self.index_cache, self.info['filename'])
 
-        seeker.close()
-        seeker = codecs.open(
-            self.info['filename'],
-            mode='rb'
-        )
+        if offset_list is None:
+            self._build_index_from_scratch(seeker)
+            if self.index_cache is not None:
+                PeakListIndex.save_offset_list(self.index_cache, self.info['filename'],
+                                               self.info['offsetList'])
+        else:
+            self.info['offsetList'] = offset_list
+            self.info['seekable'] = True
 
+        seeker.seek(0)
         return seeker
 
     def _build_index_from_scratch(self, seeker):
-        """Build an index of spectra data with offsets by parsing the file."""
-
-        def get_data_indices(fh):
-            """Get a list with binary file indices of spectra in mgf file."""
-            spec_positions = []
-
-            # go to start of file
-            fh.seek(0)
-            pos = 0
-            scan_start_pos = 0
-            for line in fh:
-                if line.strip() == "BEGIN IONS":
-                    scan_start_pos = pos + len(line)
-                elif line.strip() == "END IONS":
-                    scan_end_pos = pos + len(line)
-                    spec_positions.append((scan_start_pos, scan_end_pos))
-                pos = pos + len(line)
-
-            return spec_positions
-
-        indices = get_data_indices(seeker)
-        if indices is None:
-            raise ParseError()
-        self.info['offsetList'] = indices
+        """
+        Build an index of spectra data with offsets by searching the memory mapped file
+        (see PeakListIndex.index_mgf).
+        """
+        self.info['offsetList'] = PeakListIndex.index_mgf(seeker)
         self.info['seekable'] = True
 
         return
 
+    def get_param_index(self):
+        """
+        :return: dict param -> {value: scan index} for the SCANS param
+            (see PeakListIndex.index_mgf_params)
+        """
+        if self.info['paramIndex'] is None:
+            self.info['paramIndex'] = PeakListIndex.index_mgf_params(
+                self.seeker, self.info['offsetList'])
+        return self.info['paramIndex']
+
+    def get_index_by_param(self, param, value):
+        """
+        :param param: SCANS (scan number)
+        :param value: value of the param
+        :return: index of the scan (for get_by_id)
+        """
+        try:
+            return self.get_param_index()[param][value]
+        except KeyError:
+            raise KeyError("MGF file does not contain a spectrum with {0}={1}.".format(param, value))
+
     def get_by_id(self, scan_id):
         """"
          Random access to spectrum peak list in mgf by scanId
@@ -167,8 +185,9 @@ class Reader(object):
         start_pos = position[0]
         end_pos = position[1]
 
+        # a new dict for each scan, so returned scans aren't changed by later requests
         if start_pos == -1:  # empty scan
-            self.spectrum['peaks'] = ''
+            self.spectrum = {'peaks': '', 'precursor': None}
             # self.spectrum['params'] = params
             return self.spectrum
 
@@ -178,8 +197,10 @@ class Reader(object):
         if scan is None:
             raise KeyError("MGF file does not contain a spectrum with index {0}.".format(scan_id))
         else:
-            self.spectrum['peaks'] = self.parse_peak_list(scan)
-            self.spectrum['precursor'] = self.parse_precursor(scan)
+            self.spectrum = {
+                'peaks': self.parse_peak_list(scan),
+                'precursor': self.parse_precursor(scan)
+            }
             return self.spectrum
 
     def __getitem__(self, scan_id):
@@ -0,0 +1,84 @@
+class ModificationRegistry(object):
+    """
+    Modifications found in the peptides, in order of first occurrence.
+
+    Modifications are indexed by name and by (name, mass), so registering one doesn't need to
+    scan the ones seen before. A name that is already registered with a different mass is
+    disambiguated by appending '*' (repeatedly, until the name is free or has the same mass).
+    """
+
+    def __init__(self):
+        self.mods = []
+        self.by_name = {}           # name -> mod
+        self.residue_sets = {}      # name -> set of residues of mod
+        self.resolved_names = {}    # (name as found, mass) -> registered name
+
+    def __iter__(self):
+        return iter(self.mods)
+
+    def __len__(self):
+        return len(self.mods)
+
+    def __contains__(self, name):
+        return name in self.by_name
+
+    def get(self, name):
+        return self.by_name[name]
+
+    def add(self, mod):
+        """
+        Register a modification or add its residues to the registered one with the same name
+        and mass.
+
+        :param mod: dict with name, monoisotopicMassDelta (float) and residues (list), the name is
+            changed to the registered name
+        :return: registered name
+        """
+        key = (mod['name'], mod['monoisotopicMassDelta'])
+        name = self.resolved_names.get(key)
+        if name is None:
+            name = mod['name']
+            while name in self.by_name and \
+                    self.by_name[name]['monoisotopicMassDelta'] != mod['monoisotopicMassDelta']:
+                name += "*"
+            self.resolved_names[key] = name
+
+        mod['name'] = name
+        if name in self.by_name:
+            registered_mod = self.by_name[name]
+            residue_set = self.residue_sets[name]
+            for res in mod['residues']:
+                if res not in residue_set:
+                    residue_set.add(res)
+                    registered_mod['residues'].append(res)
+        else:
+            self.mods.append(mod)
+            self.by_name[name] = mod
+            self.residue_sets[name] = set(mod['residues'])
+
+        return name
+
+    def dump(self):
+        """
+        :return: json serializable state of the registry (see load)
+        """
+        return {
+            'mods': self.mods,
+            'resolved_names': [[name, mass, registered_name] for (name, mass), registered_name
+                               in self.resolved_names.items()]
+        }
+
+    @classmethod
+    def load(cls, state):
+        """
+        :param state: state returned by dump
+        :return: ModificationRegistry with the registered modifications of state
+        """
+        registry = cls()
+        for mod in state['mods']:
+            registry.mods.append(mod)
+            registry.by_name[mod['name']] = mod
+            registry.residue_sets[mod['name']] = set(mod['residues'])
+        for name, mass, registered_name in state['resolved_names']:
+            registry.resolved_names[(name, mass)] = registered_name
+        return registry
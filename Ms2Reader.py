@@ -25,6 +25,8 @@ import codecs
 
 from collections import defaultdict as ddict
 
+import PeakListIndex
+
 
 class RegexPatterns(object):
     params_pattern = re.compile('([A-Z]+)=(.*)')
@@ -47,6 +49,10 @@ class Reader(object):
                         path obsolete, seeking is disabled
     :type file_object: File_object like
 
+    :param index_cache: IndexCache to load the scan index from and store it in,
+                        the index is built every time if None
+    :type index_cache: IndexCache
+
     Example:
 
     """
@@ -55,6 +61,7 @@ class Reader(object):
             self,
             path=None,
             file_object=None,
+            index_cache=None,
     ):
 
         # self.info contains information extracted from the mgf file
@@ -69,6 +76,9 @@ class Reader(object):
         assert path is not None or file_object is not None, \
             'Must provide either a path or a file object to parse'
 
+        # IndexCache for storing the scan offsets (see PeakListIndex.save_offset_list)
+        self.index_cache = index_cache
+
         self.info['fileObject'], self.info['seekable'] = self.__open_file(
             path,
             file_object
@@ -97,10 +107,8 @@ class Reader(object):
                     gzip.open(path)
                 )
             else:
-                file_object = codecs.open(
-                    path,
-                    mode='r'
-                )
+                # path can be a stored zip member (see ArchiveExtractor.ZipMember)
+                file_object = PeakListIndex.open_file(path)
                 seekable = True
 
         return file_object, seekable
@@ -116,72 +124,33 @@ class Reader(object):
                   seeking to a particular offset for the file.
         """
 
-        # Declare the seeker
-        seeker = open(self.info['filename'], 'rb')
+        # Declare the seeker, it's kept open for reading the scans
+        seeker = PeakListIndex.open_file(self.info['filename'])
 
         self.info['offsets'] = None
-        seeker.seek(0, 2) #  what's this for? - cc
 
-        self._build_index_from_scratch(seeker)
+        offset_list = None
+        if self.index_cache is not None:
+            offset_list = PeakListIndex.load_offset_list(self.index_cache, self.info['filename'])
 
-        seeker.close()
-        seeker = codecs.open(
-            self.info['filename'],
-            mode='rb'
-        )
+        if offset_list is None:
+            self._build_index_from_scratch(seeker)
+            if self.index_cache is not None:
+                PeakListIndex.save_offset_list(self.index_cache, self.info['filename'],
+                                               self.info['offsetList'])
+        else:
+            self.info['offsetList'] = offset_list
+            self.info['seekable'] = True
 
+        seeker.seek(0)
         return seeker
 
     def _build_index_from_scratch(self, seeker):
-        """Build an index of spectra data with offsets by parsing the file."""
-
-        def get_data_indices(fh):
-            """Get a list with binary file indices of spectra in mgf file."""
-            spec_positions = []
-
-            # go to start of file
-            fh.seek(0)
-            pos = 0
-            scan_start_pos = None
-            for line in fh:
-                if line[0] == "S":
-                    if scan_start_pos:
-                        scan_end_pos = pos
-                        spec_positions.append((scan_start_pos, scan_end_pos))
-                    scan_start_pos = pos
-                pos = pos + len(line)
-
-            # last one
-            spec_positions.append((scan_start_pos, pos))
-
-            return spec_positions
-
-
-
-            # go to start of file
-            # fh.seek(0)
-            # pos = 0
-            # peak_list_start_pos = None
-            # for line in fh:
-            #     if line[0].isdigit():
-            #         if peak_list_start_pos is None or peak_list_start_pos == -1:
-            #             peak_list_start_pos = pos
-            #
-            #     elif peak_list_start_pos is not None and peak_list_start_pos != -1:
-            #             spec_positions.append((peak_list_start_pos, pos))
-            #             peak_list_start_pos = -1
-            #
-            #     pos = pos + len(line)
-            #
-            # # last one
-            # if peak_list_start_pos != -1:
-            #     spec_positions.append((peak_list_start_pos, pos))
-            # return spec_positions
-
-        indices = get_data_indices(seeker)
-        if indices is None:
-            raise ParseError()
-        self.info['offsetList'] = indices
+        """
+        Build an index of spectra data with offsets by searching the memory mapped file
+        (see PeakListIndex.index_ms2).
+        """
+        self.info['offsetList'] = PeakListIndex.index_ms2(seeker)
         self.info['seekable'] = True
 
         return
@@ -196,8 +165,9 @@ class Reader(object):
         start_pos = position[0]
         end_pos = position[1]
 
+        # a new dict for each scan, so returned scans aren't changed by later requests
         if start_pos == -1:  # empty scan
-            self.spectrum['peaks'] = ''
+            self.spectrum = {'peaks': '', 'precursor': None}
             # self.spectrum['params'] = params
             return self.spectrum
 
@@ -207,8 +177,10 @@ class Reader(object):
         if scan is None:
             raise KeyError("MS2 file does not contain a spectrum with index {0}.".format(scan_id))
         else:
-            self.spectrum['peaks'] = self.parse_peak_list(scan)
-            self.spectrum['precursor'] = self.parse_precursor(scan)
+            self.spectrum = {
+                'peaks': self.parse_peak_list(scan),
+                'precursor': self.parse_precursor(scan)
+            }
             return self.spectrum
 
     def __getitem__(self, scan_id):
@@ -1,4 +1,18 @@
 import pyteomics.mzid as py_mzid
+from pyteomics.xml import ByteEncodingOrderedDict
+import pyteomics.xml as py_xml
+from MzIdStreamReader import MzIdStreamReader, MzIdStreamParseError
+from IndexCache import IndexCache
+from DBSequenceCache import DBSequenceCache
+from ModificationRegistry import ModificationRegistry
+from UnimodTable import UnimodTable
+from DBWriter import DBWriter
+from Checkpoint import Checkpoint
+from collections import defaultdict
+from itertools import islice
+from lxml import etree
+from io import BytesIO
+import multiprocessing
 import re
 import ntpath
 import json
@@ -6,8 +20,8 @@ import sys
 from time import time
 from PeakListParser import PeakListParser
 import zipfile
-import gzip
 import os
+import ArchiveExtractor
 from NumpyEncoder import NumpyEncoder
 
 
@@ -15,12 +29,142 @@ class MzIdParseException(Exception):
     pass
 
 
+# parser used by the forked main loop worker processes (see MzIdParser.process_sid_results_parallel)
+_shard_parser = None
+
+
+def _init_shard_worker():
+    # file handles are shared with the parent after the fork, reopen them so seeking doesn't interfere
+    for peak_list_reader in _shard_parser.peak_list_readers.values():
+        peak_list_reader.reopen()
+
+
+def _process_shard(shard):
+    return _shard_parser.process_sid_result_shard(shard)
+
+
+class CachedMzIdentML(py_mzid.MzIdentML):
+    """
+    pyteomics MzIdentML reader that loads its byte offset index from an IndexCache
+    instead of scanning the whole file, if there is a valid entry for it.
+    With index_sid_results SpectrumIdentificationResults are indexed as well, their offsets are
+    used for splitting the main loop into shards (see MzIdParser.process_sid_results_parallel).
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.index_cache = kwargs.pop('index_cache', None)
+        # one entry per SpectrumIdentificationResult, only built for the parallel main loop
+        if kwargs.pop('index_sid_results', False):
+            kwargs['indexed_tags'] = py_mzid.MzIdentML._indexed_tags | {
+                'SpectrumIdentificationResult'}
+        super(CachedMzIdentML, self).__init__(*args, **kwargs)
+
+    def _get_light_info(self, element, name, attributes=True):
+        # attributes and cv/userParams of an element, without recursion
+        info = {}
+        if attributes:
+            schema_info = self.schema_info
+            info.update(element.attrib)
+            for k, v in info.items():
+                for t, a in self._converters_items:
+                    if t in schema_info and (name, k) in schema_info[t]:
+                        info[k] = a(v)
+        for child in element.iterchildren():
+            if py_xml._local_name(child) in {'cvParam', 'userParam', 'UserParam'}:
+                param = self._handle_param(child)
+                if not ('name' in info and 'name' in param):
+                    info.update(param)
+        return info
+
+    def get_light_sid_result(self, element):
+        """
+        Convert a SpectrumIdentificationResult element to a dict with only the fields used by
+        the main loop: the SIR attributes and the SpectrumIdentificationItems with their
+        attributes, cv/userParams and IonType params. FragmentArrays, PeptideEvidenceRefs and the
+        SIR cv/userParams aren't converted.
+        Values are converted the same way as by _get_info_smart.
+
+        :param element: lxml SpectrumIdentificationResult element
+        """
+        sid_result = dict(element.attrib)
+        sid_items = []
+        for child in element.iterchildren('{*}SpectrumIdentificationItem'):
+            sid_item = self._get_light_info(child, 'SpectrumIdentificationItem')
+            # Fragmentation is flattened by pyteomics
+            for fragmentation in child.iterchildren('{*}Fragmentation'):
+                for ion_type in fragmentation.iterchildren('{*}IonType'):
+                    # only the params (ion names), index and charge aren't used
+                    sid_item.setdefault('IonType', []).append(
+                        self._get_light_info(ion_type, 'IonType', attributes=False))
+            sid_items.append(sid_item)
+        if sid_items:
+            sid_result['SpectrumIdentificationItem'] = sid_items
+        return sid_result
+
+    def _build_index(self):
+        if self.index_cache is None or not self._indexed_tags or not self._use_index:
+            return super(CachedMzIdentML, self)._build_index()
+
+        indexed_tags = sorted(self._indexed_tags)
+        cached_index = self.index_cache.load(self._source_init)
+        # entries written for a different set of indexed tags are rebuilt
+        if cached_index is None or cached_index.get('indexed_tags') != indexed_tags:
+            super(CachedMzIdentML, self)._build_index()
+            self.index_cache.save(self._source_init, {
+                'indexed_tags': indexed_tags,
+                'offsets': {tag: offsets.items() for tag, offsets in self._offset_index.items()}
+            })
+            return
+
+        self._offset_index = defaultdict(ByteEncodingOrderedDict)
+        self._flat_offset_index = ByteEncodingOrderedDict()
+        for tag, offsets in cached_index['offsets'].items():
+            self._offset_index[str(tag)] = ByteEncodingOrderedDict(offsets)
+            self._flat_offset_index.update(offsets)
+
+
 class MzIdParser:
     """
 
     """
+    # parsing engine: False - random access through the pyteomics offset index,
+    # True - read the file once front to back (see MzIdStreamReader)
+    single_pass = False
+    # single pass engine: read gzipped mzid files directly instead of extracting them first
+    stream_compressed = True
+
+    # main loop: only convert the SpectrumIdentificationResult fields that are used
+    # (see CachedMzIdentML.get_light_sid_result)
+    light_sid_results = True
+
+    # write rows to the DB in a background thread while parsing (see DBWriter)
+    background_db_writes = True
+
+    # store references to the scans in the peak list files instead of the peak lists
+    # (see PeakListResolver)
+    store_peak_references = False
+    # store peak lists binary encoded (see PeakListEncoding) instead of as text, the text
+    # format is kept by default for the xiSPEC front end
+    binary_peak_lists = False
+
+    # number of processes for the main loop (index engine only)
+    processes = 1
+
+    # number of threads opening the peak list readers (see PeakListParser.open_readers)
+    peak_list_reader_threads = 4
+    # zip archive of the peak list files (see PeakListParser.open_zip_peak_lists), only the files
+    # referenced by the SpectraData are extracted, to peak_list_dir
+    peak_list_archive = None
+    # number of SpectrumIdentificationResults per shard for the parallel main loop
+    shard_size = 5000
+    # number of SpectrumIdentificationResults whose scans are read together (see get_sid_result_scans)
+    scan_batch_size = 1000
+
+    sid_result_end_pattern = re.compile(r'</(\w+:)?SpectrumIdentificationResult\s*>')
+
     def __init__(self, mzid_path, temp_dir, peak_list_dir, db, logger, db_name='', user_id=0,
-                 origin=''):
+                 origin='', single_pass=None, index_cache_dir=None, processes=None,
+                 checkpoint_path=None, resume=False):
         """
 
         :param mzid_path: path to mzidentML file
@@ -28,8 +172,21 @@ class MzIdParser:
         :param db: database python module to use (xiUI_pg or xiSPEC_sqlite)
         :param db_name: db name for SQLite
         :param origin: ftp dir of pride project
+        :param single_pass: overrides the class default parsing engine if not None
+        :param index_cache_dir: dir to store mzid and peak list offset indices in, next to the
+            indexed files if None
+        :param processes: overrides the class default number of main loop processes if not None
+        :param checkpoint_path: path of the file to save the progress of the main loop to
+            (see Checkpoint), no checkpoints are saved if None
+        :param resume: continue the upload saved at checkpoint_path if there is a valid
+            checkpoint for the mzid file, instead of starting a new upload
         """
 
+        if single_pass is not None:
+            self.single_pass = single_pass
+        if processes is not None:
+            self.processes = processes
+
         self.upload_id = 0
         self.mzid_path = mzid_path
 
@@ -58,7 +215,7 @@ class MzIdParser:
         # ToDo: AnalysisProtocolCollection->SpectrumIdentificationProtocol->ModificationParams
         # ToDo: atm we get them while looping through the peptides
         #  (might be more robust and we're doing it anyway)
-        self.modlist = []
+        self.modlist = ModificationRegistry()
         self.unknown_mods = []
 
         # From mzidentML schema 1.2.0:
@@ -68,6 +225,10 @@ class MzIdParser:
 
         self.warnings = []
 
+        # per file caches for the main loop
+        self.score_key_cache = {}   # SpectrumIdentificationItem key -> is score
+        self.ion_types_cache = {}   # tuple of IonType names -> ';' joined ion types
+
         # connect to DB
         try:
             self.con = db.connect(db_name)
@@ -78,16 +239,46 @@ class MzIdParser:
             print(e)
             sys.exit(1)
 
-        self.upload_id = self.db.new_upload([user_id, os.path.basename(self.mzid_path), origin],
-                                            self.cur, self.con)
+        self.checkpoint = None
+        self.resume_state = None    # state of the checkpoint the upload is resumed from
+        if checkpoint_path is not None:
+            self.checkpoint = Checkpoint(checkpoint_path, self.mzid_path)
+            if resume:
+                self.resume_state = self.checkpoint.load()
+                if self.resume_state is None:
+                    self.logger.info('no valid checkpoint to resume from at {}'.format(checkpoint_path))
+
+        if self.resume_state is not None:
+            # resuming needs random access to the SpectrumIdentificationResults
+            self.single_pass = False
+            self.upload_id = self.resume_state['upload_id']
+            self.random_id = self.resume_state['random_id']
+        else:
+            self.upload_id = self.db.new_upload([user_id, os.path.basename(self.mzid_path), origin],
+                                                self.cur, self.con)
 
-        self.random_id = self.db.get_random_id(self.upload_id, self.cur, self.con)
+            self.random_id = self.db.get_random_id(self.upload_id, self.cur, self.con)
 
         self.upload_info_read = False
         self.mzid_reader = None
+        self.db_writer = None
+        self.mzid_size = None   # size of the mzid file if it is read without extracting it
+        self.db_sequence_cache = None
+        self.index_cache = IndexCache(suffix='idx')
+        self.peak_list_index_cache = None   # PeakListParser.default_index_cache
+        if index_cache_dir is not None:
+            # separate dirs, so the size limits of the mzid and peak list indices are independent
+            self.index_cache = IndexCache(os.path.join(index_cache_dir, 'mzid'), suffix='idx')
+            self.peak_list_index_cache = IndexCache(os.path.join(index_cache_dir, 'peak_lists'),
+                                                    suffix='idx')
+        self.sid_result_offsets = None
 
     def initialise_mzid_reader(self):
-        if self.mzid_path.endswith('.gz') or self.mzid_path.endswith('.zip'):
+        # the single pass engine only reads forward, so it can read gzip files without extracting
+        stream_compressed = self.single_pass and self.stream_compressed and \
+            self.mzid_path.endswith('.gz')
+        if not stream_compressed and (self.mzid_path.endswith('.gz') or
+                                      self.mzid_path.endswith('.zip')):
             self.mzid_path = MzIdParser.extract_mzid(self.mzid_path)
 
         self.logger.info('reading mzid - start ' + self.mzid_path)
@@ -95,21 +286,43 @@ class MzIdParser:
         # schema:
         # https://raw.githubusercontent.com/HUPO-PSI/mzIdentML/master/schema/mzIdentML1.2.0.xsd
         try:
-            self.mzid_reader = py_mzid.MzIdentML(self.mzid_path)
+            if stream_compressed:
+                source = ArchiveExtractor.open_stream(self.mzid_path)
+            else:
+                source = self.mzid_path
+            # the single pass engine doesn't use random access, so skip building the offset index
+            self.mzid_reader = CachedMzIdentML(source, use_index=not self.single_pass,
+                                               index_cache=self.index_cache,
+                                               index_sid_results=self.processes > 1)
         except Exception as e:
             raise MzIdParseException(type(e).__name__, e.args)
 
         self.logger.info('reading mzid - done. Time: {} sec'.format(round(time() - start_time, 2)))
 
+    def get_spectra_data(self):
+        """
+        :return: list of all SpectraData elements
+        """
+        if not self.mzid_reader._use_index:
+            spectra_data = list(self.mzid_reader.iterfind('SpectraData', detailed=True))
+            self.mzid_reader.reset()
+            return spectra_data
+
+        spectra_data = []
+        for spectra_data_id in self.mzid_reader._offset_index["SpectraData"].keys():
+            sp_datum = self.mzid_reader.get_by_id(spectra_data_id, tag_id='SpectraData',
+                                                  detailed=True)
+            spectra_data.append(sp_datum)
+
+        return spectra_data
+
     # used by TestLoop when downloading files from PRIDE
     def get_supported_peak_list_file_names(self):
         """
         :return: list of all supported peak list file names
         """
         peak_list_file_names = []
-        for spectra_data_id in self.mzid_reader._offset_index["SpectraData"].keys():
-            sp_datum = self.mzid_reader.get_by_id(spectra_data_id, tag_id='SpectraData',
-                                                  detailed=True)
+        for sp_datum in self.get_spectra_data():
             ff_acc = sp_datum['FileFormat']['accession']
             if any([ff_acc == 'MS:1001062',  # MGF
                     ff_acc == 'MS:1000584',  # mzML
@@ -124,57 +337,85 @@ class MzIdParser:
         """
         :return: list of all peak list file names
         """
-        peak_list_file_names = []
-        for spectra_data_id in self.mzid_reader._offset_index["SpectraData"].keys():
-            sp_datum = self.mzid_reader.get_by_id(spectra_data_id, tag_id='SpectraData',
-                                                  detailed=True)
-            peak_list_file_names.append(ntpath.basename(sp_datum['location']))
-
-        return peak_list_file_names
+        return [ntpath.basename(sp_datum['location']) for sp_datum in self.get_spectra_data()]
 
-    def init_peak_list_readers(self):
+    def init_peak_list_readers(self, spectra_data=None):
         """
         sets self.peak_list_readers by looping through SpectraData elements
         dictionary:
             key: spectra_data_ref
             value: associated peak_list_reader
+
+        :param spectra_data: list of SpectraData elements, read from the mzid_reader if None
         """
-        peak_list_readers = {}
-        for spectra_data_id in self.mzid_reader._offset_index["SpectraData"].keys():
-            sp_datum = self.mzid_reader.get_by_id(spectra_data_id, tag_id='SpectraData',
-                                                  detailed=True)
+        if spectra_data is None:
+            spectra_data = self.get_spectra_data()
+
+        # the readers are opened in parallel (see PeakListParser.open_readers), the errors of all
+        # files are reported together
+        open_functions = [
+            (sp_datum['id'], lambda sp_datum=sp_datum: self.open_peak_list_reader(sp_datum))
+            for sp_datum in spectra_data
+        ]
+        peak_list_readers, errors = PeakListParser.open_readers(open_functions,
+                                                                self.peak_list_reader_threads)
+        for sd_id, e in errors:
+            if not isinstance(e, MzIdParseException):
+                raise e
+        if len(errors) > 0:
+            raise MzIdParseException('\n'.join([e.args[0] for sd_id, e in errors]))
 
-            self.check_spectra_data_validity(sp_datum)
+        self.peak_list_readers = peak_list_readers
+
+    def open_peak_list_reader(self, sp_datum):
+        """
+        :param sp_datum: SpectraData element
+        :return: PeakListParser for the peak list file (or its gz version)
+        """
+        self.check_spectra_data_validity(sp_datum)
 
-            sd_id = sp_datum['id']
-            peak_list_file_name = ntpath.basename(sp_datum['location'])
-            peak_list_file_path = self.peak_list_dir + peak_list_file_name
+        peak_list_file_name = ntpath.basename(sp_datum['location'])
+        peak_list_file_path = self.peak_list_dir + peak_list_file_name
 
+        try:
+            peak_list_reader = PeakListParser(
+                self.get_peak_list_path(peak_list_file_name, sp_datum['FileFormat']['accession']),
+                sp_datum['FileFormat']['accession'],
+                sp_datum['SpectrumIDFormat']['accession'],
+                self.peak_list_index_cache
+            )
+        except Exception:
+            # try gz version
             try:
                 peak_list_reader = PeakListParser(
-                    peak_list_file_path,
+                    PeakListParser.extract_gz(self.get_peak_list_path(peak_list_file_name + '.gz')),
                     sp_datum['FileFormat']['accession'],
-                    sp_datum['SpectrumIDFormat']['accession']
+                    sp_datum['SpectrumIDFormat']['accession'],
+                    self.peak_list_index_cache
                 )
-            except Exception:
-                # try gz version
-                try:
-                    peak_list_reader = PeakListParser(
-                        PeakListParser.extract_gz(peak_list_file_path + '.gz'),
-                        sp_datum['FileFormat']['accession'],
-                        sp_datum['SpectrumIDFormat']['accession']
-                    )
-                except IOError:
-                    raise MzIdParseException('Missing peak list file: %s' % peak_list_file_path)
+            except IOError:
+                raise MzIdParseException('Missing peak list file: %s' % peak_list_file_path)
 
-            peak_list_readers[sd_id] = peak_list_reader
+        peak_list_reader.binary_peaks = self.binary_peak_lists
+        return peak_list_reader
 
-        self.peak_list_readers = peak_list_readers
+    def get_peak_list_path(self, peak_list_file_name, file_format_accession=None):
+        """
+        :param peak_list_file_name: file name of the peak list file
+        :param file_format_accession: file format cv accession, None for files that need to be
+            extracted (e.g. .gz)
+        :return: path of the peak list file in peak_list_dir, extracted from peak_list_archive if
+            it is set (or an ArchiveExtractor.ZipMember for stored files that can be read in place)
+        """
+        if self.peak_list_archive is None:
+            return self.peak_list_dir + peak_list_file_name
+        # the PeakListResolver reads referenced peak lists from peak_list_dir
+        in_place = not self.store_peak_references and \
+            file_format_accession in PeakListParser.in_place_formats
+        return self.peak_list_archive.get_path(peak_list_file_name, in_place)
 
     def check_all_spectra_data_validity(self):
-        for spectra_data_id in self.mzid_reader._offset_index["SpectraData"].keys():
-            sp_datum = self.mzid_reader.get_by_id(spectra_data_id, tag_id='SpectraData',
-                                                  detailed=True)
+        for sp_datum in self.get_spectra_data():
             self.check_spectra_data_validity(sp_datum)
 
     @staticmethod
@@ -204,17 +445,29 @@ class MzIdParser:
 
         start_time = time()
 
-        if not self.upload_info_read:
-            self.upload_info()  # overridden (empty function) in xiSPEC subclass
-
-        if self.peak_list_dir:
-            self.init_peak_list_readers()
-
-        self.parse_db_sequences()  # overridden (empty function) in xiSPEC subclass
-        self.parse_peptides()
-        self.parse_peptide_evidences()
-        self.map_spectra_data_to_protocol()
-        self.main_loop()
+        if self.background_db_writes:
+            self.db_writer = DBWriter(self.db, self.cur, self.con)
+        try:
+            if self.resume_state is not None:
+                self.parse_resume()
+            elif self.single_pass:
+                self.parse_single_pass()
+            else:
+                if not self.upload_info_read:
+                    self.upload_info()  # overridden (empty function) in xiSPEC subclass
+
+                if self.peak_list_dir:
+                    self.init_peak_list_readers()
+
+                self.parse_db_sequences()  # overridden (empty function) in xiSPEC subclass
+                self.parse_peptides()
+                self.parse_peptide_evidences()
+                self.map_spectra_data_to_protocol()
+                self.main_loop()
+            self.stop_db_writer()
+        finally:
+            # on errors the rows that haven't been written are dropped
+            self.stop_db_writer(discard=True)
 
         # meta_data = [self.upload_id, -1, -1, -1, -1]
         # self.db.write_meta_data(meta_data, self.cur, self.con)
@@ -223,10 +476,222 @@ class MzIdParser:
 
         self.other_info()
 
+        if self.checkpoint is not None:
+            self.checkpoint.remove()
+
         self.logger.info('all done! Total time: ' + str(round(time() - start_time, 2)) + " sec")
 
         self.con.close()
 
+    def write_rows(self, function_name, rows):
+        """
+        Write rows with a write function of the db module and commit, in the background if
+        the DB writer is running.
+
+        :param function_name: name of the db module function, e.g. 'write_peptides'
+        :param rows: list of rows, mustn't be changed afterwards
+        """
+        if self.db_writer is not None:
+            self.db_writer.write(function_name, rows)
+        else:
+            getattr(self.db, function_name)(rows, self.cur, self.con)
+            self.con.commit()
+
+    def flush_db_writes(self):
+        """
+        Wait for the DB writer, needed before using the connection directly.
+        """
+        if self.db_writer is not None:
+            self.db_writer.flush()
+
+    def after_db_writes(self, function, *args):
+        """
+        Call a function once the rows written so far are committed (by the DB writer thread if
+        it is running).
+        """
+        if self.db_writer is not None:
+            self.db_writer.call(function, *args)
+        else:
+            function(*args)
+
+    def get_checkpoint_state(self, spec_id, identification_id, fragment_parsing_error_scans):
+        """
+        :param spec_id: number of SpectrumIdentificationResults written
+        :param identification_id: number of spectrum identifications written
+        :param fragment_parsing_error_scans: SpectrumIdentificationResult ids with missing
+            fragment ion types
+        :return: json serializable state for resuming the main loop after spec_id
+            SpectrumIdentificationResults (see parse_resume)
+        """
+        return {
+            'upload_id': self.upload_id,
+            'random_id': self.random_id,
+            'upload_info_written': self.upload_info_read,
+            # byte offset of the last written SpectrumIdentificationResult (None if not indexed)
+            'sid_result_offset': self.get_last_sid_result_offset(spec_id),
+            'spec_id': spec_id,
+            'identification_id': identification_id,
+            # only the first ones end up in the warning (see main_loop)
+            'fragment_parsing_error_scans': fragment_parsing_error_scans[:51],
+            'contains_crosslinks': self.contains_crosslinks,
+            'modlist': self.modlist.dump(),
+            'unknown_mods': self.unknown_mods,
+            'warnings': self.warnings
+        }
+
+    def save_checkpoint(self, spec_id, identification_id, fragment_parsing_error_scans):
+        """
+        Save a checkpoint once the rows written so far are committed (see get_checkpoint_state).
+        """
+        if self.checkpoint is None:
+            return
+        # serialized now, the parser state changes while the DB writer catches up
+        state = json.loads(json.dumps(
+            self.get_checkpoint_state(spec_id, identification_id, fragment_parsing_error_scans),
+            cls=NumpyEncoder))
+        self.after_db_writes(self.checkpoint.save, state)
+
+    def parse_resume(self):
+        """
+        Alternative to parse() for an upload resumed from a checkpoint: everything before the
+        main loop has been written, the main loop continues after the last
+        SpectrumIdentificationResult saved in the checkpoint.
+        """
+        state = self.resume_state
+        self.logger.info('resuming upload {} after {} spectra'.format(self.upload_id,
+                                                                       state['spec_id']))
+
+        if state['sid_result_offset'] is not None and self.get_sid_result_offsets() and \
+                self.get_last_sid_result_offset(state['spec_id']) != state['sid_result_offset']:
+            raise MzIdParseException('Checkpoint does not match the mzid file')
+
+        # rows written after the checkpoint was saved
+        self.flush_db_writes()
+        self.db.delete_spectra_from(self.upload_id, state['spec_id'], state['identification_id'],
+                                    self.cur, self.con)
+
+        if self.peak_list_dir:
+            self.init_peak_list_readers()
+        self.map_spectra_data_to_protocol()
+
+        # overwrites the warnings of map_spectra_data_to_protocol, they are part of the state
+        self.modlist = ModificationRegistry.load(state['modlist'])
+        self.unknown_mods = state['unknown_mods']
+        self.warnings = state['warnings']
+        self.contains_crosslinks = state['contains_crosslinks']
+
+        self.main_loop(resume_state=state)
+
+        if not state['upload_info_written'] and not self.upload_info_read:
+            self.upload_info()  # overridden (empty function) in xiSPEC subclass
+
+    def stop_db_writer(self, discard=False):
+        if self.db_writer is None:
+            return
+        db_writer = self.db_writer
+        self.db_writer = None
+        db_writer.close(discard)
+
+    def parse_single_pass(self):
+        """
+        Alternative to the random access parsing in parse(). Reads the mzid file once front to
+        back and feeds each section to the same parse functions as it is passed.
+        Relies on the element order defined in the mzIdentML schema.
+        """
+        self.logger.info('single pass parsing - start')
+        start_time = time()
+
+        self.db_sequence_cache = DBSequenceCache(self.mzid_reader)
+        stream = MzIdStreamReader(self.mzid_path, self.mzid_reader, self.db_sequence_cache)
+        # AnalysisSoftware needs to be a list (see upload_info)
+        self.mzid_reader.schema_info['lists'].add("AnalysisSoftware")
+
+        try:
+            upload_info_sections = {}
+            for tag in ['AnalysisSoftwareList', 'Provider', 'AuditCollection',
+                        'AnalysisSampleCollection']:
+                upload_info_sections[tag] = list(stream.section(tag))
+
+            self.parse_db_sequences(stream.section('DBSequence'))  # overridden (empty function) in xiSPEC subclass
+            self.parse_peptides(stream.section('Peptide'))
+            # DBSequences are added to the cache by the stream even if the section was skipped
+            self.parse_peptide_evidences(stream.section('PeptideEvidence'))
+
+            analysis_collections = list(stream.section('AnalysisCollection'))
+            sid_protocols = {p['id']: p for p in stream.section('SpectrumIdentificationProtocol')}
+            upload_info_sections['AnalysisCollection'] = analysis_collections
+            upload_info_sections['AnalysisProtocolCollection'] = list(
+                stream.section('AnalysisProtocolCollection'))
+            if len(analysis_collections) == 0:
+                raise MzIdParseException('Missing AnalysisCollection')
+            self.map_spectra_data_to_protocol(analysis_collections[0], sid_protocols)
+
+            spectra_data = list(stream.section('SpectraData'))
+            upload_info_sections['SpectraData'] = spectra_data
+            if self.peak_list_dir:
+                self.init_peak_list_readers(spectra_data)
+
+            self.main_loop(stream.section('SpectrumIdentificationResult', self.convert_sid_result))
+
+            upload_info_sections['BibliographicReference'] = list(
+                stream.section('BibliographicReference'))
+            stream.close()
+            self.mzid_size = stream.document_size
+        except MzIdStreamParseError as e:
+            raise MzIdParseException(type(e).__name__, e.args)
+
+        # BibliographicReference is at the end of the file, so upload info is written last
+        if not self.upload_info_read:
+            self.upload_info(upload_info_sections)  # overridden (empty function) in xiSPEC subclass
+
+        self.logger.info('single pass parsing - done. Time: {} sec'.format(
+            round(time() - start_time, 2)))
+
+    def is_score_key(self, key):
+        """
+        :param key: SpectrumIdentificationItem key
+        :return: True if the value is a score (cached per key)
+        """
+        try:
+            return self.score_key_cache[key]
+        except KeyError:
+            lower_key = key.lower()
+            is_score = 'score' in lower_key or \
+                       'pvalue' in lower_key or \
+                       'evalue' in lower_key or \
+                       'sequest' in lower_key or \
+                       'scaffold' in lower_key
+            self.score_key_cache[key] = is_score
+            return is_score
+
+    def get_ions(self, sid_item):
+        """
+        Ion types of a SpectrumIdentificationItem, memoized by the IonType names.
+
+        :return: ';' joined ion types or None if none are specified
+        """
+        try:
+            ion_names = tuple([i['name'] for i in sid_item['IonType']])
+        except KeyError:
+            return None
+
+        try:
+            return self.ion_types_cache[ion_names]
+        except KeyError:
+            cache = True
+        except TypeError:   # unhashable name
+            cache = False
+
+        ions = list(set(self.get_ion_types_mzid(sid_item)))
+        if len(ions) == 0:
+            ions = None
+        else:
+            ions = ';'.join(ions)
+        if cache:
+            self.ion_types_cache[ion_names] = ions
+
+        return ions
+
     def get_ion_types_mzid(self, sid_item):
         try:
             ion_names_list = [i['name'] for i in sid_item['IonType']]
@@ -273,23 +738,12 @@ class MzIdParser:
             return return_file_list[0]
 
         elif archive.endswith('gz'):
-            in_f = gzip.open(archive, 'rb')
-            archive = archive.replace(".gz", "")
-            out_f = open(archive, 'wb')
-            try:
-                out_f.write(in_f.read())
-            except IOError:
-                raise StandardError('Zip archive error: %s' % archive)
-
-            in_f.close()
-            out_f.close()
-
-            return archive
+            return ArchiveExtractor.extract_gz(archive)
 
         else:
             raise StandardError('unsupported file type: %s' % archive)
 
-    def map_spectra_data_to_protocol(self):
+    def map_spectra_data_to_protocol(self, analysis_collection=None, sid_protocols=None):
         """
         extract and map spectrumIdentificationProtocol which includes annotation data like fragment
          tolerance only fragment tolerance is extracted for now
@@ -298,7 +752,9 @@ class MzIdParser:
 
         Parameters:
         ------------------------
-        mzid_reader: pyteomics mzid_reader
+        analysis_collection: AnalysisCollection element, read from the mzid_reader if None
+        sid_protocols: dict of SpectrumIdentificationProtocol elements indexed by id,
+            looked up in the mzid_reader if None
         """
 
         self.logger.info('generating spectra data protocol map - start')
@@ -306,15 +762,22 @@ class MzIdParser:
 
         spectra_data_protocol_map = {}
 
-        sid_protocols = []
+        if analysis_collection is None:
+            analysis_collection = self.mzid_reader.iterfind('AnalysisCollection').next()
+            self.mzid_reader.reset()
 
-        analysis_collection = self.mzid_reader.iterfind('AnalysisCollection').next()
         for spectrumIdentification in analysis_collection['SpectrumIdentification']:
             sid_protocol_ref = spectrumIdentification['spectrumIdentificationProtocol_ref']
-            sid_protocol = self.mzid_reader.get_by_id(sid_protocol_ref,
-                                                      tag_id='SpectrumIdentificationProtocol',
-                                                      detailed=True)
-            sid_protocols.append(sid_protocol)
+            if sid_protocols is None:
+                sid_protocol = self.mzid_reader.get_by_id(sid_protocol_ref,
+                                                          tag_id='SpectrumIdentificationProtocol',
+                                                          detailed=True)
+            else:
+                try:
+                    sid_protocol = sid_protocols[sid_protocol_ref]
+                except KeyError:
+                    raise MzIdParseException(
+                        'Missing SpectrumIdentificationProtocol: %s' % sid_protocol_ref)
             try:
                 frag_tol = sid_protocol['FragmentTolerance']
                 frag_tol_plus = frag_tol['search tolerance plus value']
@@ -354,7 +817,6 @@ class MzIdParser:
                     'fragmentTolerance': ' '.join([frag_tol_value, frag_tol_unit])
                 }
 
-        self.mzid_reader.reset()
         self.spectra_data_protocol_map = spectra_data_protocol_map
         self.logger.info('generating spectraData_ProtocolMap - done. Time: {} sec'.format(
             round(time() - start_time, 2)))
@@ -369,29 +831,54 @@ class MzIdParser:
 
         mod['residues'] = [aa for aa in mod['residues']]
 
-        if mod['name'] in [m['name'] for m in self.modlist]:
-            old_mod = self.modlist[[m['name'] for m in self.modlist].index(mod['name'])]
-            # check if modname with different mass exists already
-            if mod['monoisotopicMassDelta'] != old_mod['monoisotopicMassDelta']:
-                mod['name'] += "*"
-                self.add_to_modlist(mod)
-            else:
-                for res in mod['residues']:
-                    if res not in old_mod['residues']:
-                        old_mod['residues'].append(res)
-        else:
-            self.modlist.append(mod)
+        # modname with different mass gets a '*' appended
+        return self.modlist.add(mod)
 
-        return mod['name']
+    def iter_indexed(self, tag_id):
+        """
+        Generator over all elements of one indexed type using random access by id.
 
-    def parse_db_sequences(self):
+        :param tag_id: indexed tag, e.g. 'Peptide'
+        """
+        for elem_id in self.mzid_reader._offset_index[tag_id].keys():
+            yield self.mzid_reader.get_by_id(elem_id, tag_id=tag_id, detailed=True)
+
+    def get_db_sequence_cache(self):
+        """
+        :return: DBSequenceCache with all DBSequences of the file, built from the mzid file if
+            they haven't been parsed
+        """
+        if self.db_sequence_cache is None or not self.db_sequence_cache.complete:
+            self.logger.info('build db sequence cache - start')
+            start_time = time()
+            self.db_sequence_cache = DBSequenceCache(self.mzid_reader)
+            self.db_sequence_cache.build(self.mzid_path)
+            self.logger.info('build db sequence cache - done. Time: {} sec'.format(
+                round(time() - start_time, 2)))
+
+        return self.db_sequence_cache
+
+    def parse_db_sequences(self, db_sequences=None):
+        """
+        Also fills the db_sequence_cache.
+
+        :param db_sequences: iterable of DBSequence elements, read from the mzid_reader if None
+        """
 
         self.logger.info('parse db sequences - start')
         start_time = time()
+
+        fill_cache = db_sequences is None
+        if db_sequences is None:
+            db_sequences = self.iter_indexed('DBSequence')
+            self.db_sequence_cache = DBSequenceCache(self.mzid_reader)
+
         # DBSEQUENCES
         inj_list = []
-        for db_id in self.mzid_reader._offset_index["DBSequence"].keys():
-            db_sequence = self.mzid_reader.get_by_id(db_id, tag_id='DBSequence', detailed=True)
+        for db_sequence in db_sequences:
+            if fill_cache:
+                self.db_sequence_cache.add(db_sequence["id"], db_sequence["accession"],
+                                           db_sequence.get("name"))
 
             data = [db_sequence["id"], db_sequence["accession"]]
 
@@ -421,23 +908,30 @@ class MzIdParser:
 
             inj_list.append(data)
 
-        self.db.write_db_sequences(inj_list, self.cur, self.con)
+        self.write_rows('write_db_sequences', inj_list)
+        if fill_cache:
+            self.db_sequence_cache.complete = True
 
         self.logger.info('parse db sequences - done. Time: {} sec'.format(
             round(time() - start_time, 2)))
 
-    def parse_peptides(self):
+    def parse_peptides(self, peptides=None):
+        """
+        :param peptides: iterable of Peptide elements, read from the mzid_reader if None
+        """
         start_time = time()
         self.logger.info('parse peptides, modifications - start')
 
+        if peptides is None:
+            peptides = self.iter_indexed('Peptide')
+
         # ToDo: might be stuff in pyteomics lib for this?
         unimod_masses = self.get_unimod_masses(self.unimod_path)
 
         # PEPTIDES
         peptide_index = 0
         peptide_inj_list = []
-        for pep_id in self.mzid_reader._offset_index["Peptide"].keys():
-            peptide = self.mzid_reader.get_by_id(pep_id, tag_id='Peptide', detailed=True)
+        for peptide in peptides:
             pep_seq_dict = []
             for aa in peptide['PeptideSequence']:
                 pep_seq_dict.append({"Modification": "", "aminoAcid": aa})
@@ -493,7 +987,7 @@ class MzIdParser:
                             # join modifications into one for multiple modifications on the same aa
                             if not cur_mod['Modification'] == '':
                                 mod['name'] = '_'.join(sorted([cur_mod['Modification'], mod['name']], key=str.lower))
-                                cur_mod_mass = [x['monoisotopicMassDelta'] for x in self.modlist if x['name'] == cur_mod['Modification']][0]
+                                cur_mod_mass = self.modlist.get(cur_mod['Modification'])['monoisotopicMassDelta']
                                 mod['monoisotopicMassDelta'] += cur_mod_mass
 
                             # save to all mods list and get back new_name
@@ -540,20 +1034,12 @@ class MzIdParser:
 
             if peptide_index % 1000 == 0:
                 self.logger.info('writing 1000 peptides to DB')
-                try:
-                    self.db.write_peptides(peptide_inj_list, self.cur, self.con)
-                    peptide_inj_list = []
-                    self.con.commit()
-                except Exception as e:
-                    raise e
+                self.write_rows('write_peptides', peptide_inj_list)
+                peptide_inj_list = []
 
             peptide_index += 1
 
-        try:
-            self.db.write_peptides(peptide_inj_list, self.cur, self.con)
-            self.con.commit()
-        except Exception as e:
-            raise e
+        self.write_rows('write_peptides', peptide_inj_list)
         #
         mod_index = 0
         modifications_inj_list = []
@@ -571,26 +1057,27 @@ class MzIdParser:
                 mod_accession
             ])
             mod_index += 1
-        self.db.write_modifications(modifications_inj_list, self.cur, self.con)
+        self.write_rows('write_modifications', modifications_inj_list)
 
         self.logger.info('parse peptides, modifications - done. Time: {} sec'.format(
             round(time() - start_time, 2)))
 
-    def parse_peptide_evidences(self):
+    def parse_peptide_evidences(self, peptide_evidences=None):
+        """
+        :param peptide_evidences: iterable of PeptideEvidence elements, read from the mzid_reader
+            if None
+        """
         start_time = time()
         self.logger.info('parse peptide evidences - start')
 
-        seq_id_to_acc_map = {}
+        db_sequence_cache = self.get_db_sequence_cache()
 
-        for db_id in self.mzid_reader._offset_index["DBSequence"].keys():
-            db_sequence = self.mzid_reader.get_by_id(db_id, tag_id='DBSequence', detailed=True)
-            seq_id_to_acc_map[db_sequence["id"]] = db_sequence["accession"]
+        if peptide_evidences is None:
+            peptide_evidences = self.iter_indexed('PeptideEvidence')
 
         # PEPTIDE EVIDENCES
         inj_list = []
-        for pep_ev_id in self.mzid_reader._offset_index["PeptideEvidence"].keys():
-            peptide_evidence = self.mzid_reader.get_by_id(pep_ev_id, tag_id='PeptideEvidence',
-                                                          detailed=True)
+        for peptide_evidence in peptide_evidences:
 
             pep_start = -1
             if "start" in peptide_evidence:
@@ -606,7 +1093,7 @@ class MzIdParser:
             data = [
                 peptide_ref,                                                 # 'peptide_ref',
                 peptide_evidence["dBSequence_ref"],                          # 'dbsequence_ref',
-                seq_id_to_acc_map[peptide_evidence["dBSequence_ref"]],       # 'protein_accession',
+                db_sequence_cache.accession(peptide_evidence["dBSequence_ref"]),  # 'protein_accession',
                 pep_start,                                                   # 'pep_start',
                 is_decoy,                                                    # 'is_decoy',
                 self.upload_id                                               # 'upload_id'
@@ -616,20 +1103,11 @@ class MzIdParser:
 
             if len(inj_list) % 1000 == 0:
                 self.logger.info('writing 1000 peptide_evidences to DB')
-                try:
-                    self.db.write_peptide_evidences(inj_list, self.cur, self.con)
-                    inj_list = []
-                    self.con.commit()
-                except Exception as e:
-                    raise e
+                self.write_rows('write_peptide_evidences', inj_list)
+                inj_list = []
 
-        try:
-            self.db.write_peptide_evidences(inj_list, self.cur, self.con)
-            self.con.commit()
-        except Exception as e:
-            raise e
+        self.write_rows('write_peptide_evidences', inj_list)
 
-        self.con.commit()
         self.mzid_reader.reset()
 
         self.logger.info('parse peptide evidences - done. Time: {} sec'.format(
@@ -637,184 +1115,319 @@ class MzIdParser:
 
     @staticmethod
     def get_unimod_masses(unimod_path):
-        masses = {}
-        mod_id = -1
+        return UnimodTable.get(unimod_path).masses
 
-        with open(unimod_path) as f:
-            for line in f:
-                if line.startswith('id: '):
-                    mod_id = ''.join(line.replace('id: ', '').split())
+    def get_write_spectra_function(self):
+        """
+        :return: name of the db module function for writing the spectra rows
+        """
+        if self.store_peak_references:
+            return 'write_spectra_references'
+        if self.binary_peak_lists:
+            return 'write_spectra_binary'
+        return 'write_spectra'
+
+    def get_sid_result_scans(self, sid_results):
+        """
+        Read the scans of a batch of SpectrumIdentificationResults with one get_scans request per
+        peak list file, so each file is read in offset order instead of mzid order.
+
+        :param sid_results: list of SpectrumIdentificationResult elements
+        :return: dict spectraData_ref -> dict scan_id -> scan
+        """
+        scan_ids = defaultdict(list)    # spectraData_ref -> scan ids
+        for sid_result in sid_results:
+            peak_list_reader = self.peak_list_readers[sid_result['spectraData_ref']]
+            scan_ids[sid_result['spectraData_ref']].append(
+                peak_list_reader.parse_scan_id(sid_result["spectrumID"]))
+
+        return {
+            sd_ref: self.peak_list_readers[sd_ref].get_scans(ids, self.store_peak_references)
+            for sd_ref, ids in scan_ids.items()
+        }
+
+    def process_sid_result_batch(self, sid_results):
+        """
+        process_sid_result for a batch of SpectrumIdentificationResults, reading their scans
+        together (see get_sid_result_scans).
+
+        :param sid_results: list of SpectrumIdentificationResult elements
+        :return: list of process_sid_result results in order of sid_results
+        """
+        scans = None
+        if self.peak_list_dir:
+            scans = self.get_sid_result_scans(sid_results)
+        return [self.process_sid_result(sid_result, scans) for sid_result in sid_results]
 
-                elif line.startswith('xref: delta_mono_mass ') and not mod_id == -1:
-                    mass = float(line.replace('xref: delta_mono_mass ', '').replace('"', ''))
-                    masses[mod_id] = mass
+    def process_sid_results_batched(self, sid_results):
+        """
+        Generator over the processed SpectrumIdentificationResults in order of sid_results,
+        processing them in batches of self.scan_batch_size (see process_sid_result_batch).
+        """
+        batch = []
+        for sid_result in sid_results:
+            batch.append(sid_result)
+            if len(batch) == self.scan_batch_size:
+                for processed_sid_result in self.process_sid_result_batch(batch):
+                    yield processed_sid_result
+                batch = []
+
+        for processed_sid_result in self.process_sid_result_batch(batch):
+            yield processed_sid_result
+
+    def process_sid_result(self, sid_result, scans=None):
+        """
+        Turn a SpectrumIdentificationResult into DB rows.
 
-        return masses
+        The ids are numbered by main_loop: spectrum id and spectrum_id of the identifications are
+        left as None, identification ids are numbered from 0 in order of the items.
+
+        :param sid_result: SpectrumIdentificationResult element
+        :param scans: scans read in advance (see get_sid_result_scans), read from the peak list
+            file if None
+        :return: tuple (spectrum row or None if there are no peak lists,
+            list of spectrum identification rows,
+            list of SpectrumIdentificationResult ids with missing fragment ion types)
+        """
+        spectrum = None
+        identification_id = 0
+        fragment_parsing_error_scans = []
+
+        if self.peak_list_dir:
+            peak_list_reader = self.peak_list_readers[sid_result['spectraData_ref']]
 
-    def main_loop(self):
+            scan_id = peak_list_reader.parse_scan_id(sid_result["spectrumID"])
+            if scans is not None:
+                scan = scans[sid_result['spectraData_ref']][scan_id]
+            elif self.store_peak_references:
+                scan = peak_list_reader.get_scan_reference(scan_id)
+            else:
+                scan = peak_list_reader.get_scan(scan_id)
+
+            protocol = self.spectra_data_protocol_map[sid_result['spectraData_ref']]
+
+            if scan['precursor'] is not None:
+                precursor_mz = scan['precursor']['mz']
+                precursor_charge = scan['precursor']['charge']
+            else:
+                # give warning precursor info is missing
+                precursor_mz = None
+                precursor_charge = None
+
+            spectrum = [
+                None,   # spec_id
+                scan.get('peaks'),
+                ntpath.basename(peak_list_reader.peak_list_path),
+                str(scan_id),
+                protocol['fragmentTolerance'],
+                self.upload_id,
+                sid_result['id'],
+                precursor_mz,
+                precursor_charge
+            ]
+            if self.store_peak_references:
+                spectrum += [scan['offset'], scan['length'], peak_list_reader.file_format_accession]
+
+        spectrum_ident_dict = dict()
+        linear_index = -1  # negative index values for linear peptides
+
+        for spec_id_item in sid_result['SpectrumIdentificationItem']:
+            # get suitable id
+            if 'cross-link spectrum identification item' in spec_id_item.keys():
+                self.contains_crosslinks = True
+                cross_link_id = spec_id_item['cross-link spectrum identification item']
+            else:  # assuming linear
+                # misusing 'cross-link spectrum identification item'
+                # for linear peptides with negative index
+                # specIdItem['cross-link spectrum identification item'] = linear_index
+                # spec_id_set.add(get_cross_link_identifier(specIdItem))
+
+                cross_link_id = linear_index
+                linear_index -= 1
+
+            # check if seen it before
+            if cross_link_id in spectrum_ident_dict.keys():
+                # do crosslink specific stuff
+                ident_data = spectrum_ident_dict.get(cross_link_id)
+                # ident_data[4] = self.peptide_id_lookup[spec_id_item['peptide_ref']]
+                ident_data[4] = spec_id_item['peptide_ref']  # debug
+            else:
+                # do stuff common to linears and crosslinks
+                charge_state = spec_id_item['chargeState']
+                pass_threshold = spec_id_item['passThreshold']
+                # ToDo: refactor with MS: cv Param list of all scores
+                scores = {
+                    k: v for k, v in spec_id_item.iteritems() if self.is_score_key(k)
+                }
+                #
+                # fragmentation ions
+                # ToDo: do we want to make assumptions of fragIon types by fragMethod from mzML?
+                ions = self.get_ions(spec_id_item)
+                # if no ion types are specified in the id file check the mzML file
+                # if len(ions) == 0 and peak_list_reader['fileType'] == 'mzml':
+                #     ions = peakListParser.get_ion_types_mzml(scan)
+
+                if ions is None:
+                    ions = 'peptide;b;y'
+                    # ToDo: better error handling for general errors -
+                    #  bundling together of same type errors
+                    fragment_parsing_error_scans.append(sid_result['id'])
+
+                # extract other useful info to display
+                rank = spec_id_item['rank']
+
+                # from mzidentML schema 1.2.0: For PMF data, the rank attribute may be
+                # meaningless and values of rank = 0 should be given.
+                # xiSPEC front-end expects rank = 1 as default
+                if rank is None or int(rank) == 0:
+                    rank = 1
+
+                experimental_mass_to_charge = spec_id_item['experimentalMassToCharge']
+                try:
+                    calculated_mass_to_charge = spec_id_item['calculatedMassToCharge']
+                except KeyError:
+                    calculated_mass_to_charge = None
+
+                ident_data = [
+                    identification_id,
+                    # spec_id_item['id'],
+                    self.upload_id,
+                    None,   # spec_id
+                    # self.peptide_id_lookup[spec_id_item['peptide_ref']], # debug use spec_id_item['peptide_ref'],
+                    spec_id_item['peptide_ref'],
+                    '',  # pep2
+                    charge_state,
+                    rank,
+                    pass_threshold,
+                    ions,
+                    json.dumps(scores),
+                    experimental_mass_to_charge,
+                    calculated_mass_to_charge,
+                    "",
+                    "",
+                    ""
+                ]
+
+                spectrum_ident_dict[cross_link_id] = ident_data
+
+                identification_id += 1
+
+        return spectrum, spectrum_ident_dict.values(), fragment_parsing_error_scans
+
+    def convert_sid_result(self, elem):
+        """
+        :param elem: lxml SpectrumIdentificationResult element
+        :return: dict with the fields used by process_sid_result (all fields if not
+            self.light_sid_results)
+        """
+        if self.light_sid_results:
+            return self.mzid_reader.get_light_sid_result(elem)
+        return self.mzid_reader._get_info_smart(elem)
+
+    def iter_sid_results(self, start=0):
+        """
+        Generator over the SpectrumIdentificationResults of the mzid file.
+
+        :param start: number of SpectrumIdentificationResults to skip, they are not read if the
+            SpectrumIdentificationResults are indexed
+        """
+        if start > 0:
+            if self.get_sid_result_offsets():
+                for shard in self.get_sid_result_shards(start):
+                    for sid_result in self.read_sid_result_shard(shard):
+                        yield sid_result
+            else:
+                for sid_result in islice(self.iter_sid_results(), start, None):
+                    yield sid_result
+            return
+
+        if not self.light_sid_results:
+            for sid_result in self.mzid_reader:
+                yield sid_result
+            return
+
+        stream = MzIdStreamReader(self.mzid_path, self.mzid_reader)
+        try:
+            for sid_result in stream.section('SpectrumIdentificationResult',
+                                             self.convert_sid_result):
+                yield sid_result
+        except MzIdStreamParseError as e:
+            raise MzIdParseException(type(e).__name__, e.args)
+        finally:
+            stream.close()
+
+    def main_loop(self, sid_results=None, resume_state=None):
+        """
+        :param sid_results: iterable of SpectrumIdentificationResult elements, read from the
+            mzid file if None (in parallel if self.processes > 1)
+        :param resume_state: checkpoint state to continue from (see get_checkpoint_state),
+            the SpectrumIdentificationResults written before it are skipped
+        """
         spec_id = 0
         identification_id = 0
+        fragment_parsing_error_scans = []
+        if resume_state is not None:
+            spec_id = resume_state['spec_id']
+            identification_id = resume_state['identification_id']
+            fragment_parsing_error_scans = resume_state['fragment_parsing_error_scans']
+
+        if sid_results is not None:
+            processed_sid_results = self.process_sid_results_batched(
+                islice(sid_results, spec_id, None))
+        elif self.processes > 1:
+            processed_sid_results = self.process_sid_results_parallel(spec_id)
+        else:
+            processed_sid_results = self.process_sid_results_batched(
+                self.iter_sid_results(spec_id))
+
         spectra = []
         spectrum_identifications = []
 
-        fragment_parsing_error_scans = []
+        if resume_state is None:
+            # everything before the main loop has been written
+            self.save_checkpoint(spec_id, identification_id, fragment_parsing_error_scans)
 
         #
         # main loop
         main_loop_start_time = time()
         self.logger.info('main loop - start')
 
-        for sid_result in self.mzid_reader:
-            if self.peak_list_dir:
-                peak_list_reader = self.peak_list_readers[sid_result['spectraData_ref']]
+        for spectrum, identifications, fragment_errors in processed_sid_results:
+            if spectrum is not None:
+                spectrum[0] = spec_id
+                spectra.append(spectrum)
 
-                scan_id = peak_list_reader.parse_scan_id(sid_result["spectrumID"])
-                scan = peak_list_reader.get_scan(scan_id)
+            for ident_data in identifications:
+                ident_data[0] += identification_id
+                ident_data[2] = spec_id
+            identification_id += len(identifications)
 
-                protocol = self.spectra_data_protocol_map[sid_result['spectraData_ref']]
-
-                if scan['precursor'] is not None:
-                    precursor_mz = scan['precursor']['mz']
-                    precursor_charge = scan['precursor']['charge']
-                else:
-                    # give warning precursor info is missing
-                    precursor_mz = None
-                    precursor_charge = None
-
-                spectra.append([
-                        spec_id,
-                        scan['peaks'],
-                        ntpath.basename(peak_list_reader.peak_list_path),
-                        str(scan_id),
-                        protocol['fragmentTolerance'],
-                        self.upload_id,
-                        sid_result['id'],
-                        precursor_mz,
-                        precursor_charge
-                    ])
-
-            spectrum_ident_dict = dict()
-            linear_index = -1  # negative index values for linear peptides
-
-            for spec_id_item in sid_result['SpectrumIdentificationItem']:
-                # get suitable id
-                if 'cross-link spectrum identification item' in spec_id_item.keys():
-                    self.contains_crosslinks = True
-                    cross_link_id = spec_id_item['cross-link spectrum identification item']
-                else:  # assuming linear
-                    # misusing 'cross-link spectrum identification item'
-                    # for linear peptides with negative index
-                    # specIdItem['cross-link spectrum identification item'] = linear_index
-                    # spec_id_set.add(get_cross_link_identifier(specIdItem))
-
-                    cross_link_id = linear_index
-                    linear_index -= 1
-
-                # check if seen it before
-                if cross_link_id in spectrum_ident_dict.keys():
-                    # do crosslink specific stuff
-                    ident_data = spectrum_ident_dict.get(cross_link_id)
-                    # ident_data[4] = self.peptide_id_lookup[spec_id_item['peptide_ref']]
-                    ident_data[4] = spec_id_item['peptide_ref']  # debug
-                else:
-                    # do stuff common to linears and crosslinks
-                    charge_state = spec_id_item['chargeState']
-                    pass_threshold = spec_id_item['passThreshold']
-                    # ToDo: refactor with MS: cv Param list of all scores
-                    scores = {
-                        k: v for k, v in spec_id_item.iteritems()
-                        if 'score' in k.lower() or
-                           'pvalue' in k.lower() or
-                           'evalue' in k.lower() or
-                           'sequest' in k.lower() or
-                           'scaffold' in k.lower()
-                    }
-                    #
-                    # fragmentation ions
-                    # ToDo: do we want to make assumptions of fragIon types by fragMethod from mzML?
-                    ions = self.get_ion_types_mzid(spec_id_item)
-                    # if no ion types are specified in the id file check the mzML file
-                    # if len(ions) == 0 and peak_list_reader['fileType'] == 'mzml':
-                    #     ions = peakListParser.get_ion_types_mzml(scan)
-
-                    ions = list(set(ions))
-
-                    if len(ions) == 0:
-                        ions = ['peptide', 'b', 'y']
-                        # ToDo: better error handling for general errors -
-                        #  bundling together of same type errors
-                        fragment_parsing_error_scans.append(sid_result['id'])
-
-                    ions = ';'.join(ions)
-
-                    # extract other useful info to display
-                    rank = spec_id_item['rank']
-
-                    # from mzidentML schema 1.2.0: For PMF data, the rank attribute may be
-                    # meaningless and values of rank = 0 should be given.
-                    # xiSPEC front-end expects rank = 1 as default
-                    if rank is None or int(rank) == 0:
-                        rank = 1
-
-                    experimental_mass_to_charge = spec_id_item['experimentalMassToCharge']
-                    try:
-                        calculated_mass_to_charge = spec_id_item['calculatedMassToCharge']
-                    except KeyError:
-                        calculated_mass_to_charge = None
-
-                    ident_data = [
-                        identification_id,
-                        # spec_id_item['id'],
-                        self.upload_id,
-                        spec_id,
-                        # self.peptide_id_lookup[spec_id_item['peptide_ref']], # debug use spec_id_item['peptide_ref'],
-                        spec_id_item['peptide_ref'],
-                        '',  # pep2
-                        charge_state,
-                        rank,
-                        pass_threshold,
-                        ions,
-                        json.dumps(scores),
-                        experimental_mass_to_charge,
-                        calculated_mass_to_charge,
-                        "",
-                        "",
-                        ""
-                    ]
-
-                    spectrum_ident_dict[cross_link_id] = ident_data
-
-                    identification_id += 1
-
-            spectrum_identifications += spectrum_ident_dict.values()
+            spectrum_identifications += identifications
+            fragment_parsing_error_scans += fragment_errors
 
             spec_id += 1
 
             if spec_id % 1000 == 0:
                 self.logger.info('writing 1000 entries (1000 spectra and their idents) to DB')
-                try:
-                    self.db.write_spectra(spectra, self.cur, self.con)
-                    spectra = []
-                    self.db.write_spectrum_identifications(spectrum_identifications, self.cur,
-                                                           self.con)
-                    spectrum_identifications = []
-                    self.con.commit()
-                except Exception as e:
-                    raise e
+                self.write_rows(self.get_write_spectra_function(), spectra)
+                spectra = []
+                self.write_rows('write_spectrum_identifications', spectrum_identifications)
+                spectrum_identifications = []
+                self.save_checkpoint(spec_id, identification_id, fragment_parsing_error_scans)
 
         # end main loop
         self.logger.info('main loop - done Time: {} sec'.format(
             round(time() - main_loop_start_time, 2)))
+        for peak_list_reader in self.peak_list_readers.values():
+            self.logger.info('scan cache {}: {}'.format(peak_list_reader.peak_list_file_name,
+                                                        peak_list_reader.scan_cache.stats()))
 
         # once loop is done write remaining data to DB
         db_wrap_up_start_time = time()
         self.logger.info('write remaining entries to DB - start')
-        try:
-            self.db.write_spectra(spectra, self.cur, self.con)
-            self.db.write_spectrum_identifications(spectrum_identifications, self.cur, self.con)
-            self.con.commit()
-        except Exception as e:
-            raise e
+        self.write_rows(self.get_write_spectra_function(), spectra)
+        self.write_rows('write_spectrum_identifications', spectrum_identifications)
+        self.flush_db_writes()
 
         self.logger.info('write remaining entries to DB - start - done.  Time: {} sec'.format(
             round(time() - db_wrap_up_start_time, 2)))
@@ -834,86 +1447,208 @@ class MzIdParser:
                 'id': id_string
             })
 
-    def upload_info(self):
-        self.upload_info_read = True
-        upload_info_start_time = time()
-        self.logger.info('parse upload info - start')
+    def get_sid_result_offsets(self):
+        """
+        :return: sorted byte offsets of the SpectrumIdentificationResults, empty if they aren't
+            indexed (single pass engine, single process, pyteomics doesn't index SIRs with
+            namespace prefixes)
+        """
+        if self.sid_result_offsets is None:
+            try:
+                self.sid_result_offsets = sorted(
+                    self.mzid_reader._offset_index['SpectrumIdentificationResult'].values())
+            except (AttributeError, KeyError):
+                return []
+        return self.sid_result_offsets
 
-        peak_list_file_names = json.dumps(self.get_all_peak_list_file_names(), cls=NumpyEncoder)
+    def get_last_sid_result_offset(self, count):
+        """
+        :param count: number of SpectrumIdentificationResults
+        :return: byte offset of the last of the first count SpectrumIdentificationResults,
+            None if count is 0 or they aren't indexed
+        """
+        sid_result_offsets = self.get_sid_result_offsets()
+        if 0 < count <= len(sid_result_offsets):
+            return sid_result_offsets[count - 1]
+        return None
 
-        spectra_formats = []
-        for spectra_data_id in self.mzid_reader._offset_index["SpectraData"].keys():
-            sp_datum = self.mzid_reader.get_by_id(spectra_data_id, tag_id='SpectraData',
-                                                  detailed=True)
-            spectra_formats.append(sp_datum)
-        spectra_formats = json.dumps(spectra_formats, cls=NumpyEncoder)
+    def get_sid_result_shards(self, start=0):
+        """
+        Split the SpectrumIdentificationResults into shards of consecutive elements.
 
-        # AnalysisSoftwareList - optional element
-        # see https://groups.google.com/forum/#!topic/pyteomics/Mw4eUHmicyU
-        self.mzid_reader.schema_info['lists'].add("AnalysisSoftware")
-        try:
-            analysis_software = json.dumps(self.mzid_reader.iterfind('AnalysisSoftwareList').next()['AnalysisSoftware'])
-        except StopIteration:
-            analysis_software = '{}'
-        except Exception as e:
-            raise MzIdParseException(type(e).__name__, e.args)
-        self.mzid_reader.reset()
+        :param start: number of SpectrumIdentificationResults to leave out
+        :return: list of shards: (list of SIR byte offsets, byte offset of the end of the shard)
+        """
+        sir_offsets = self.get_sid_result_offsets()[start:]
+        file_size = os.path.getsize(self.mzid_path)
+
+        shards = []
+        for i in range(0, len(sir_offsets), self.shard_size):
+            shard_offsets = sir_offsets[i:i + self.shard_size]
+            if i + self.shard_size < len(sir_offsets):
+                end_offset = sir_offsets[i + self.shard_size]
+            else:
+                end_offset = file_size
+            shards.append((shard_offsets, end_offset))
 
-        # Provider - optional element
-        try:
-            provider = json.dumps(self.mzid_reader.iterfind('Provider').next())
-        except StopIteration:
-            provider = '{}'
-        except Exception as e:
-            raise MzIdParseException(type(e).__name__, e.args)
-        self.mzid_reader.reset()
+        return shards
+
+    def process_sid_result_shard(self, shard):
+        """
+        Process a shard of SpectrumIdentificationResults (see get_sid_result_shards).
+
+        :return: tuple (list of process_sid_result results, contains_crosslinks)
+        """
+        processed_sid_results = list(self.process_sid_results_batched(
+            self.read_sid_result_shard(shard)))
+
+        return processed_sid_results, self.contains_crosslinks
+
+    def read_sid_result_shard(self, shard):
+        """
+        Read a shard of SpectrumIdentificationResults (see get_sid_result_shards).
+        Reads the shard's byte range and parses its SIRs wrapped in a copy of the root element.
+
+        :return: list of converted SpectrumIdentificationResults (see convert_sid_result)
+        """
+        shard_offsets, end_offset = shard
+
+        with open(self.mzid_path, 'rb') as f:
+            f.seek(shard_offsets[0])
+            data = f.read(end_offset - shard_offsets[0])
 
-        # AuditCollection - optional element
-        audits = '{}'
+        # the byte range between two SIRs can contain the end/start of SpectrumIdentificationLists
+        sid_result_strings = []
+        for offset in shard_offsets:
+            start = offset - shard_offsets[0]
+            match = self.sid_result_end_pattern.search(data, start)
+            if match is None:
+                raise MzIdParseException('Unterminated SpectrumIdentificationResult at byte %s' % offset)
+            sid_result_strings.append(data[start:match.end()])
+
+        root_start, root_end = self.get_root_element_tags()
+        fragment = root_start + ''.join(sid_result_strings) + root_end
+
+        sid_results = []
+        for event, elem in etree.iterparse(BytesIO(fragment), tag='{*}SpectrumIdentificationResult',
+                                           remove_comments=True, huge_tree=True):
+            sid_results.append(self.convert_sid_result(elem))
+            elem.clear()
+
+        return sid_results
+
+    def get_root_element_tags(self):
+        """
+        :return: tuple of start and end tag of the root element (including namespace declarations)
+        """
         try:
-            audits = json.dumps(self.mzid_reader.iterfind('AuditCollection').next())
-        except StopIteration:
-            audits = '{}'
-        except Exception as e:
+            return MzIdStreamReader.read_root_element_tags(self.mzid_path)
+        except MzIdStreamParseError as e:
             raise MzIdParseException(type(e).__name__, e.args)
-        self.mzid_reader.reset()
 
-        # AnalysisSampleCollection - optional element
+    def process_sid_results_parallel(self, start=0):
+        """
+        Generator over the processed SpectrumIdentificationResults in document order,
+        processing shards of them in a multiprocessing pool.
+        Worker processes are forked and use copies of this parser and its peak list readers.
+
+        :param start: number of SpectrumIdentificationResults to skip
+        """
+        shards = self.get_sid_result_shards(start)
+        # pyteomics doesn't index SIRs with namespace prefixes
+        if len(shards) == 0:
+            for processed_sid_result in self.process_sid_results_batched(
+                    self.iter_sid_results(start)):
+                yield processed_sid_result
+            return
+
+        self.logger.info('processing {} shards with {} processes'.format(len(shards), self.processes))
+
+        global _shard_parser
+        _shard_parser = self
+        pool = multiprocessing.Pool(self.processes, initializer=_init_shard_worker)
         try:
-            samples = json.dumps(self.mzid_reader.iterfind('AnalysisSampleCollection').next()['Sample'])
-        except StopIteration:
-            samples = '{}'
-        except Exception as e:
-            raise MzIdParseException(type(e).__name__, e.args)
-        self.mzid_reader.reset()
+            for processed_sid_results, contains_crosslinks in pool.imap(_process_shard, shards):
+                if contains_crosslinks:
+                    self.contains_crosslinks = True
+                for processed_sid_result in processed_sid_results:
+                    yield processed_sid_result
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+            _shard_parser = None
+
+    def read_upload_info_sections(self):
+        """
+        :return: dict of the elements used by upload_info, indexed by tag
+        """
+        # AnalysisSoftwareList - optional element
+        # see https://groups.google.com/forum/#!topic/pyteomics/Mw4eUHmicyU
+        self.mzid_reader.schema_info['lists'].add("AnalysisSoftware")
+
+        sections = {'SpectraData': self.get_spectra_data()}
 
-        # AnalysisCollection - required element, StopIteration exception shouldn't happen
+        # one forward scan that stops at the DataCollection
+        # Provider, AuditCollection, AnalysisSampleCollection - optional elements
+        # AnalysisCollection, AnalysisProtocolCollection - required elements
+        stream = MzIdStreamReader(self.mzid_path, self.mzid_reader)
         try:
-            analyses = json.dumps(self.mzid_reader.iterfind('AnalysisCollection').next()['SpectrumIdentification'])
-        except StopIteration:
-            analyses = '{}' # could legitimately throw error here instead, its required
+            for tag in ['AnalysisSoftwareList', 'Provider', 'AuditCollection',
+                        'AnalysisSampleCollection', 'AnalysisCollection',
+                        'AnalysisProtocolCollection']:
+                sections[tag] = list(stream.section(tag))[:1]
+
+            # BibliographicReference - optional element, read from the end of the file
+            sections['BibliographicReference'] = stream.trailing_section('BibliographicReference')
         except Exception as e:
             raise MzIdParseException(type(e).__name__, e.args)
-        self.mzid_reader.reset()
+        finally:
+            stream.close()
 
-        # AnalysisProtocolCollection - required element
+        return sections
+
+    @staticmethod
+    def upload_info_json(sections, tag, key=None, cls=None):
+        # missing elements are written as empty object
+        # (could legitimately throw error for the required ones instead)
+        if len(sections[tag]) == 0:
+            return '{}'
         try:
-            protocol_collection = self.mzid_reader.iterfind('AnalysisProtocolCollection').next()
-            protocols = json.dumps(protocol_collection['SpectrumIdentificationProtocol'],
-                                   cls=NumpyEncoder)
-        except StopIteration:
-            protocols = '{}' # could legitimately throw error here instead, its required
+            info = sections[tag][0]
+            if key is not None:
+                info = info[key]
+            return json.dumps(info, cls=cls)
         except Exception as e:
             raise MzIdParseException(type(e).__name__, e.args)
-        self.mzid_reader.reset()
 
-        # BibliographicReference - optional element
-        bibRefs = []
-        for bib in self.mzid_reader.iterfind('BibliographicReference'):
-            bibRefs.append(bib)
-        bibRefs = json.dumps(bibRefs)
-        self.mzid_reader.reset()
+    def upload_info(self, sections=None):
+        """
+        :param sections: dict of the elements to write, indexed by tag
+            (see read_upload_info_sections), read from the mzid_reader if None
+        """
+        self.upload_info_read = True
+        upload_info_start_time = time()
+        self.logger.info('parse upload info - start')
 
+        if sections is None:
+            sections = self.read_upload_info_sections()
+
+        peak_list_file_names = json.dumps(
+            [ntpath.basename(sp_datum['location']) for sp_datum in sections['SpectraData']],
+            cls=NumpyEncoder)
+        spectra_formats = json.dumps(sections['SpectraData'], cls=NumpyEncoder)
+
+        analysis_software = self.upload_info_json(sections, 'AnalysisSoftwareList', 'AnalysisSoftware')
+        provider = self.upload_info_json(sections, 'Provider')
+        audits = self.upload_info_json(sections, 'AuditCollection')
+        samples = self.upload_info_json(sections, 'AnalysisSampleCollection', 'Sample')
+        analyses = self.upload_info_json(sections, 'AnalysisCollection', 'SpectrumIdentification')
+        protocols = self.upload_info_json(sections, 'AnalysisProtocolCollection',
+                                          'SpectrumIdentificationProtocol', cls=NumpyEncoder)
+        bibRefs = json.dumps(sections['BibliographicReference'])
+
+        self.flush_db_writes()
         self.db.write_mzid_info(peak_list_file_names,
                                 spectra_formats,
                                 analysis_software,
@@ -932,17 +1667,20 @@ class MzIdParser:
         pass
 
     def other_info(self):
-        ident_file_size = os.path.getsize(self.mzid_path)
+        if self.mzid_size is not None:
+            ident_file_size = self.mzid_size
+        else:
+            ident_file_size = os.path.getsize(self.mzid_path)
         self.db.write_other_info(self.upload_id, self.contains_crosslinks, self.ident_count,
                                  ident_file_size, self.warnings, self.cur, self.con)
 
 
 class xiSPEC_MzIdParser(MzIdParser):
 
-    def upload_info(self):
+    def upload_info(self, sections=None):
         pass
 
-    def parse_db_sequences(self):
+    def parse_db_sequences(self, db_sequences=None):
         pass
 
     def fill_in_missing_scores(self):
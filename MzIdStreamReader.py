@@ -0,0 +1,196 @@
+from lxml import etree
+import re
+import ArchiveExtractor
+from DBSequenceCache import DBSequenceCache
+
+
+class MzIdStreamParseError(Exception):
+    pass
+
+
+class MzIdStreamReader(object):
+    """
+    Forward-only reader for mzIdentML files.
+
+    Walks the document once with lxml iterparse and hands out the elements of each section
+    as they are passed. Elements are converted to dicts by a pyteomics MzIdentML reader, which
+    doesn't need an offset index for this (use_index=False).
+    Sections have to be requested in document order, sections that are not requested are skipped.
+    """
+
+    # (tag, kwargs for pyteomics _get_info_smart) in mzIdentML document order
+    # schema: https://raw.githubusercontent.com/HUPO-PSI/mzIdentML/master/schema/mzIdentML1.2.0.xsd
+    sections = [
+        ('AnalysisSoftwareList', {}),
+        ('Provider', {}),
+        ('AuditCollection', {}),
+        ('AnalysisSampleCollection', {}),
+        ('DBSequence', {'detailed': True}),
+        ('Peptide', {'detailed': True}),
+        ('PeptideEvidence', {'detailed': True}),
+        ('AnalysisCollection', {}),
+        ('SpectrumIdentificationProtocol', {'detailed': True}),   # nested in AnalysisProtocolCollection
+        ('AnalysisProtocolCollection', {}),
+        ('SpectraData', {'detailed': True}),
+        ('SpectrumIdentificationResult', {}),
+        ('BibliographicReference', {}),
+    ]
+
+    # elements we never use but which can make up a large part of the file,
+    # they are only tracked so they can be freed as they are passed
+    discarded_tags = ['ProteinAmbiguityGroup']
+
+    root_start_pattern = re.compile(r'<(\w+:)?MzIdentML\b[^>]*>')
+    data_collection_end_pattern = re.compile(r'</(\w+:)?DataCollection\s*>')
+    tail_block_size = 64 * 1024
+
+    def __init__(self, mzid_path, mzid_reader, db_sequence_cache=None):
+        """
+
+        :param mzid_path: path to mzidentML file
+        :param mzid_reader: pyteomics MzIdentML reader used for converting elements
+        :param db_sequence_cache: DBSequenceCache to fill, a new one if None
+        """
+        self.mzid_path = mzid_path
+        self.mzid_reader = mzid_reader
+
+        # recorded for every DBSequence passed (requested or not)
+        if db_sequence_cache is None:
+            db_sequence_cache = DBSequenceCache(mzid_reader)
+        self.db_sequence_cache = db_sequence_cache
+
+        self._section_order = dict((tag, i) for i, (tag, kwargs) in enumerate(self.sections))
+        self._section_kwargs = dict(self.sections)
+        self._requested_position = 0    # order of the last requested section
+        self._document_position = 0     # order of the last section element read from the file
+        self._lookahead = None
+        self._elements = self._iter_elements()
+        # size of the (decompressed) document, set once it has been read to the end
+        self.document_size = None
+
+    def _iter_elements(self):
+        tags = ['{*}' + tag for tag, kwargs in self.sections] + ['{*}' + tag for tag in self.discarded_tags]
+        depth = 0
+        # gzipped files are decompressed on the fly
+        with ArchiveExtractor.open_stream(self.mzid_path) as f:
+            for event, elem in etree.iterparse(f, events=('start', 'end'), tag=tags,
+                                               remove_comments=True, huge_tree=True):
+                if event == 'start':
+                    depth += 1
+                    continue
+                depth -= 1
+
+                yield etree.QName(elem).localname, elem
+
+                # only free top level elements, nested ones are still needed by their parent
+                if depth == 0:
+                    elem.clear()
+                    while elem.getprevious() is not None:
+                        del elem.getparent()[0]
+
+            self.document_size = f.tell()
+
+    def _next_element(self):
+        if self._lookahead is not None:
+            element = self._lookahead
+            self._lookahead = None
+            return element
+
+        for name, elem in self._elements:
+            if name in self.discarded_tags:
+                continue
+
+            order = self._section_order[name]
+            if order < self._document_position:
+                raise MzIdStreamParseError(
+                    'unexpected element order: %s found after %s' % (
+                        name, self.sections[self._document_position][0]))
+            self._document_position = order
+
+            if name == 'DBSequence':
+                self.db_sequence_cache.add_element(elem)
+            elif order > self._section_order['DBSequence']:
+                self.db_sequence_cache.complete = True
+
+            return name, elem
+
+        return None, None
+
+    def section(self, tag, convert=None):
+        """
+        Generator over the elements of one section, converted to dicts.
+
+        :param tag: local name of the section elements
+        :param convert: function converting an lxml element, pyteomics _get_info_smart if None
+        """
+        order = self._section_order[tag]
+        if order < self._requested_position:
+            raise MzIdStreamParseError('%s requested after a later section was read' % tag)
+        self._requested_position = order
+        kwargs = self._section_kwargs[tag]
+
+        while True:
+            name, elem = self._next_element()
+            if name is None:
+                return
+            name_order = self._section_order[name]
+            # skip elements of sections that weren't requested
+            if name_order < order:
+                continue
+            if name_order > order:
+                self._lookahead = (name, elem)
+                return
+            if convert is not None:
+                yield convert(elem)
+            else:
+                yield self.mzid_reader._get_info_smart(elem, **kwargs)
+
+    def close(self):
+        """
+        Stop reading the file (sections can't be requested afterwards).
+        """
+        self._elements.close()
+
+    def trailing_section(self, tag):
+        """
+        Read the elements of a section that comes after the DataCollection (BibliographicReference)
+        from the end of the file, without scanning the rest of the document.
+
+        :param tag: local name of the section elements
+        :return: list of elements converted to dicts
+        """
+        with open(self.mzid_path, 'rb') as f:
+            f.seek(0, 2)
+            position = f.tell()
+            tail = ''
+            match = None
+            while match is None:
+                if position == 0:
+                    raise MzIdStreamParseError('Missing DataCollection end tag')
+                read_size = min(self.tail_block_size, position)
+                position -= read_size
+                f.seek(position)
+                tail = f.read(read_size) + tail
+                for match in self.data_collection_end_pattern.finditer(tail):
+                    pass
+
+        root_start, root_end = self.read_root_element_tags(self.mzid_path)
+        parser = etree.XMLParser(remove_comments=True, huge_tree=True)
+        # the tail already contains the root end tag
+        root = etree.fromstring(root_start + tail[match.end():], parser)
+
+        kwargs = self._section_kwargs[tag]
+        return [self.mzid_reader._get_info_smart(elem, **kwargs) for elem in root.iter('{*}' + tag)]
+
+    @classmethod
+    def read_root_element_tags(cls, mzid_path):
+        """
+        :param mzid_path: path to mzidentML file
+        :return: tuple of start and end tag of the root element (including namespace declarations)
+        """
+        with ArchiveExtractor.open_stream(mzid_path) as f:
+            head = f.read(1024 * 1024)
+        match = cls.root_start_pattern.search(head)
+        if match is None:
+            raise MzIdStreamParseError('Missing MzIdentML root element')
+        return match.group(0), '</%sMzIdentML>' % (match.group(1) or '')
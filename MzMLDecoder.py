@@ -0,0 +1,258 @@
+import re
+import zlib
+import struct
+import binascii
+import numpy as np
+from xml.etree import cElementTree
+
+
+class MzMLDecodeError(Exception):
+    pass
+
+
+# binary data array cv params
+array_types = {
+    'MS:1000514': 'mz',         # m/z array
+    'MS:1000515': 'intensity',  # intensity array
+}
+data_types = {
+    'MS:1000521': np.dtype('<f4'),  # 32-bit float
+    'MS:1000523': np.dtype('<f8'),  # 64-bit float
+    'MS:1000519': np.dtype('<i4'),  # 32-bit integer
+    'MS:1000522': np.dtype('<i8'),  # 64-bit integer
+}
+# compression accession -> (zlib, numpress)
+compressions = {
+    'MS:1000576': (False, None),        # no compression
+    'MS:1000574': (True, None),         # zlib compression
+    'MS:1002312': (False, 'linear'),    # MS-Numpress linear prediction compression
+    'MS:1002313': (False, 'pic'),       # MS-Numpress positive integer compression
+    'MS:1002314': (False, 'slof'),      # MS-Numpress short logged float compression
+    'MS:1002746': (True, 'linear'),     # MS-Numpress linear prediction followed by zlib
+    'MS:1002747': (True, 'pic'),        # MS-Numpress positive integer followed by zlib
+    'MS:1002748': (True, 'slof'),       # MS-Numpress short logged float followed by zlib
+}
+
+spectrum_end_tag_pattern = re.compile(br'</(?:\w+:)?spectrum>')
+
+
+def local_name(tag):
+    return tag.rpartition('}')[2]
+
+
+def decode_fixed_point(data):
+    """
+    :return: the fixed point of MS-Numpress linear and slof encoded data (first 8 bytes, double
+        in big-endian byte order)
+    """
+    if len(data) < 8:
+        raise MzMLDecodeError('corrupt numpress data: missing fixed point')
+    return struct.unpack('>d', data[:8])[0]
+
+
+def decode_numpress_ints(data):
+    """
+    Decode the variable length integers of MS-Numpress linear and pic encoded data. Each integer
+    is a stream of half bytes (high half byte first): a head n <= 8 for n leading zero half bytes
+    or 8 + n for n leading 0xf half bytes, followed by the remaining 8 - n half bytes, least
+    significant first.
+
+    :param data: encoded integers (str)
+    :return: numpy uint32 array
+    """
+    data = np.frombuffer(data, dtype=np.uint8)
+    half_bytes = np.empty(2 * len(data), dtype=np.uint32)
+    half_bytes[0::2] = data >> 4
+    half_bytes[1::2] = data & 0xf
+    if len(half_bytes) == 0:
+        return np.empty(0, dtype=np.uint32)
+
+    leading = np.where(half_bytes <= 8, half_bytes, half_bytes - 8)
+    next_head = (np.arange(len(half_bytes)) + 9 - leading).tolist()
+
+    # the heads have to be found one after another
+    heads = []
+    head = 0
+    last = len(half_bytes) - 1
+    while head <= last:
+        if head == last and half_bytes[head] == 0:
+            break   # padding of the last byte
+        heads.append(head)
+        head = next_head[head]
+    if head > last + 1:
+        raise MzMLDecodeError('corrupt numpress data: truncated integer')
+    heads = np.array(heads, dtype=np.int64)
+
+    shift = np.arange(8)
+    half_byte_shift = (4 * shift).astype(np.uint32)
+    head_leading = leading[heads][:, np.newaxis]
+    is_value = shift < 8 - head_leading
+
+    # remaining half bytes, least significant first
+    padded = np.concatenate([half_bytes, np.zeros(8, dtype=np.uint32)])
+    value_half_bytes = np.where(is_value, padded[heads[:, np.newaxis] + 1 + shift], 0)
+    # leading 0xf half bytes
+    is_one = ~is_value & (half_bytes[heads] > 8)[:, np.newaxis]
+    value_half_bytes = np.where(is_one, 0xf, value_half_bytes).astype(np.uint32)
+
+    return np.bitwise_or.reduce(value_half_bytes << half_byte_shift, axis=1).astype(np.uint32)
+
+
+def decode_numpress_linear(data):
+    """
+    MS-Numpress linear prediction: fixed point, the first two values as 4 byte little-endian
+    integers, then the differences to the linear prediction of the following values.
+
+    :return: numpy float64 array
+    """
+    fixed_point = decode_fixed_point(data)
+    if len(data) == 8:
+        return np.empty(0, dtype=np.float64)
+    if len(data) < 12 or 12 < len(data) < 16:
+        raise MzMLDecodeError('corrupt numpress data: truncated start values')
+
+    first_values = np.frombuffer(data[8:16], dtype='<u4').astype(np.int64)
+    differences = decode_numpress_ints(data[16:]).view(np.int32).astype(np.int64)
+    # value[i] = 2 * value[i - 1] - value[i - 2] + difference[i]: the first differences of the
+    # values are the cumulative sum of the prediction differences
+    steps = first_values[1:] - first_values[:1] if len(first_values) == 2 else first_values[:0]
+    if len(differences) > 0:
+        steps = np.concatenate([steps, steps[-1] + np.cumsum(differences)])
+    values = np.concatenate([first_values[:1], first_values[0] + np.cumsum(steps)])
+    return values / fixed_point
+
+
+def decode_numpress_pic(data):
+    """
+    MS-Numpress positive integer compression: the rounded values as variable length integers.
+
+    :return: numpy float64 array
+    """
+    return decode_numpress_ints(data).astype(np.float64)
+
+
+def decode_numpress_slof(data):
+    """
+    MS-Numpress short logged float: fixed point, then log(value + 1) * fixed point as 2 byte
+    little-endian unsigned integers.
+
+    :return: numpy float64 array
+    """
+    fixed_point = decode_fixed_point(data)
+    if len(data) % 2 != 0:
+        raise MzMLDecodeError('corrupt numpress data: odd length')
+    return np.exp(np.frombuffer(data[8:], dtype='<u2') / fixed_point) - 1
+
+
+numpress_decoders = {
+    'linear': decode_numpress_linear,
+    'pic': decode_numpress_pic,
+    'slof': decode_numpress_slof,
+}
+
+
+def decode_binary_array(text, data_type, compression):
+    """
+    :param text: base64 encoded content of a binary element
+    :param data_type: numpy dtype of the values (ignored for MS-Numpress)
+    :param compression: (zlib, numpress) tuple (see compressions)
+    :return: numpy array of the values
+    """
+    use_zlib, numpress = compression
+    if not text:
+        return np.empty(0, dtype=np.float64)
+    try:
+        data = binascii.a2b_base64(text)
+        if use_zlib:
+            data = zlib.decompress(data)
+    except (binascii.Error, zlib.error) as e:
+        raise MzMLDecodeError('corrupt binary data array: %s' % e)
+
+    if numpress is not None:
+        return numpress_decoders[numpress](data)
+    if len(data) % data_type.itemsize != 0:
+        raise MzMLDecodeError('corrupt binary data array: %s bytes' % len(data))
+    return np.frombuffer(data, dtype=data_type)
+
+
+def parse_precursor(precursor_element):
+    """
+    :return: precursor dict with mz and charge, read like pymzml (isolation window target
+        m/z, overridden by the selected ion m/z)
+    """
+    precursor = {'mz': None, 'charge': None}
+    for element in precursor_element.iter():
+        tag = local_name(element.tag)
+        if tag == 'userParam':
+            precursor.setdefault('userParams', {})[element.get('name')] = element.get('value')
+        elif tag in ['isolationWindow', 'selectedIon']:
+            for cv_param in element.iter():
+                if local_name(cv_param.tag) != 'cvParam':
+                    continue
+                accession = cv_param.get('accession')
+                value = cv_param.get('value')
+                if accession == 'MS:1000827' and tag == 'isolationWindow' or \
+                        accession in ['MS:1000040', 'MS:1000744'] and tag == 'selectedIon':
+                    try:
+                        precursor['mz'] = float(value)
+                    except (TypeError, ValueError):
+                        precursor['mz'] = value
+                elif accession == 'MS:1000041' and tag == 'selectedIon':
+                    try:
+                        precursor['charge'] = int(value)
+                    except (TypeError, ValueError):
+                        precursor['charge'] = value
+    return precursor
+
+
+def decode_spectrum(data, decode_arrays=True):
+    """
+    Decode a spectrum element of an mzML file.
+
+    :param data: the spectrum element (str), may be followed by other content (e.g. the
+        closing tags of the last spectrum)
+    :param decode_arrays: decode the m/z and intensity arrays, they are empty if False
+    :return: dict with id, mz (numpy array), intensity (numpy array) and precursors (list of
+        precursor dicts, None without precursorList)
+    """
+    end_match = spectrum_end_tag_pattern.search(data)
+    if end_match is not None:
+        data = data[:end_match.end()]
+    try:
+        spectrum_element = cElementTree.fromstring(data)
+    except SyntaxError as e:
+        raise MzMLDecodeError('invalid spectrum: %s' % e)
+
+    spectrum = {
+        'id': spectrum_element.get('id'),
+        'mz': None,
+        'intensity': None,
+        'precursors': None
+    }
+    for element in spectrum_element.iter():
+        tag = local_name(element.tag)
+        if tag == 'precursorList':
+            spectrum['precursors'] = [parse_precursor(precursor) for precursor in element
+                                      if local_name(precursor.tag) == 'precursor']
+        elif tag == 'binaryDataArray' and decode_arrays:
+            array_type, data_type, compression, text = None, None, None, None
+            for child in element:
+                child_tag = local_name(child.tag)
+                if child_tag == 'cvParam':
+                    accession = child.get('accession')
+                    array_type = array_types.get(accession, array_type)
+                    data_type = data_types.get(accession, data_type)
+                    compression = compressions.get(accession, compression)
+                elif child_tag == 'binary':
+                    text = child.text
+            if array_type is None:
+                continue    # other arrays (e.g. charge array)
+            if data_type is None or compression is None:
+                raise MzMLDecodeError('unknown encoding of %s array in spectrum %s' % (
+                    array_type, spectrum['id']))
+            spectrum[array_type] = decode_binary_array(text, data_type, compression)
+
+    for array_type in ['mz', 'intensity']:
+        if spectrum[array_type] is None:
+            spectrum[array_type] = np.empty(0, dtype=np.float64)
+    return spectrum
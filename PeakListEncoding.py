@@ -0,0 +1,108 @@
+import re
+import zlib
+import numpy as np
+
+
+class PeakListEncodingError(Exception):
+    pass
+
+
+# first byte of a binary peak list
+RAW = b'\x00'
+ZLIB = b'\x01'
+
+mz_dtype = np.dtype('<f8')
+intensity_dtype = np.dtype('<f4')
+peak_size = mz_dtype.itemsize + intensity_dtype.itemsize
+
+# peak line of a text peak list (or of an MGF/MS2 scan): m/z and intensity
+peak_line_pattern = re.compile(r'^([0-9.]+)\s+([0-9.]+)', re.M)
+
+
+def encode_peaks(mz, intensity, compress=True):
+    """
+    Binary peak list: one byte for the compression (RAW or ZLIB), followed by the m/z values
+    as little-endian float64 and the intensities as little-endian float32.
+
+    :param mz: sequence of m/z values
+    :param intensity: sequence of intensities, same length as mz
+    :param compress: zlib compress the arrays
+    :return: encoded peak list (str)
+    """
+    mz = np.asarray(mz, dtype=mz_dtype)
+    intensity = np.asarray(intensity, dtype=intensity_dtype)
+    if mz.shape != intensity.shape:
+        raise PeakListEncodingError('%s m/z values for %s intensities' % (len(mz), len(intensity)))
+
+    data = mz.tostring() + intensity.tostring()
+    if compress:
+        return ZLIB + zlib.compress(data)
+    return RAW + data
+
+
+def decode_peaks(encoded):
+    """
+    :param encoded: binary peak list (see encode_peaks), e.g. read from a BLOB/bytea column
+    :return: tuple of numpy arrays (m/z, intensity)
+    """
+    encoded = memoryview(encoded).tobytes()
+    header, data = encoded[:1], encoded[1:]
+    if header == ZLIB:
+        try:
+            data = zlib.decompress(data)
+        except zlib.error as e:
+            raise PeakListEncodingError('corrupt peak list: %s' % e)
+    elif header != RAW:
+        raise PeakListEncodingError('unknown peak list encoding: %r' % header)
+
+    if len(data) % peak_size != 0:
+        raise PeakListEncodingError('truncated peak list of %s bytes' % len(data))
+    peak_count = len(data) // peak_size
+
+    mz = np.frombuffer(data, dtype=mz_dtype, count=peak_count)
+    intensity = np.frombuffer(data, dtype=intensity_dtype, count=peak_count,
+                              offset=peak_count * mz_dtype.itemsize)
+    return mz, intensity
+
+
+def parse_text_peaks(text):
+    """
+    :param text: text peak list (lines of 'm/z intensity') or MGF/MS2 scan, other lines are
+        ignored
+    :return: tuple of numpy arrays (m/z, intensity)
+    """
+    peaks = peak_line_pattern.findall(text)
+    if len(peaks) == 0:
+        return np.empty(0, dtype=mz_dtype), np.empty(0, dtype=intensity_dtype)
+    mz, intensity = zip(*peaks)
+    return np.array(mz, dtype=mz_dtype), np.array(intensity, dtype=intensity_dtype)
+
+
+def _text_values(values):
+    """
+    float32 values are formatted with their 7 significant digits, other values as Python floats
+    (str(), 12 significant digits).
+    """
+    values = np.asarray(values)
+    if values.dtype == np.float32:
+        return np.char.mod('%.7g', values).tolist()
+    return values.tolist()
+
+
+def format_text_peaks(mz, intensity):
+    """
+    Formats all peaks with a single format operation instead of one per peak.
+
+    :return: text peak list (legacy format, lines of 'm/z intensity')
+    """
+    mz = _text_values(mz)
+    intensity = _text_values(intensity)
+    if len(mz) != len(intensity):
+        raise PeakListEncodingError('%s m/z values for %s intensities' % (len(mz), len(intensity)))
+    if len(mz) == 0:
+        return ''
+
+    values = [None] * (2 * len(mz))
+    values[0::2] = mz
+    values[1::2] = intensity
+    return ("%s %s\n" * len(mz))[:-1] % tuple(values)
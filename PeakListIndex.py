@@ -0,0 +1,393 @@
+import re
+import mmap
+from array import array
+from xml.sax.saxutils import unescape
+import ArchiveExtractor
+
+
+def get_offset_typecode():
+    """
+    :return: array typecode for 64 bit offsets, 'q' isn't available in Python 2 but 'l' is
+        64 bit on 64 bit Linux and OS X
+    """
+    for typecode in ['q', 'l']:
+        try:
+            if array(typecode).itemsize == 8:
+                return typecode
+        except ValueError:
+            pass
+    return 'd'      # exact for offsets up to 2**53
+
+
+offset_typecode = get_offset_typecode()
+
+
+class OffsetList(object):
+    """
+    Compact list of scan (start, end) byte offsets, stored in a single array of 64 bit values
+    instead of a list of tuples.
+    """
+
+    def __init__(self, offsets=None):
+        """
+
+        :param offsets: array of start and end offsets, alternating
+        """
+        if offsets is None:
+            offsets = array(offset_typecode)
+        self.offsets = offsets
+
+    def append(self, position):
+        self.offsets.extend(position)
+
+    def __len__(self):
+        return len(self.offsets) // 2
+
+    def __getitem__(self, index):
+        """
+        :return: tuple (start, end) of the scan
+        """
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('scan index out of range: %s' % index)
+        return int(self.offsets[2 * index]), int(self.offsets[2 * index + 1])
+
+    def __iter__(self):
+        return iter(zip(map(int, self.offsets[0::2]), map(int, self.offsets[1::2])))
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+
+def load_offset_list(index_cache, file_path):
+    """
+    :param index_cache: IndexCache
+    :param file_path: path of the peak list file
+    :return: OffsetList stored by save_offset_list or None
+    """
+    offsets = index_cache.load_array(file_path, offset_typecode)
+    if offsets is None or len(offsets) % 2 != 0:
+        return None
+    return OffsetList(offsets)
+
+
+def save_offset_list(index_cache, file_path, offset_list):
+    return index_cache.save_array(file_path, offset_list.offsets)
+
+
+def open_file(path):
+    """
+    :param path: path of the peak list file or ArchiveExtractor.ZipMember
+    :return: file opened in binary mode
+    """
+    if isinstance(path, ArchiveExtractor.ZipMember):
+        return path.open()
+    return open(path, 'rb')
+
+
+class MappedSegment(object):
+    """
+    Read only mmap of a segment of a file (e.g. a stored zip member), with offsets relative to
+    the start of the segment. Supports the part of the mmap interface used for indexing.
+    """
+
+    def __init__(self, f, offset, size):
+        """
+
+        :param f: file opened in binary mode
+        :param offset: offset of the segment in the file
+        :param size: size of the segment
+        """
+        # mmap offsets have to be a multiple of the allocation granularity
+        self.start = offset % mmap.ALLOCATIONGRANULARITY
+        self.size = size
+        self.data = mmap.mmap(f.fileno(), self.start + size, access=mmap.ACCESS_READ,
+                              offset=offset - self.start)
+
+    def get_bounds(self, start, end):
+        start, end, step = slice(start, end).indices(self.size)
+        return self.start + start, self.start + max(start, end)
+
+    def find(self, sub, start=0, end=None):
+        index = self.data.find(sub, *self.get_bounds(start, end))
+        return -1 if index == -1 else index - self.start
+
+    def rfind(self, sub, start=0, end=None):
+        index = self.data.rfind(sub, *self.get_bounds(start, end))
+        return -1 if index == -1 else index - self.start
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            if index < 0:
+                index += self.size
+            if not 0 <= index < self.size:
+                raise IndexError('mmap index out of range')
+            return self.data[self.start + index]
+        start, end = self.get_bounds(index.start, index.stop)
+        return self.data[start:end]
+
+    def close(self):
+        self.data.close()
+
+
+def map_file(f):
+    """
+    :param f: file opened in binary mode or ArchiveExtractor.MemberFile
+    :return: read only mmap (MappedSegment for a MemberFile) of the file or None if the file
+        is empty (can't be mapped)
+    """
+    if isinstance(f, ArchiveExtractor.MemberFile):
+        if f.size == 0:
+            return None
+        return MappedSegment(f.file, f.offset, f.size)
+    f.seek(0, 2)
+    if f.tell() == 0:
+        return None
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def find_line(data, token, start):
+    """
+    Find the next line consisting of token (surrounding whitespace is ignored).
+
+    :param data: mmap or str to search
+    :param token: content of the line
+    :param start: offset to start searching at
+    :return: tuple (start, end) of the line, end including the line break, or None
+    """
+    while True:
+        index = data.find(token, start)
+        if index == -1:
+            return None
+        line_start = data.rfind(b'\n', 0, index) + 1
+        line_end = data.find(b'\n', index)
+        line_end = len(data) if line_end == -1 else line_end + 1
+        if data[line_start:line_end].strip() == token:
+            return line_start, line_end
+        start = index + len(token)
+
+
+def index_mgf(f):
+    """
+    Index the scans of an MGF file: from the end of the BEGIN IONS line to the end of the
+    END IONS line.
+
+    :param f: file opened in binary mode
+    :return: OffsetList
+    """
+    offset_list = OffsetList()
+    data = map_file(f)
+    if data is None:
+        return offset_list
+
+    try:
+        scan_start = 0
+        begin = find_line(data, b'BEGIN IONS', 0)
+        end = find_line(data, b'END IONS', 0)
+        while end is not None:
+            if begin is not None and begin[0] < end[0]:
+                scan_start = begin[1]
+                begin = find_line(data, b'BEGIN IONS', begin[1])
+            else:
+                offset_list.append((scan_start, end[1]))
+                end = find_line(data, b'END IONS', end[1])
+    finally:
+        data.close()
+
+    return offset_list
+
+
+# scan number in an MGF TITLE without SCANS: Thermo nativeID or <run>.<first scan>.<last scan>.<charge>
+title_scan_number_patterns = [
+    re.compile(r'scan=([0-9]+)'),
+    re.compile(r'^\S+\.([0-9]+)\.[0-9]+\.[0-9]+(?:\s|$)'),
+]
+
+
+def parse_scan_numbers(scans):
+    """
+    :param scans: value of an MGF SCANS param, e.g. '100', '100-102' or '100,105'
+    :return: list of scan numbers
+    """
+    scan_numbers = []
+    for part in scans.split(','):
+        first, sep, last = part.partition('-')
+        try:
+            if sep:
+                scan_numbers.extend(range(int(first), int(last) + 1))
+            else:
+                scan_numbers.append(int(first))
+        except ValueError:
+            pass
+    return scan_numbers
+
+
+def parse_title_scan_number(title):
+    for pattern in title_scan_number_patterns:
+        match = pattern.search(title)
+        if match:
+            return int(match.group(1))
+    return None
+
+
+def index_mgf_params(f, offset_list):
+    """
+    Index the scans of an MGF file by their scan numbers (only the params before the peaks are
+    read), for the spectrum id formats in PeakListParser.mgf_native_id_params.
+
+    Scan numbers are taken from SCANS or, for scans without SCANS, from the TITLE (see
+    title_scan_number_patterns). If a scan number occurs in more than one scan the first one is
+    indexed.
+
+    :param f: file opened in binary mode
+    :param offset_list: OffsetList of the file (see index_mgf)
+    :return: dict with the key 'SCANS' (scan number -> scan index)
+    """
+    params = {'SCANS': {}}
+    # params read from the scans
+    scan_param_keys = [b'TITLE', b'SCANS']
+    data = map_file(f)
+    if data is None:
+        return params
+
+    try:
+        for scan_index, (start, end) in enumerate(offset_list):
+            scan_params = {}
+            pos = start
+            while pos < end:
+                line_end = data.find(b'\n', pos, end)
+                if line_end == -1:
+                    line_end = end
+                line = data[pos:line_end].strip()
+                pos = line_end + 1
+                if line[:1].isdigit() or line == b'END IONS':
+                    break
+                key, sep, value = line.partition(b'=')
+                if sep and key in scan_param_keys:
+                    scan_params[key] = value
+
+            if 'SCANS' in scan_params:
+                scan_numbers = parse_scan_numbers(scan_params['SCANS'])
+            elif 'TITLE' in scan_params:
+                scan_numbers = [parse_title_scan_number(scan_params['TITLE'])]
+            else:
+                scan_numbers = []
+            for scan_number in scan_numbers:
+                if scan_number is not None:
+                    params['SCANS'].setdefault(scan_number, scan_index)
+    finally:
+        data.close()
+
+    return params
+
+
+mzml_index_list_offset_pattern = re.compile(
+    br'<indexListOffset>\s*([0-9]+)\s*</indexListOffset>')
+mzml_offset_pattern = re.compile(br'<offset\s+idRef="([^"]*)"[^>]*>\s*([0-9]+)\s*</offset>')
+mzml_spectrum_pattern = re.compile(br'<spectrum\s[^>]*?\bid="([^"]*)"')
+xml_attribute_entities = {'&quot;': '"', '&apos;': "'"}
+
+# the indexListOffset is written at the end of an indexedmzML file
+mzml_tail_size = 10 * 1024
+
+
+def read_mzml_index_list(data):
+    """
+    Read the spectrum offsets from the index list of an indexedmzML file.
+
+    :param data: mmap of the file
+    :return: list of (spectrum id, offset) or None if the file has no index list or one of the
+        offsets doesn't point to a spectrum (e.g. written by a broken converter)
+    """
+    match = mzml_index_list_offset_pattern.search(data[max(0, len(data) - mzml_tail_size):])
+    if match is None:
+        return None
+    index_list_offset = int(match.group(1))
+
+    start = data.find(b'<index name="spectrum"', index_list_offset)
+    if start == -1:
+        return None
+    end = data.find(b'</index>', start)
+    if end == -1:
+        return None
+
+    spectra = []
+    for spectrum_id, offset in mzml_offset_pattern.findall(data[start:end]):
+        offset = int(offset)
+        if data[offset:offset + 10] not in [b'<spectrum ', b'<spectrum\t', b'<spectrum\n']:
+            return None
+        spectra.append((unescape(spectrum_id, xml_attribute_entities), offset))
+    return spectra
+
+
+def scan_mzml_spectra(data):
+    """
+    Find the spectra of an mzML file by searching for their start tags.
+
+    :param data: mmap of the file
+    :return: list of (spectrum id, offset)
+    """
+    return [(unescape(match.group(1), xml_attribute_entities), match.start())
+            for match in mzml_spectrum_pattern.finditer(data)]
+
+
+def index_mzml(f):
+    """
+    Index the spectra of an mzML file by their id attribute. The index list of an indexedmzML
+    file is used if it is valid, otherwise the file is searched for the spectra.
+
+    :param f: file opened in binary mode
+    :return: list of (spectrum id, offset) in file order
+    """
+    data = map_file(f)
+    if data is None:
+        return []
+
+    try:
+        spectra = read_mzml_index_list(data)
+        if spectra is None:
+            spectra = scan_mzml_spectra(data)
+    finally:
+        data.close()
+
+    return spectra
+
+
+def index_ms2(f):
+    """
+    Index the scans of an MS2 file: from the start of an S line to the start of the next one
+    (or the end of the file).
+
+    :param f: file opened in binary mode
+    :return: OffsetList
+    """
+    offset_list = OffsetList()
+    data = map_file(f)
+    if data is None:
+        return offset_list
+
+    try:
+        if data[0:1] == b'S':
+            scan_start = 0
+        else:
+            scan_start = data.find(b'\nS') + 1
+            if scan_start == 0:     # no scans
+                return offset_list
+        while True:
+            scan_end = data.find(b'\nS', scan_start) + 1
+            if scan_end == 0:
+                offset_list.append((scan_start, len(data)))
+                break
+            offset_list.append((scan_start, scan_end))
+            scan_start = scan_end
+    finally:
+        data.close()
+
+    return offset_list
@@ -1,11 +1,20 @@
 import ntpath
-import zipfile
 import Ms2Reader as py_msn
 import MGF as py_mgf
 import pymzml
+from xml.etree import cElementTree
+import bisect
 import re
-import gzip
+import codecs
+import ArchiveExtractor
+from ScanCache import ScanCache
+from IndexCache import IndexCache
+import PeakListEncoding
+import PeakListIndex
+from MzMLDecoder import decode_spectrum, MzMLDecodeError
+import numpy as np
 import os
+from multiprocessing.pool import ThreadPool
 
 
 class PeakListParseError(Exception):
@@ -17,26 +26,117 @@ class ScanNotFoundException(Exception):
 
 
 class PeakListParser:
-    def __init__(self, pl_path, file_format_accession, spectrum_id_format_accession):
+
+    # maximum size in bytes of the cached scans (see ScanCache), 0 disables caching
+    scan_cache_size = 64 * 1024 * 1024
+
+    # get_scan returns binary peak lists (see PeakListEncoding) instead of text
+    binary_peaks = False
+
+    # MGF param used for looking up the position of the scan of a spectrum id of these formats
+    # (see get_scan_position)
+    mgf_native_id_params = {
+        'MS:1000768': 'SCANS',  # Thermo nativeID format
+        'MS:1000776': 'SCANS',  # scan number only nativeID format
+    }
+
+    # MGF and MS2 scan indices are stored next to the peak list file (<file>.idx)
+    default_index_cache = IndexCache(suffix='idx')
+
+    # formats whose readers can read stored zip members in place (see ArchiveExtractor.ZipMember)
+    in_place_formats = [
+        'MS:1001062',   # MGF
+        'MS:1001466',   # MS2
+    ]
+
+    def __init__(self, pl_path, file_format_accession, spectrum_id_format_accession,
+                 index_cache=None):
+        """
+
+        :param pl_path: path of the peak list file or ArchiveExtractor.ZipMember (for
+            in_place_formats)
+        :param file_format_accession: file format cv accession
+        :param spectrum_id_format_accession: spectrum id format cv accession
+        :param index_cache: IndexCache for the MGF and MS2 scan indices, default_index_cache if
+            None
+        """
+        if isinstance(pl_path, ArchiveExtractor.ZipMember):
+            index_cache = None  # IndexCache entries are keyed by the stat of the indexed file
+        elif index_cache is None:
+            index_cache = self.default_index_cache
         # self.spectra_data = spectra_data
         self.file_format_accession = file_format_accession
         self.spectrum_id_format_accession = spectrum_id_format_accession
         self.peak_list_path = pl_path
         self.peak_list_file_name = os.path.split(pl_path)[1]
+        self.scan_cache = ScanCache(self.scan_cache_size)
+        self.mzml_file = None   # binary file handle for decoding mzML spectra (see MzMLDecoder)
 
         try:
             if self.is_mzML():
                 self.reader = pymzml.run.Reader(pl_path)
+                self.init_mzml_id_index(index_cache)
+                self.mzml_file = open(pl_path, 'rb')
             elif self.is_mgf():
-                self.reader = py_mgf.Reader(pl_path)
+                self.reader = py_mgf.Reader(pl_path, index_cache=index_cache)
             elif self.is_ms2():
-                self.reader = py_msn.Reader(pl_path)
+                self.reader = py_msn.Reader(pl_path, index_cache=index_cache)
             else:
                 self.reader = None
         except Exception as e:
             message = "Error reading peak list file {0}: {1} - Arguments:\n{2!r}".format(self.peak_list_file_name, type(e).__name__, e.args)
             raise PeakListParseError(message)
 
+    def reopen(self):
+        """
+        Reopen the file handle of the reader (e.g. after forking, where it would share the
+        file position with the parent process).
+        """
+        if self.reader is None:
+            return
+        self.reader.seeker.close()
+        if self.is_mzML():
+            self.reader.seeker = codecs.open(self.reader.info['filename'], mode='r',
+                                             encoding=self.reader.info['encoding'])
+        else:
+            self.reader.seeker = PeakListIndex.open_file(self.reader.info['filename'])
+        if self.mzml_file is not None:
+            self.mzml_file.close()
+            self.mzml_file = open(self.peak_list_path, 'rb')
+
+    def close(self):
+        if self.reader is not None:
+            self.reader.seeker.close()
+        if self.mzml_file is not None:
+            self.mzml_file.close()
+
+    def init_mzml_id_index(self, index_cache):
+        """
+        Add the spectra of the mzML file to the index of the pymzml reader by their id
+        attribute (see PeakListIndex.index_mzml), so they can be read by the spectrumID of an
+        mzML unique identifier (MS:1001530). Spectra whose id contains a scan number are also
+        indexed by it if the pymzml index doesn't contain them (e.g. broken indexListOffset).
+
+        :param index_cache: IndexCache to load the id index from and store it in
+        """
+        spectra = index_cache.load(self.peak_list_path)
+        if not isinstance(spectra, list):
+            with open(self.peak_list_path, 'rb') as f:
+                spectra = PeakListIndex.index_mzml(f)
+            index_cache.save(self.peak_list_path, spectra)
+
+        offsets = self.reader.info['offsets']
+        for spectrum_id, offset in spectra:
+            offsets[spectrum_id] = offset
+            scan_number_match = re.search("scan=([0-9]+)", spectrum_id)
+            if scan_number_match:
+                offsets.setdefault(int(scan_number_match.group(1)), offset)
+
+        if len(spectra) > 0:
+            self.reader.info['offsetList'] = sorted(
+                set(self.reader.info['offsetList']) | set(offset for spectrum_id, offset in spectra))
+            self.reader.info['seekable'] = True
+
     def is_mgf(self):
         return self.file_format_accession == 'MS:1001062'
 
@@ -48,35 +148,52 @@ class PeakListParser:
 
 
     @staticmethod
-    def extract_gz(in_file):
-        if in_file.endswith('.gz'):
-            in_f = gzip.open(in_file, 'rb')
-            in_file = in_file.replace(".gz", "")
-            out_f = open(in_file, 'wb')
-            out_f.write(in_f.read())
-            in_f.close()
-            out_f.close()
+    def open_readers(open_functions, threads):
+        """
+        Open peak list readers in a thread pool. Building the indices mostly reads the files (and
+        extract_gz decompresses them), which doesn't hold the GIL.
 
-            return in_file
+        :param open_functions: list of (key, function returning a PeakListParser)
+        :param threads: max number of threads
+        :return: tuple (dict key -> PeakListParser, list of (key, exception) of the functions that
+            failed, in the order of open_functions)
+        """
+        def open_reader(open_function):
+            key, function = open_function
+            try:
+                return key, function(), None
+            except Exception as e:
+                return key, None, e
 
+        if threads > 1 and len(open_functions) > 1:
+            pool = ThreadPool(min(threads, len(open_functions)))
+            try:
+                results = pool.map(open_reader, open_functions)
+            finally:
+                pool.close()
+                pool.join()
         else:
-            raise StandardError("unsupported file extension for: %s" % in_file)
+            results = [open_reader(open_function) for open_function in open_functions]
+
+        readers = {key: reader for key, reader, e in results if e is None}
+        errors = [(key, e) for key, reader, e in results if e is not None]
+        return readers, errors
+
+    @staticmethod
+    def extract_gz(in_file):
+        return ArchiveExtractor.extract_gz(in_file)
 
     @staticmethod
-    def unzip_peak_lists(zip_file):
+    def open_zip_peak_lists(zip_file):
         """
-        unzips and returns resulting folder
-        :param zip_file: path to archive to unzip
-        :return: resulting folder
+        opens a zip archive of peak list files, they are extracted to <zip_file>_unzip/ (or
+        read in place) when they are opened, see ArchiveExtractor.ZipArchive
+        :param zip_file: path to archive
+        :return: ZipArchive
         """
 
         if zip_file.endswith(".zip"):
-            zip_ref = zipfile.ZipFile(zip_file, 'r')
-            unzip_path = zip_file + '_unzip/'
-            zip_ref.extractall(unzip_path)
-            zip_ref.close()
-
-            return unzip_path
+            return ArchiveExtractor.ZipArchive(zip_file)
 
         else:
             raise StandardError("unsupported file extension for: %s" % zip_file)
@@ -96,23 +213,37 @@ class PeakListParser:
         return ion_types
 
     def get_scan(self, scan_id):
+        """
+        :return: scan dict with peaks and precursor, cached and immutable (see ScanCache)
+        """
+        return self.scan_cache.get(('scan', scan_id), lambda: self._read_scan(scan_id))
+
+    def _read_scan(self, scan_id):
         if self.reader is None:
             raise PeakListParseError("unsupported peak list file type for: %s" % ntpath.basename(self.peak_list_file_name))
 
+        if self.binary_peaks and not self.is_mzML():
+            return self._read_binary_scan(scan_id)
+
+        if self.is_mzML():
+            mz, intensity, precursor = self._read_mzml_scan(scan_id)
+            if self.binary_peaks:
+                peak_list = PeakListEncoding.encode_peaks(mz, intensity)
+            else:
+                peak_list = PeakListEncoding.format_text_peaks(mz, intensity)
+            return {
+                'peaks': peak_list,
+                'precursor': precursor
+            }
+
         try:
-            scan = self.reader[scan_id]
+            scan = self.reader[self.get_scan_position(scan_id)]
         except Exception as e:
             # raise ScanNotFoundException(type(e).__name__,
             #                             ntpath.basename(self.peak_list_path), e.args)
             raise ScanNotFoundException("%s - for file: %s - scanId: %s" % (e.args[0], ntpath.basename(self.peak_list_path), scan_id))
 
-        if self.is_mzML():
-            peak_list = "\n".join(["%s %s" % (mz, i) for mz, i in scan.peaks if i > 0])
-            precursor = None
-            if 'precursors' in scan:
-                precursor = scan['precursors'][0]
-
-        elif self.is_mgf():
+        if self.is_mgf():
             peak_list = scan['peaks']
             precursor = scan['precursor']
 
@@ -128,6 +259,225 @@ class PeakListParser:
         return scan
 
 
+    def get_scan_offset(self, scan_id):
+        """
+        :return: byte offset of the scan in the peak list file, None if it isn't indexed
+        """
+        try:
+            if self.is_mzML():
+                return self.reader.info['offsets'][scan_id]
+            return self.reader.info['offsetList'][self.get_scan_position(scan_id)][0]
+        except (KeyError, IndexError, TypeError, ScanNotFoundException):
+            return None
+
+    def get_scans(self, scan_ids, references=False):
+        """
+        Batch version of get_scan (get_scan_reference if references).
+        The scans are read in order of their position in the file instead of the order of the
+        request, so a batch is read front to back rather than seeking back and forth.
+        Scans without a known offset (e.g. unindexed mzML) are read last, in request order.
+
+        :param scan_ids: scan ids as returned by parse_scan_id, may contain duplicates
+        :param references: return scan references (see get_scan_reference) instead of peaks
+        :return: dict scan_id -> scan
+        """
+        if references:
+            get_scan = self.get_scan_reference
+        else:
+            get_scan = self.get_scan
+
+        requests = []
+        for i, scan_id in enumerate(scan_ids):
+            offset = self.get_scan_offset(scan_id)
+            requests.append((offset is None, offset, i, scan_id))
+        requests.sort()
+
+        scans = {}
+        for unknown_offset, offset, i, scan_id in requests:
+            if scan_id not in scans:
+                scans[scan_id] = get_scan(scan_id)
+
+        return scans
+
+    def _read_binary_scan(self, scan_id):
+        """
+        get_scan for MGF and MS2 files with binary peak lists, the peaks are read from the raw
+        scan without formatting them as text first.
+        """
+        try:
+            offset, end = self.reader.info['offsetList'][self.get_scan_position(scan_id)]
+        except Exception as e:
+            raise ScanNotFoundException("%s - for file: %s - scanId: %s" % (e.args[0], ntpath.basename(self.peak_list_path), scan_id))
+
+        if offset == -1:    # empty scan
+            raw_scan = ''
+            precursor = None
+        else:
+            self.reader.seeker.seek(offset, 0)
+            raw_scan = self.reader.seeker.read(end - offset)
+            precursor = self.reader.parse_precursor(raw_scan)
+
+        return {
+            'peaks': PeakListEncoding.encode_peaks(*PeakListEncoding.parse_text_peaks(raw_scan)),
+            'precursor': precursor
+        }
+
+    def get_mzml_scan_range(self, scan_id):
+        """
+        :return: tuple (start, end) of the byte range of the spectrum in the mzML file, the
+            same range as read by pymzml
+        :raises KeyError: if the spectrum isn't indexed
+        """
+        offset = self.reader.info['offsets'][scan_id]
+        end_index = bisect.bisect_right(self.reader.info['offsetList'], offset)
+        if end_index == len(self.reader.info['offsetList']):
+            end = os.path.getsize(self.reader.info['filename'])
+        else:
+            end = self.reader.info['offsetList'][end_index]
+        return offset, end
+
+    def read_mzml_spectrum(self, offset, length, decode_arrays=True):
+        """
+        Decode the spectrum at a byte range of the mzML file (see MzMLDecoder.decode_spectrum).
+        """
+        self.mzml_file.seek(offset, 0)
+        return decode_spectrum(self.mzml_file.read(length), decode_arrays)
+
+    def _read_mzml_scan(self, scan_id):
+        """
+        Indexed spectra are decoded by MzMLDecoder, the others (or ones with array encodings
+        it doesn't know, e.g. in a referenceableParamGroup) are read by pymzml.
+
+        :return: tuple (m/z array, intensity array, precursor) of the peaks with intensity > 0
+        """
+        spectrum = None
+        try:
+            offset, end = self.get_mzml_scan_range(scan_id)
+            spectrum = self.read_mzml_spectrum(offset, end - offset)
+        except (KeyError, MzMLDecodeError):
+            pass
+
+        if spectrum is not None:
+            mz, intensity = self.filter_mzml_peaks(spectrum['mz'], spectrum['intensity'])
+            precursors = spectrum['precursors']
+        else:
+            try:
+                scan = self.reader[scan_id]
+            except Exception as e:
+                raise ScanNotFoundException("%s - for file: %s - scanId: %s" % (e.args[0], ntpath.basename(self.peak_list_path), scan_id))
+            mz, intensity = self.get_mzml_peak_arrays(scan)
+            precursors = scan.get('precursors')
+
+        precursor = None
+        if precursors:
+            precursor = precursors[0]
+        return mz, intensity, precursor
+
+    @staticmethod
+    def get_mzml_peak_list(spectrum):
+        """
+        :param spectrum: pymzml spectrum
+        :return: text peak list of the peaks with intensity > 0
+        """
+        return PeakListEncoding.format_text_peaks(*PeakListParser.get_mzml_peak_arrays(spectrum))
+
+    @staticmethod
+    def get_mzml_peak_arrays(spectrum):
+        """
+        Uses the decoded m/z and intensity arrays of the spectrum, instead of its list of
+        (m/z, intensity) tuples (spectrum.peaks).
+
+        :param spectrum: pymzml spectrum
+        :return: tuple of numpy arrays (m/z, intensity) of the peaks with intensity > 0
+        """
+        return PeakListParser.filter_mzml_peaks(spectrum.mz, spectrum.i)
+
+    @staticmethod
+    def filter_mzml_peaks(mz, intensity):
+        """
+        :return: tuple of float64 numpy arrays (m/z, intensity) of the peaks with intensity > 0
+        """
+        mz = np.asarray(mz, dtype=float)
+        intensity = np.asarray(intensity, dtype=float)
+        # arrays of different length are truncated, like zip in spectrum.peaks
+        peak_count = min(len(mz), len(intensity))
+        mz, intensity = mz[:peak_count], intensity[:peak_count]
+        non_zero = intensity > 0
+        return mz[non_zero], intensity[non_zero]
+
+    def get_scan_reference(self, scan_id):
+        """
+        Like get_scan, but instead of the peaks returns where the scan is in the peak list file,
+        for reading them on request with read_peaks.
+
+        :return: dict with offset, length (in bytes) and precursor, cached and immutable
+        """
+        return self.scan_cache.get(('reference', scan_id),
+                                   lambda: self._read_scan_reference(scan_id))
+
+    def _read_scan_reference(self, scan_id):
+        if self.reader is None:
+            raise PeakListParseError("unsupported peak list file type for: %s" % ntpath.basename(self.peak_list_file_name))
+
+        try:
+            if self.is_mzML():
+                offset, end = self.get_mzml_scan_range(scan_id)
+                precursors = self.read_mzml_spectrum(offset, end - offset,
+                                                     decode_arrays=False)['precursors']
+                precursor = None
+                if precursors:
+                    precursor = precursors[0]
+            else:
+                offset, end = self.reader.info['offsetList'][self.get_scan_position(scan_id)]
+                precursor = None
+                if offset != -1:
+                    self.reader.seeker.seek(offset, 0)
+                    precursor = self.reader.parse_precursor(self.reader.seeker.read(end - offset))
+        except Exception as e:
+            raise ScanNotFoundException("%s - for file: %s - scanId: %s" % (e.args[0], ntpath.basename(self.peak_list_path), scan_id))
+
+        return {
+            'offset': offset,
+            'length': end - offset,
+            'precursor': precursor
+        }
+
+    def read_peaks(self, offset, length):
+        """
+        Read the peak list of a scan from its location in the file (see get_scan_reference).
+
+        :return: peak list in the same format as returned by get_scan
+        """
+        if self.reader is None:
+            raise PeakListParseError("unsupported peak list file type for: %s" % ntpath.basename(self.peak_list_file_name))
+
+        if offset == -1:    # empty scan
+            return ''
+
+        if self.is_mzML():
+            try:
+                spectrum = self.read_mzml_spectrum(offset, length)
+                return PeakListEncoding.format_text_peaks(
+                    *self.filter_mzml_peaks(spectrum['mz'], spectrum['intensity']))
+            except MzMLDecodeError:
+                pass
+
+        self.reader.seeker.seek(offset, 0)
+        data = self.reader.seeker.read(length)
+
+        if self.is_mzML():
+            try:
+                self.reader.spectrum.initFromTreeObject(cElementTree.fromstring(data))
+            except Exception:
+                # the last spectrum is followed by closing tags
+                starting_tag = data.split()[0]
+                stop_index = data.index('</' + starting_tag[1:] + '>')
+                self.reader.spectrum.initFromTreeObject(
+                    cElementTree.fromstring(data[:stop_index + len(starting_tag) + 2]))
+            return self.get_mzml_peak_list(self.reader.spectrum)
+
+        return self.reader.parse_peak_list(data)
+
     def parse_scan_id(self, spec_id):
 
         # #
@@ -219,17 +569,9 @@ class PeakListParser:
 
         # MS:1001530 mzML unique identifier:
         # Used for referencing mzML. The value of the spectrum ID attribute is referenced directly.
-        elif self.spectrum_id_format_accession == 'MS:1001530':
-            # ToDo: pymzML uses scan number as index and not the spectrumID attribute therefore
-            # ToDo: we resort to using the default way of parsing the spec_id, i.e. using the last number in the string
-            # ToDo: This might change if we are going to use a different (more standards compliant approach)
-            identified_spec_id_format = False
-            # matches = re.search("scan=([0-9]+)", spec_id).groups()
-            # try:
-            #     spec_id = int(matches[0])
-            #     identified_spec_id_format = True
-            # except IndexError:
-            #     pass
+        # mzML spectra are indexed by their id attribute (see init_mzml_id_index)
+        elif self.spectrum_id_format_accession == 'MS:1001530' and self.is_mzML():
+            identified_spec_id_format = True
 
         if not identified_spec_id_format:
             # ToDo: display warning or throw error? depending on strict mode or not?
@@ -246,3 +588,34 @@ class PeakListParser:
 
         return spec_id
 
+    def get_scan_position(self, scan_id):
+        """
+        :param scan_id: scan id as returned by parse_scan_id
+        :return: index of the scan in the offsetList of the MGF or MS2 reader, scan numbers of
+            mgf_native_id_params formats are looked up in the MGF params (see get_mgf_scan_index)
+        """
+        if self.is_mgf() and self.spectrum_id_format_accession in self.mgf_native_id_params:
+            return self.get_mgf_scan_index(
+                self.mgf_native_id_params[self.spectrum_id_format_accession], scan_id)
+        return scan_id
+
+    def get_mgf_scan_index(self, param, value):
+        """
+        Look up the index of an MGF scan by a param.
+
+        MGF files without scan numbers (no SCANS and no scan number in the TITLE) are
+        indexed by position, so the scan number is used as the index of the scan.
+
+        :param param: SCANS (scan number)
+        :param value: value of the param
+        :return: index of the scan in the offsetList
+        """
+        param_index = self.reader.get_param_index()
+        if param == 'SCANS' and len(param_index['SCANS']) == 0:
+            return value
+        try:
+            return param_index[param][value]
+        except KeyError:
+            # the callers add the file and scan id to the message
+            raise ScanNotFoundException("%s=%s not found" % (param, value))
+
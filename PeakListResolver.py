@@ -0,0 +1,113 @@
+import os
+import shutil
+import MGF as py_mgf
+import Ms2Reader as py_msn
+from PeakListParser import PeakListParser, PeakListParseError
+import PeakListEncoding
+
+
+def get_upload_peak_list_dir(store_dir, identifier):
+    """
+    :param store_dir: persistent store of the peak list files of uploads with peak references
+    :param identifier: identifier of the upload (<upload_id>-<random_id> for PostgreSQL, the
+        session identifier for SQLite, whose databases contain a single upload)
+    :return: dir of the peak list files of the upload, for the PeakListResolver
+    """
+    return os.path.join(store_dir, identifier)
+
+
+def store_peak_lists(peak_list_readers, peak_list_dir, move=True):
+    """
+    Move the peak list files of an upload stored with peak references out of the upload folder
+    (which is deleted after parsing) to peak_list_dir (see get_upload_peak_list_dir). The readers
+    are closed.
+
+    :param peak_list_readers: dict -> PeakListParser of the upload
+    :param peak_list_dir: dir to store the files in
+    :param move: move the files, copy them if False
+    :return: paths of the stored files
+    """
+    if not os.path.isdir(peak_list_dir):
+        os.makedirs(peak_list_dir)
+
+    stored_paths = []
+    for peak_list_reader in peak_list_readers.values():
+        peak_list_reader.close()
+        # the references are stored with the file name (see MzIdParser.process_sid_result)
+        stored_path = os.path.join(peak_list_dir, os.path.basename(peak_list_reader.peak_list_path))
+        if stored_path in stored_paths:
+            continue
+        if move:
+            shutil.move(peak_list_reader.peak_list_path, stored_path)
+        else:
+            shutil.copyfile(peak_list_reader.peak_list_path, stored_path)
+        stored_paths.append(stored_path)
+
+    return stored_paths
+
+
+class PeakListResolver(object):
+    """
+    Reads the peak lists of spectra that were stored as references to the peak list file
+    (peak_list_file_name, peak_list_offset, peak_list_length, peak_list_format) instead of
+    the peak list itself.
+
+    MGF and MS2 scans are read and decoded directly, mzML scans through a PeakListParser
+    that is kept open for further requests.
+    """
+
+    # file format accession -> peak list decoder for a raw scan
+    raw_scan_decoders = {
+        'MS:1001062': py_mgf.Reader.parse_peak_list,
+        'MS:1001466': py_msn.Reader.parse_peak_list,
+    }
+
+    def __init__(self, peak_list_dir):
+        """
+
+        :param peak_list_dir: dir of the peak list files (see get_upload_peak_list_dir)
+        """
+        self.peak_list_dir = peak_list_dir
+        self.peak_list_readers = {}     # peak list file name -> PeakListParser
+
+    def get_peak_list_reader(self, peak_list_file_name, file_format_accession):
+        if peak_list_file_name not in self.peak_list_readers:
+            self.peak_list_readers[peak_list_file_name] = PeakListParser(
+                os.path.join(self.peak_list_dir, peak_list_file_name), file_format_accession, None)
+        return self.peak_list_readers[peak_list_file_name]
+
+    def get_peaks(self, peak_list_file_name, offset, length, file_format_accession):
+        """
+        :return: peak list in the same format as PeakListParser.get_scan
+        """
+        if offset is None:
+            raise PeakListParseError("no peak list reference for spectrum in: %s" % peak_list_file_name)
+
+        if file_format_accession in self.raw_scan_decoders:
+            if offset == -1:    # empty scan
+                return ''
+            with open(os.path.join(self.peak_list_dir, peak_list_file_name), 'rb') as f:
+                f.seek(offset, 0)
+                return self.raw_scan_decoders[file_format_accession](f.read(length))
+
+        return self.get_peak_list_reader(peak_list_file_name, file_format_accession).read_peaks(
+            offset, length)
+
+    def resolve(self, spectrum):
+        """
+        :param spectrum: dict of a spectra table row
+        :return: peak list of the spectrum, read from the file if it is stored as a reference
+            or decoded if it is stored binary encoded
+        """
+        if spectrum.get('peak_list') is not None:
+            return spectrum['peak_list']
+        if spectrum.get('peak_list_binary') is not None:
+            return PeakListEncoding.format_text_peaks(
+                *PeakListEncoding.decode_peaks(spectrum['peak_list_binary']))
+        return self.get_peaks(spectrum['peak_list_file_name'], spectrum['peak_list_offset'],
+                              spectrum['peak_list_length'], spectrum['peak_list_format'])
+
+    def close(self):
+        for peak_list_reader in self.peak_list_readers.values():
+            peak_list_reader.close()
+        self.peak_list_readers = {}
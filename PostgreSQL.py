@@ -20,6 +20,7 @@ def connect(dbname):
 def create_tables(cur, con):
     # don't create tables here
     # use file postgreSQL_schema.sql to init db
+    # and update_postgreSQL.sql to update a db created with an older schema
     #
     # you will need to search and replace 'username' in the sql file,
     # replacing it with the role name you use to access the database
@@ -244,6 +245,65 @@ def write_spectra(inj_list, cur, con):
     return True
 
 
+def write_spectra_references(inj_list, cur, con):
+    """
+    Write spectra with a reference to the scan in the peak list file instead of the peak list
+    (see PeakListResolver).
+    """
+    try:
+        cur.executemany("""
+        INSERT INTO spectra (
+        id, 
+        peak_list, 
+        peak_list_file_name, 
+        scan_id, 
+        frag_tol, 
+        upload_id, 
+        spectrum_ref,
+        precursor_mz,
+        precursor_charge,
+        peak_list_offset,
+        peak_list_length,
+        peak_list_format
+        )
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)""", inj_list)
+        con.commit()
+
+    except psycopg2.Error as e:
+        raise DBException(e.message)
+
+    return True
+
+
+def write_spectra_binary(inj_list, cur, con):
+    """
+    Write spectra with binary peak lists (see PeakListEncoding), same row layout as
+    write_spectra.
+    """
+    try:
+        cur.executemany("""
+        INSERT INTO spectra (
+        id, 
+        peak_list_binary, 
+        peak_list_file_name, 
+        scan_id, 
+        frag_tol, 
+        upload_id, 
+        spectrum_ref,
+        precursor_mz,
+        precursor_charge
+        )
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)""",
+            [[row[0], None if row[1] is None else psycopg2.Binary(row[1])] + list(row[2:])
+             for row in inj_list])
+        con.commit()
+
+    except psycopg2.Error as e:
+        raise DBException(e.message)
+
+    return True
+
+
 def write_spectrum_identifications(inj_list, cur, con):
     try:
         cur.executemany("""
@@ -270,3 +330,104 @@ def write_spectrum_identifications(inj_list, cur, con):
         raise DBException(e.message)
 
     return True
+
+
+def delete_spectra_from(upload_id, spectrum_id, identification_id, cur, con):
+    """
+    Delete the spectra and spectrum identifications with ids from spectrum_id and
+    identification_id on (rows written after the checkpoint an upload is resumed from).
+    """
+    try:
+        cur.execute("DELETE FROM spectra WHERE upload_id = %s AND id >= %s;",
+                    (upload_id, spectrum_id))
+        cur.execute("DELETE FROM spectrum_identifications WHERE upload_id = %s AND id >= %s;",
+                    (upload_id, identification_id))
+        con.commit()
+
+    except psycopg2.Error as e:
+        raise DBException(e.message)
+    return True
+
+
+# tables with the parsed data of an upload
+upload_data_tables = ['db_sequences', 'peptides', 'peptide_evidences', 'modifications', 'spectra',
+                      'spectrum_identifications']
+
+
+def get_upload_by_content_hash(content_hash, cur, con):
+    """
+    :param content_hash: content hash of the uploaded files (see UploadHash)
+    :return: id of the latest completed upload with the content hash, None if there is none
+    """
+    try:
+        cur.execute("""SELECT id FROM uploads WHERE content_hash = %s AND upload_error IS NULL
+                    ORDER BY id DESC LIMIT 1;""", (content_hash,))
+        rows = cur.fetchall()
+
+    except psycopg2.Error as e:
+        # e.g. content_hash column missing (see update_postgreSQL.sql), don't leave the
+        # transaction aborted
+        con.rollback()
+        raise DBException(e.message)
+
+    if len(rows) == 0:
+        return None
+    return rows[0][0]
+
+
+def clone_upload(source_upload_id, upload_id, cur, con):
+    """
+    Copy the parsed data and upload info of an upload to another upload (duplicate upload of
+    the same files).
+
+    :return: upload warnings of the source upload
+    """
+    try:
+        for table in upload_data_tables:
+            cur.execute("""SELECT column_name FROM information_schema.columns
+                        WHERE table_schema = 'public' AND table_name = %s
+                        ORDER BY ordinal_position;""", (table,))
+            columns = [row[0] for row in cur.fetchall()]
+            values = ['%s' if column == 'upload_id' else column for column in columns]
+            cur.execute("INSERT INTO {0} ({1}) SELECT {2} FROM {0} WHERE upload_id = %s;".format(
+                table, ', '.join(columns), ', '.join(values)), (upload_id, source_upload_id))
+
+        cur.execute("""UPDATE uploads SET
+                        (peak_list_file_names, spectra_formats, analysis_software, provider,
+                         audits, samples, analyses, protocol, bib, contains_crosslinks,
+                         ident_count, ident_file_size, upload_warnings, content_hash) =
+                        (SELECT peak_list_file_names, spectra_formats, analysis_software, provider,
+                         audits, samples, analyses, protocol, bib, contains_crosslinks,
+                         ident_count, ident_file_size, upload_warnings, content_hash
+                         FROM uploads WHERE id = %s)
+                    WHERE id = %s;""", (source_upload_id, upload_id))
+        con.commit()
+
+        cur.execute("SELECT upload_warnings FROM uploads WHERE id = %s;", (upload_id,))
+        upload_warnings = cur.fetchall()[0][0]
+
+    except psycopg2.Error as e:
+        # don't keep a partial copy, the upload is parsed instead
+        con.rollback()
+        raise DBException(e.message)
+
+    if upload_warnings is None:
+        return []
+    return upload_warnings
+
+
+def write_content_hash(upload_id, content_hash, upload_warnings, cur, con):
+    """
+    Mark an upload as completed, so duplicate uploads of the same files can be copied from it.
+
+    :param content_hash: content hash of the uploaded files (see UploadHash)
+    """
+    try:
+        cur.execute("""UPDATE uploads SET content_hash = %s, upload_warnings = %s
+                    WHERE id = %s;""", (content_hash, json.dumps(upload_warnings), upload_id))
+        con.commit()
+
+    except psycopg2.Error as e:
+        con.rollback()
+        raise DBException(e.message)
+    return True
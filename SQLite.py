@@ -1,5 +1,6 @@
 import sqlite3
 import json
+import os
 
 
 class DBException(Exception):
@@ -8,7 +9,8 @@ class DBException(Exception):
 
 def connect(dbname):
     try:
-        con = sqlite3.connect(dbname)
+        # the connection is handed over to the DBWriter thread while parsing
+        con = sqlite3.connect(dbname, check_same_thread=False)
     except sqlite3.Error as e:
         raise DBException(e.message)
 
@@ -102,7 +104,11 @@ def create_tables(cur, con):
             "frag_tol TEXT,"
             "spectrum_ref TEXT,"
             "precursor_mz FLOAT,"
-            "precursor_charge INT)"
+            "precursor_charge INT,"
+            "peak_list_offset INT,"     # reference to the scan in the peak list file
+            "peak_list_length INT,"     # instead of peak_list (see write_spectra_references)
+            "peak_list_format TEXT,"
+            "peak_list_binary BLOB)"    # instead of peak_list (see write_spectra_binary)
         )
 
         cur.execute("DROP TABLE IF EXISTS spectrum_identifications")
@@ -262,6 +268,65 @@ def write_spectra(inj_list, cur, con):
     return True
 
 
+def write_spectra_references(inj_list, cur, con):
+    """
+    Write spectra with a reference to the scan in the peak list file instead of the peak list
+    (see PeakListResolver).
+    """
+    try:
+        cur.executemany("""
+          INSERT INTO spectra (
+              'id', 
+              'peak_list', 
+              'peak_list_file_name', 
+              'scan_id', 
+              'frag_tol', 
+              'upload_id', 
+              'spectrum_ref',
+              'precursor_mz',
+              'precursor_charge',
+              'peak_list_offset',
+              'peak_list_length',
+              'peak_list_format'
+          )
+          VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", inj_list)
+        con.commit()
+
+    except sqlite3.Error as e:
+        raise DBException(e.message)
+
+    return True
+
+
+def write_spectra_binary(inj_list, cur, con):
+    """
+    Write spectra with binary peak lists (see PeakListEncoding), same row layout as
+    write_spectra.
+    """
+    try:
+        cur.executemany("""
+          INSERT INTO spectra (
+              'id', 
+              'peak_list_binary', 
+              'peak_list_file_name', 
+              'scan_id', 
+              'frag_tol', 
+              'upload_id', 
+              'spectrum_ref',
+              'precursor_mz',
+              'precursor_charge'
+          )
+          VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            [[row[0], None if row[1] is None else sqlite3.Binary(row[1])] + list(row[2:])
+             for row in inj_list])
+        con.commit()
+
+    except sqlite3.Error as e:
+        raise DBException(e.message)
+
+    return True
+
+
 def write_spectrum_identifications(inj_list, cur, con):
     try:
         cur.executemany("""
@@ -290,6 +355,145 @@ def write_spectrum_identifications(inj_list, cur, con):
     return True
 
 
+def delete_spectra_from(upload_id, spectrum_id, identification_id, cur, con):
+    """
+    Delete the spectra and spectrum identifications with ids from spectrum_id and
+    identification_id on (rows written after the checkpoint an upload is resumed from).
+    """
+    try:
+        cur.execute("DELETE FROM spectra WHERE id >= ?", (spectrum_id,))
+        cur.execute("DELETE FROM spectrum_identifications WHERE id >= ?", (identification_id,))
+        con.commit()
+
+    except sqlite3.Error as e:
+        raise DBException(e.message)
+
+    return True
+
+
+# registry of completed uploads by content hash, each upload has its own database file
+registry_path = 'dbs/upload_registry.db'
+
+# tables with the parsed data of an upload
+upload_data_tables = ['meta_data', 'protocols', 'peptides', 'modifications', 'peptide_evidences',
+                      'spectra', 'spectrum_identifications']
+
+
+def connect_registry():
+    try:
+        con = sqlite3.connect(registry_path)
+        con.execute("CREATE TABLE IF NOT EXISTS uploads("
+                    "content_hash TEXT PRIMARY KEY, "
+                    "db_path TEXT, "
+                    "upload_warnings JSON)")
+    except sqlite3.Error as e:
+        raise DBException(e.message)
+
+    return con
+
+
+def get_db_path(cur):
+    """
+    :return: absolute path of the database file of the cursor
+    """
+    cur.execute("PRAGMA database_list")
+    return os.path.abspath([row[2] for row in cur.fetchall() if row[1] == 'main'][0])
+
+
+def get_upload_by_content_hash(content_hash, cur, con):
+    """
+    :param content_hash: content hash of the uploaded files (see UploadHash)
+    :return: path of the database of a completed upload with the content hash, None if there
+        is none
+    """
+    try:
+        db_path = get_db_path(cur)
+        registry_con = connect_registry()
+        rows = registry_con.execute("SELECT db_path FROM uploads WHERE content_hash = ?",
+                                    (content_hash,)).fetchall()
+        registry_con.close()
+    except sqlite3.Error as e:
+        raise DBException(e.message)
+
+    # tmp databases are removed eventually
+    if len(rows) == 0 or not os.path.isfile(rows[0][0]) or rows[0][0] == db_path:
+        return None
+    return rows[0][0]
+
+
+def get_shared_columns(table, cur):
+    """
+    :return: columns of the table in both the main and the attached source database, in the
+        order of main (the source may have been created with an older schema)
+    """
+    cur.execute("PRAGMA source.table_info({0})".format(table))
+    source_columns = set(row[1] for row in cur.fetchall())
+    cur.execute("PRAGMA main.table_info({0})".format(table))
+    return [row[1] for row in cur.fetchall() if row[1] in source_columns]
+
+
+def clone_upload(source_db_path, upload_id, cur, con):
+    """
+    Copy the parsed data of an upload from its database (duplicate upload of the same files).
+    The tables have to exist already (create_tables). Only the columns of both schemas are
+    copied, columns added since the source was written are left null.
+
+    :return: upload warnings of the source upload
+    """
+    try:
+        cur.execute("ATTACH DATABASE ? AS source", (source_db_path,))
+        try:
+            # read all columns first, the sqlite3 module commits before a PRAGMA
+            table_columns = [(table, get_shared_columns(table, cur))
+                             for table in upload_data_tables]
+            for table, columns in table_columns:
+                if len(columns) == 0:
+                    raise sqlite3.OperationalError('no such table: source.%s' % table)
+            try:
+                for table, columns in table_columns:
+                    cur.execute("INSERT INTO main.{0} ({1}) SELECT {1} FROM source.{0}".format(
+                        table, ', '.join(columns)))
+                con.commit()
+            except sqlite3.Error:
+                # don't keep a partial copy, the upload is parsed instead
+                con.rollback()
+                raise
+        finally:
+            cur.execute("DETACH DATABASE source")
+
+        registry_con = connect_registry()
+        rows = registry_con.execute("SELECT upload_warnings FROM uploads WHERE db_path = ?",
+                                    (source_db_path,)).fetchall()
+        registry_con.close()
+
+    except sqlite3.Error as e:
+        raise DBException(e.message)
+
+    if len(rows) == 0 or rows[0][0] is None:
+        return []
+    return json.loads(rows[0][0])
+
+
+def write_content_hash(upload_id, content_hash, upload_warnings, cur, con):
+    """
+    Register the database of a completed upload, so duplicate uploads of the same files can be
+    copied from it.
+
+    :param content_hash: content hash of the uploaded files (see UploadHash)
+    """
+    try:
+        registry_con = connect_registry()
+        registry_con.execute("INSERT OR REPLACE INTO uploads VALUES (?, ?, ?)",
+                             (content_hash, get_db_path(cur), json.dumps(upload_warnings)))
+        registry_con.commit()
+        registry_con.close()
+
+    except sqlite3.Error as e:
+        raise DBException(e.message)
+
+    return True
+
+
 # con = connect('/home/lars/Xi/xiSPEC_ms_parser/dbs/saved/Tmuris_exosomes1.db')
 # cur = con.cursor()
 
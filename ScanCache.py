@@ -0,0 +1,103 @@
+from collections import OrderedDict
+
+
+class FrozenDict(dict):
+    """
+    dict that can't be modified after it is created, so it can be shared by all users of a
+    cache entry.
+    """
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError('%s is immutable' % type(self).__name__)
+
+    __setitem__ = __delitem__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+    def __reduce__(self):
+        return type(self), (dict(self),)
+
+
+class ScanCache(object):
+    """
+    LRU cache of parsed scans, bounded by the (approximate) number of bytes of the cached scans.
+
+    Several SpectrumIdentificationResults (or csv rows) can reference the same scan, the cache
+    saves reading and parsing it again. Scans are frozen (FrozenDict) when they are added.
+    """
+
+    # approximate size of a cached scan without its peak list
+    entry_overhead = 256
+
+    def __init__(self, max_bytes):
+        """
+
+        :param max_bytes: maximum size of the cached scans, caching is disabled if 0
+        """
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()    # key -> (scan, size), least recently used first
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def freeze(scan):
+        """
+        :param scan: scan dict as returned by PeakListParser.get_scan or get_scan_reference
+        :return: FrozenDict of the scan (and its precursor)
+        """
+        frozen = {}
+        for key, value in scan.items():
+            if isinstance(value, dict):
+                value = FrozenDict(value)
+            frozen[key] = value
+        return FrozenDict(frozen)
+
+    def get_size(self, scan):
+        peaks = scan.get('peaks')
+        if peaks is None:
+            return self.entry_overhead
+        return self.entry_overhead + len(peaks)
+
+    def get(self, key, read_scan):
+        """
+        :param key: cache key of the scan
+        :param read_scan: function without arguments that reads the scan on a cache miss
+        :return: frozen scan
+        """
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.hits += 1
+            self.entries[key] = entry
+            return entry[0]
+
+        self.misses += 1
+        scan = self.freeze(read_scan())
+        size = self.get_size(scan)
+        if size > self.max_bytes:
+            return scan
+
+        self.entries[key] = (scan, size)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            old_key, (old_scan, old_size) = self.entries.popitem(last=False)
+            self.bytes -= old_size
+
+        return scan
+
+    def clear(self):
+        self.entries = OrderedDict()
+        self.bytes = 0
+
+    def stats(self):
+        """
+        :return: dict of the hit/miss counters and the cache size
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self.entries),
+            'bytes': self.bytes
+        }
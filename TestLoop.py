@@ -11,6 +11,8 @@ import time
 from MzIdParser import MzIdParser
 from NumpyEncoder import NumpyEncoder
 import PostgreSQL as db
+import UploadHash
+import PeakListResolver
 
 
 class TestLoop:
@@ -26,6 +28,10 @@ class TestLoop:
         self.base = "pride/data/archive"
         self.unimod_path = 'obo/unimod.obo'
         self.temp_dir = os.path.expanduser('~') + "/parser_temp/"
+        # kept between uploads, unlike the files in temp_dir
+        self.index_cache_dir = os.path.expanduser('~') + "/parser_index_cache/"
+        # peak list files of uploads with peak references (see PeakListResolver)
+        self.peak_list_store_dir = os.path.expanduser('~') + "/parser_peak_lists/"
         # connect to DB
         # try:
         #     con = db.connect('')
@@ -84,7 +90,8 @@ class TestLoop:
             raise e
         ftp.quit()
 
-        mzid_parser = MzIdParser(path, self.temp_dir, self.temp_dir, db, self.logger, 0, origin=ymp)
+        mzid_parser = MzIdParser(path, self.temp_dir, self.temp_dir, db, self.logger, 0, origin=ymp,
+                                 index_cache_dir=self.index_cache_dir)
 
         # init parser
         try:
@@ -102,6 +109,7 @@ class TestLoop:
             return
 
         # fetch peak list files from pride
+        peak_file_paths = []
         for peak_file in peak_files:
             # don't download raw files, neater to download everything else even if not supported peak list format
             # if not peak_file.endswith('raw'):
@@ -111,6 +119,7 @@ class TestLoop:
                 print('getting ' + peak_file)
                 ftp.retrbinary("RETR " + peak_file,
                                open(self.temp_dir + peak_file, 'wb').write)
+                peak_file_paths.append(self.temp_dir + peak_file)
             except ftplib.error_perm as e:
                 print('missing file: ' + peak_file + " (checking for .gz)")
                 #  check for gzipped
@@ -120,6 +129,7 @@ class TestLoop:
                     # ftp.cwd(target_dir + '/generated/')
                     ftp.retrbinary("RETR " + peak_file + '.gz',
                                    open(self.temp_dir + '/' + peak_file + '.gz', 'wb').write)
+                    peak_file_paths.append(self.temp_dir + '/' + peak_file + '.gz')
                 except ftplib.error_perm as e:
                     print('missing file: ' + peak_file + '.gz')
 
@@ -142,9 +152,49 @@ class TestLoop:
 
             ftp.close()
 
+        # copy an earlier upload of the same files (e.g. from a previous crawl) instead of parsing
+        content_hash = UploadHash.get_content_hash([path] + peak_file_paths,
+                                                   UploadHash.get_parser_settings(mzid_parser))
+        con = db.connect('')
+        cur = con.cursor()
+        duplicate_upload = None
+        try:
+            duplicate_upload = db.get_upload_by_content_hash(content_hash, cur, con)
+        except db.DBException as e:
+            self.logger.warning('looking up duplicate uploads failed (%s) - parsing' % e)
+            content_hash = None
+        if duplicate_upload is not None:
+            print('identical upload: %s' % duplicate_upload)
+            try:
+                db.clone_upload(duplicate_upload, mzid_parser.upload_id, cur, con)
+            except db.DBException as e:
+                self.logger.warning('copying upload %s failed (%s) - parsing instead' % (
+                    duplicate_upload, e))
+                duplicate_upload = None
+        con.close()
+
         # actually parse
         try:
-            mzid_parser.parse()
+            if duplicate_upload is None:
+                mzid_parser.parse()
+                if content_hash is not None:
+                    con = db.connect('')
+                    try:
+                        db.write_content_hash(mzid_parser.upload_id, content_hash,
+                                              mzid_parser.warnings, con.cursor(), con)
+                    except db.DBException as e:
+                        self.logger.warning('saving the content hash failed (%s)' % e)
+                    con.close()
+
+            # the peak references point into temp_dir, which is deleted below
+            if mzid_parser.store_peak_references:
+                if len(mzid_parser.peak_list_readers) == 0:     # copied from a duplicate upload
+                    mzid_parser.init_peak_list_readers()
+                PeakListResolver.store_peak_lists(
+                    mzid_parser.peak_list_readers,
+                    PeakListResolver.get_upload_peak_list_dir(
+                        self.peak_list_store_dir,
+                        '%s-%s' % (mzid_parser.upload_id, mzid_parser.random_id)))
         except Exception as mzid_error:
             self.logger.exception(mzid_error)
             error = json.dumps(mzid_error.args, cls=NumpyEncoder)
@@ -0,0 +1,133 @@
+import os
+import json
+
+
+class UnimodTable(object):
+    """
+    Lookup of unimod modifications by accession (e.g. 'UNIMOD:1'): monoisotopic mass delta,
+    name and residues (sites).
+
+    Parsing the obo file takes longer than the rest of a small upload, so the table is compiled
+    once into a JSON file next to it (<obo>.json) and rebuilt when the obo file is modified.
+    The table is only loaded when it's first used.
+    Use UnimodTable.get to share one table per obo file between all parsers of a process.
+    """
+
+    _tables = {}    # abspath of obo file -> UnimodTable
+
+    def __init__(self, obo_path, compiled_path=None):
+        """
+
+        :param obo_path: path to unimod.obo
+        :param compiled_path: path of the compiled table, <obo_path>.json if None
+        """
+        self.obo_path = obo_path
+        if compiled_path is None:
+            compiled_path = obo_path + '.json'
+        self.compiled_path = compiled_path
+        self._mods = None
+
+    @classmethod
+    def get(cls, obo_path):
+        """
+        :param obo_path: path to unimod.obo
+        :return: shared UnimodTable for the obo file
+        """
+        key = os.path.abspath(obo_path)
+        if key not in cls._tables:
+            cls._tables[key] = cls(obo_path)
+        return cls._tables[key]
+
+    @property
+    def mods(self):
+        """
+        dict accession -> (mass, name, residues), mass is None for terms without delta_mono_mass
+        """
+        if self._mods is None:
+            self._mods = self.load()
+        return self._mods
+
+    @property
+    def masses(self):
+        """
+        dict accession -> monoisotopic mass delta
+        """
+        return {acc: mod[0] for acc, mod in self.mods.items() if mod[0] is not None}
+
+    def mass(self, accession):
+        mass = self.mods[accession][0]
+        if mass is None:
+            raise KeyError(accession)
+        return mass
+
+    def name(self, accession):
+        return self.mods[accession][1]
+
+    def residues(self, accession):
+        return self.mods[accession][2]
+
+    def load(self):
+        """
+        Load the compiled table, compiling it from the obo file if it is missing or outdated.
+        """
+        obo_mtime = os.path.getmtime(self.obo_path)
+        try:
+            with open(self.compiled_path, 'rb') as f:
+                compiled = json.load(f)
+            if compiled['obo_mtime'] == obo_mtime:
+                return {str(acc): tuple(mod) for acc, mod in compiled['mods'].items()}
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            pass
+
+        mods = self.parse_obo(self.obo_path)
+
+        # not being able to write the compiled table (e.g. read-only install) isn't an error
+        tmp_path = '%s.%s.tmp' % (self.compiled_path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as f:
+                json.dump({'obo_mtime': obo_mtime, 'mods': mods}, f)
+            os.rename(tmp_path, self.compiled_path)
+        except (IOError, OSError):
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+        return mods
+
+    @staticmethod
+    def parse_obo(obo_path):
+        """
+        :return: dict accession -> (mass, name, residues)
+        """
+        mods = {}
+        mod_id = -1
+
+        def add_mod():
+            if mod_id != -1:
+                mods[mod_id] = (mass, name, sorted(residues))
+
+        with open(obo_path) as f:
+            for line in f:
+                if line.startswith('id: '):
+                    add_mod()
+                    mod_id = ''.join(line.replace('id: ', '').split())
+                    mass = None
+                    name = None
+                    residues = set()
+
+                elif mod_id == -1:
+                    continue
+
+                elif line.startswith('name: '):
+                    name = line.replace('name: ', '').strip()
+
+                elif line.startswith('xref: delta_mono_mass '):
+                    mass = float(line.replace('xref: delta_mono_mass ', '').replace('"', ''))
+
+                elif line.startswith('xref: spec_') and '_site ' in line:
+                    residues.add(line.split(' ', 2)[2].strip().replace('"', ''))
+
+        add_mod()
+
+        return mods
@@ -0,0 +1,50 @@
+import json
+import hashlib
+
+
+# size of the chunks hashed at once
+buffer_size = 16 * 1024 * 1024
+
+
+def hash_file(path):
+    """
+    :param path: path to file
+    :return: sha1 hex digest of the file contents, read chunk by chunk
+    """
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(buffer_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def get_parser_settings(parser):
+    """
+    :param parser: MzIdParser or csv parser of the upload
+    :return: settings of the parser that change the parse result, for get_content_hash (the same
+        for all callers, so their uploads can be copied from each other)
+    """
+    return {
+        'parser': parser.__class__.__name__,    # type() is 'instance' for the old-style parsers
+        'store_peak_references': parser.store_peak_references,
+        'binary_peak_lists': parser.binary_peak_lists
+    }
+
+
+def get_content_hash(paths, settings=None):
+    """
+    Hash identifying an upload by the contents of its files, independent of the file names and
+    their order. Uploads with the same hash give the same parse result, so a duplicate upload
+    can be copied from the first one instead of being parsed again.
+
+    :param paths: paths of the uploaded files (identification file and peak list files)
+    :param settings: json serializable parser settings that change the parse result
+        (e.g. the parser class), part of the hash
+    :return: sha1 hex digest
+    """
+    sha1 = hashlib.sha1()
+    for file_hash in sorted([hash_file(path) for path in paths]):
+        sha1.update(file_hash)
+    if settings is not None:
+        sha1.update(json.dumps(settings, sort_keys=True))
+    return sha1.hexdigest()
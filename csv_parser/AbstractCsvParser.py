@@ -6,6 +6,7 @@ from PeakListParser import PeakListParser
 import os
 #import pyteomics.fasta as py_fasta
 import SimpleFASTA
+from UnimodTable import UnimodTable
 
 
 class CsvParseException(Exception):
@@ -21,6 +22,17 @@ class AbstractCsvParser:
 
     """
 
+    # store references to the scans in the peak list files instead of the peak lists
+    # (see PeakListResolver)
+    store_peak_references = False
+    # store peak lists binary encoded (see PeakListEncoding) instead of as text
+    binary_peak_lists = False
+    # number of threads opening the peak list readers (see PeakListParser.open_readers)
+    peak_list_reader_threads = 4
+    # zip archive of the peak list files (see PeakListParser.open_zip_peak_lists), only the files
+    # referenced in the csv file are extracted, to peak_list_dir
+    peak_list_archive = None
+
     default_values = {
         'rank': 1,
         'pepseq1': '',
@@ -162,43 +174,73 @@ class AbstractCsvParser:
             value: associated peak list reader
         """
 
-        peak_list_readers = {}
-        for peak_list_file_name in self.csv_reader.peaklistfilename.unique():
+        # the readers are opened in parallel (see PeakListParser.open_readers), the errors of all
+        # files are reported together
+        open_functions = [
+            (peak_list_file_name,
+             lambda peak_list_file_name=peak_list_file_name: self.open_peak_list_reader(peak_list_file_name))
+            for peak_list_file_name in self.csv_reader.peaklistfilename.unique()
+        ]
+        peak_list_readers, errors = PeakListParser.open_readers(open_functions,
+                                                                self.peak_list_reader_threads)
+        for peak_list_file_name, e in errors:
+            if not isinstance(e, CsvParseException):
+                raise e
+        if len(errors) > 0:
+            raise CsvParseException('\n'.join([e.args[0] for peak_list_file_name, e in errors]))
 
-            # ToDo: what about .ms2?
-            if peak_list_file_name.lower().endswith('.mgf'):
-                file_format_accession = 'MS:1001062'        # MGF
-                spectrum_id_format_accesion = 'MS:1000774'  # MS:1000774 multiple peak list nativeID format - zero based
+        self.peak_list_readers = peak_list_readers
 
-            elif peak_list_file_name.lower().endswith('.mzml'):
-                file_format_accession = 'MS:1000584'        # mzML
-                spectrum_id_format_accesion = 'MS:1001530'  # mzML unique identifier
-            else:
-                raise CsvParseException("Unsupported peak list file type for: %s" % peak_list_file_name)
+    def open_peak_list_reader(self, peak_list_file_name):
+        """
+        :param peak_list_file_name: peak list file name from the csv file
+        :return: PeakListParser for the peak list file (or its gz version)
+        """
+        # ToDo: what about .ms2?
+        if peak_list_file_name.lower().endswith('.mgf'):
+            file_format_accession = 'MS:1001062'        # MGF
+            spectrum_id_format_accesion = 'MS:1000774'  # MS:1000774 multiple peak list nativeID format - zero based
 
-            peak_list_file_path = self.peak_list_dir + peak_list_file_name
+        elif peak_list_file_name.lower().endswith('.mzml'):
+            file_format_accession = 'MS:1000584'        # mzML
+            spectrum_id_format_accesion = 'MS:1001530'  # mzML unique identifier
+        else:
+            raise CsvParseException("Unsupported peak list file type for: %s" % peak_list_file_name)
 
+        try:
+            peak_list_reader = PeakListParser(
+                self.get_peak_list_path(peak_list_file_name, file_format_accession),
+                file_format_accession,
+                spectrum_id_format_accesion
+            )
+        except IOError:
+            # try gz version
             try:
                 peak_list_reader = PeakListParser(
-                    peak_list_file_path,
+                    PeakListParser.extract_gz(self.get_peak_list_path(peak_list_file_name + '.gz')),
                     file_format_accession,
                     spectrum_id_format_accesion
                 )
             except IOError:
-                # try gz version
-                try:
-                    peak_list_reader = PeakListParser(
-                        PeakListParser.extract_gz(peak_list_file_path + '.gz'),
-                        file_format_accession,
-                        spectrum_id_format_accesion
-                    )
-                except IOError:
-                    # ToDo: output all missing files not just first encountered. Use get_peak_list_file_names()?
-                    raise CsvParseException('Missing peak list file: %s' % peak_list_file_name)
+                raise CsvParseException('Missing peak list file: %s' % peak_list_file_name)
 
-            peak_list_readers[peak_list_file_name] = peak_list_reader
+        peak_list_reader.binary_peaks = self.binary_peak_lists
+        return peak_list_reader
 
-        self.peak_list_readers = peak_list_readers
+    def get_peak_list_path(self, peak_list_file_name, file_format_accession=None):
+        """
+        :param peak_list_file_name: peak list file name from the csv file
+        :param file_format_accession: file format cv accession, None for files that need to be
+            extracted (e.g. .gz)
+        :return: path of the peak list file in peak_list_dir, extracted from peak_list_archive if
+            it is set (or an ArchiveExtractor.ZipMember for stored files that can be read in place)
+        """
+        if self.peak_list_archive is None:
+            return self.peak_list_dir + peak_list_file_name
+        # the PeakListResolver reads referenced peak lists from peak_list_dir
+        in_place = not self.store_peak_references and \
+            file_format_accession in PeakListParser.in_place_formats
+        return self.peak_list_archive.get_path(peak_list_file_name, in_place)
 
     def parse(self):
 
@@ -222,21 +264,9 @@ class AbstractCsvParser:
 
 
 
-    # @staticmethod
-    # def get_unimod_masses(unimod_path):
-    #     masses = {}
-    #     mod_id = -1
-    #
-    #     with open(unimod_path) as f:
-    #         for line in f:
-    #             if line.startswith('id: '):
-    #                 mod_id = ''.join(line.replace('id: ', '').split())
-    #
-    #             elif line.startswith('xref: delta_mono_mass ') and not mod_id == -1:
-    #                 mass = float(line.replace('xref: delta_mono_mass ', '').replace('"', ''))
-    #                 masses[mod_id] = mass
-    #
-    #     return masses
+    @staticmethod
+    def get_unimod_masses(unimod_path):
+        return UnimodTable.get(unimod_path).masses
 
     def parse_db_sequences(self):
         self.logger.info('reading fasta - start')
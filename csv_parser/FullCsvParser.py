@@ -303,6 +303,7 @@ class FullCsvParser(AbstractCsvParser):
                 peak_list = None
                 precursor_mz = None
                 precursor_charge = None
+                peak_list_reference = [None, None, None]  # offset, length, format
                 if self.peak_list_dir:
                     # get peak list
                     try:
@@ -310,8 +311,13 @@ class FullCsvParser(AbstractCsvParser):
                     except KeyError:
                         raise CsvParseException('Missing peak list file: %s' % peak_list_file_name)
 
-                    scan = peak_list_reader.get_scan(scan_id)
-                    peak_list = scan['peaks']
+                    if self.store_peak_references:
+                        scan = peak_list_reader.get_scan_reference(scan_id)
+                        peak_list_reference = [scan['offset'], scan['length'],
+                                               peak_list_reader.file_format_accession]
+                    else:
+                        scan = peak_list_reader.get_scan(scan_id)
+                        peak_list = scan['peaks']
                     precursor_mz = scan['precursor']['mz']
                     precursor_charge = scan['precursor']['charge']
 
@@ -326,6 +332,8 @@ class FullCsvParser(AbstractCsvParser):
                     precursor_mz,                   # 'precursor_mz',
                     precursor_charge,               # 'precursor_charge'
                 ]
+                if self.store_peak_references:
+                    spectrum += peak_list_reference
                 spectra.append(spectrum)
             else:
                 spectrum_id = seen_spectra.index(unique_spec_identifier)
@@ -489,6 +497,9 @@ class FullCsvParser(AbstractCsvParser):
 
         # end main loop
         self.logger.info('main loop - done. Time: ' + str(round(time() - main_loop_start_time, 2)) + " sec")
+        for peak_list_reader in self.peak_list_readers.values():
+            self.logger.info('scan cache ' + peak_list_reader.peak_list_file_name + ': '
+                             + str(peak_list_reader.scan_cache.stats()))
 
         # once loop is done write data to DB
         db_wrap_up_start_time = time()
@@ -497,7 +508,12 @@ class FullCsvParser(AbstractCsvParser):
 
             self.db.write_peptide_evidences(peptide_evidences, self.cur, self.con)
             self.db.write_peptides(peptides, self.cur, self.con)
-            self.db.write_spectra(spectra, self.cur, self.con)
+            if self.store_peak_references:
+                self.db.write_spectra_references(spectra, self.cur, self.con)
+            elif self.binary_peak_lists:
+                self.db.write_spectra_binary(spectra, self.cur, self.con)
+            else:
+                self.db.write_spectra(spectra, self.cur, self.con)
             self.db.write_spectrum_identifications(spectrum_identifications, self.cur, self.con)
             self.db.write_db_sequences(db_sequences, self.cur, self.con)
             self.con.commit()
@@ -34,9 +34,33 @@ def write_spectra(inj_list, cur, con):
     pass
 
 
+def write_spectra_references(inj_list, cur, con):
+    pass
+
+
+def write_spectra_binary(inj_list, cur, con):
+    pass
+
+
 def write_spectrum_identifications(inj_list, cur, con):
     pass
 
 
+def delete_spectra_from(upload_id, spectrum_id, identification_id, cur, con):
+    pass
+
+
+def get_upload_by_content_hash(content_hash, cur, con):
+    return None
+
+
+def clone_upload(source, upload_id, cur, con):
+    return []
+
+
+def write_content_hash(upload_id, content_hash, upload_warnings, cur, con):
+    pass
+
+
 def fill_in_missing_scores(cur, con):
     pass
@@ -12,13 +12,28 @@ import getopt
 
 dev = False
 use_ftp, use_postgreSQL, user_id = False, False, False
+single_pass = False
+store_peak_references = False
+binary_peak_lists = False
+processes = None
+peak_list_threads = None
+index_cache_dir = None
+peak_list_store_dir = None
+use_checkpoint, resume = False, False
+deduplicate = True
 identifications_file, peakList_file, identifier = False, False, False
 
 try:
-    opts, args = getopt.getopt(sys.argv[1:], "fi:p:s:u:", ["ftp", "postgresql"])
+    opts, args = getopt.getopt(sys.argv[1:], "fi:p:s:u:", ["ftp", "postgresql", "single-pass",
+                                                         "processes=", "peak-list-threads=",
+                                                         "peak-references", "binary-peaks",
+                                                         "index-cache=", "peak-list-store=",
+                                                         "checkpoint", "resume", "no-dedup"])
 except getopt.GetoptError:
     print('parser.py (-f) -i <identifications file> -p <peak list file> -s <session identifier>'
-          ' (-u <user_id>)')
+          ' (-u <user_id>) (--single-pass) (--processes <number>) (--peak-list-threads <number>)'
+          ' (--peak-references) (--peak-list-store <dir>) (--binary-peaks) (--index-cache <dir>)'
+          ' (--checkpoint) (--resume) (--no-dedup)')
     sys.exit(2)
 
 for o, a in opts:
@@ -41,6 +56,37 @@ for o, a in opts:
     if o == '-u':   # user_id
         user_id = a
 
+    if o == '--single-pass':    # read mzid file once front to back instead of random access
+        single_pass = True
+
+    if o == '--peak-references':  # store peak list file references instead of peak lists
+        store_peak_references = True
+
+    if o == '--binary-peaks':  # store peak lists binary encoded instead of as text
+        binary_peak_lists = True
+
+    if o == '--processes':  # number of processes for the mzid main loop
+        processes = int(a)
+
+    if o == '--peak-list-threads':  # number of threads opening the peak list files
+        peak_list_threads = int(a)
+
+    if o == '--index-cache':  # dir to keep the mzid and peak list offset indices in
+        index_cache_dir = a
+
+    if o == '--peak-list-store':  # dir to keep the peak list files of --peak-references uploads in
+        peak_list_store_dir = a
+
+    if o == '--checkpoint':  # save the progress of mzid uploads for resuming them
+        use_checkpoint = True
+
+    if o == '--resume':     # resume an interrupted mzid upload from its checkpoint
+        use_checkpoint = True
+        resume = True
+
+    if o == '--no-dedup':   # parse files even if an identical upload has been parsed before
+        deduplicate = False
+
 if identifications_file is False or identifier is False:
     dev = True
     print ("dev test mode...")
@@ -62,6 +108,12 @@ try:
     except NameError:
         dname = ''
 
+    # the upload folder is deleted after parsing, so the indices are kept outside of it
+    if index_cache_dir is None:
+        index_cache_dir = os.path.join(dname, 'index_cache')
+    if peak_list_store_dir is None:
+        peak_list_store_dir = os.path.join(dname, 'peak_lists')
+
     # import local files
     import MzIdParser
     # import CsvParser
@@ -71,6 +123,8 @@ try:
     from csv_parser.NoPeakListsCsvParser import NoPeakListsCsvParser
     from csv_parser.LinksOnlyCsvParser import LinksOnlyCsvParser
     import PeakListParser
+    import PeakListResolver
+    import UploadHash
 
     # logging
     logFile = dname + "/log/%s_%s.log" % (identifier, int(time()))
@@ -191,21 +245,26 @@ except Exception as e:
     sys.exit(1)
 
 
+# checkpoint of the mzid main loop, kept with the uploaded files if parsing fails
+checkpoint_path = None
+if use_checkpoint and not use_ftp:
+    checkpoint_path = os.path.join(upload_folder, 'mzid.checkpoint')
+
 # parsing
 startTime = time()
+id_parser = None
 try:
     peak_list_folder = None
+    peak_list_archive = None
     peaks_size = 0
     if peakList_file:
         peaks_size = os.path.getsize(peakList_file)
         peak_list_folder = upload_folder
         if peakList_file.endswith('.zip'):
             try:
-                unzipStartTime = time()
-                logger.info('unzipping start')
-                peak_list_folder = PeakListParser.PeakListParser.unzip_peak_lists(peakList_file)
-                logger.info('unzipping done. Time: {} sec'.format(
-                    round(time() - unzipStartTime, 2)))
+                # the peak list files are extracted from the archive when they are opened
+                peak_list_archive = PeakListParser.PeakListParser.open_zip_peak_lists(peakList_file)
+                peak_list_folder = peak_list_archive.out_dir
             except IOError as e:
                 logger.error(e.args[0])
                 returnJSON['errors'].append({
@@ -230,10 +289,17 @@ try:
 
         if use_postgreSQL:
             id_parser = MzIdParser.MzIdParser(identifications_file, upload_folder, peak_list_folder,
-                                              db, logger, user_id=user_id)
+                                              db, logger, user_id=user_id, single_pass=single_pass,
+                                              index_cache_dir=index_cache_dir, processes=processes,
+                                              checkpoint_path=checkpoint_path, resume=resume)
         else:
             id_parser = MzIdParser.xiSPEC_MzIdParser(identifications_file, upload_folder,
-                                                     peak_list_folder, db, logger, db_name=database)
+                                                     peak_list_folder, db, logger, db_name=database,
+                                                     single_pass=single_pass,
+                                                     index_cache_dir=index_cache_dir,
+                                                     processes=processes,
+                                                     checkpoint_path=checkpoint_path,
+                                                     resume=resume)
         id_parser.initialise_mzid_reader()
     elif identifications_fileName.endswith('.csv'):
         logger.info('parsing csv start')
@@ -261,8 +327,15 @@ try:
     else:
         raise Exception('Unknown identifications file format!')
 
-    # create Database tables
-    if not use_postgreSQL:
+    id_parser.store_peak_references = store_peak_references
+    id_parser.binary_peak_lists = binary_peak_lists
+    id_parser.peak_list_archive = peak_list_archive
+    if peak_list_threads is not None:
+        id_parser.peak_list_reader_threads = peak_list_threads
+
+    # create Database tables (they already contain the rows of a resumed upload)
+    resuming = identifications_fileType == 'mzid' and id_parser.resume_state is not None
+    if not use_postgreSQL and not resuming:
         try:
             db.create_tables(id_parser.cur, id_parser.con)
         except db.DBException as e:
@@ -270,11 +343,69 @@ try:
             print(e)
             sys.exit(1)
 
-    id_parser.parse()
+    # copy a completed upload of the same files instead of parsing them again
+    content_hash = None
+    duplicate_upload = None
+    if deduplicate:
+        uploaded_files = [identifications_file]
+        if peakList_file:
+            uploaded_files.append(peakList_file)
+        content_hash = UploadHash.get_content_hash(uploaded_files,
+                                                   UploadHash.get_parser_settings(id_parser))
+        if not resuming:
+            try:
+                duplicate_upload = db.get_upload_by_content_hash(content_hash, id_parser.cur,
+                                                                 id_parser.con)
+            except db.DBException as e:
+                logger.warning('looking up duplicate uploads failed ({}) - parsing'.format(e))
+                content_hash = None
+
+    if duplicate_upload is not None:
+        logger.info('identical upload found ({}) - copying it instead of parsing'.format(
+            duplicate_upload))
+        try:
+            upload_warnings = db.clone_upload(duplicate_upload, id_parser.upload_id,
+                                              id_parser.cur, id_parser.con)
+        except db.DBException as e:
+            logger.warning('copying upload {} failed ({}) - parsing instead'.format(
+                duplicate_upload, e))
+            duplicate_upload = None
+
+    if duplicate_upload is None:
+        id_parser.parse()
+        upload_warnings = id_parser.warnings
+
+        if content_hash is not None:
+            # the parser may have closed its connection
+            con = db.connect(database)
+            try:
+                db.write_content_hash(id_parser.upload_id, content_hash, upload_warnings,
+                                      con.cursor(), con)
+            except db.DBException as e:
+                logger.warning('saving the content hash failed ({})'.format(e))
+            con.close()
 
     returnJSON['identifier'] = str(id_parser.upload_id) + "-" + str(id_parser.random_id)
     returnJSON['modifications'] = id_parser.unknown_mods
-    returnJSON['warnings'] = id_parser.warnings
+    returnJSON['warnings'] = upload_warnings
+
+    # the peak references point to the peak list files, which have to outlive the upload folder
+    if id_parser.store_peak_references and peakList_file:
+        if len(id_parser.peak_list_readers) == 0:   # copied from a duplicate upload
+            if identifications_fileType == 'mzid':
+                id_parser.init_peak_list_readers()
+            else:
+                id_parser.set_peak_list_readers()
+        if use_postgreSQL:
+            upload_identifier = returnJSON['identifier']
+        else:   # one database per upload, named by the session identifier
+            upload_identifier = str(identifier)
+        peak_list_store = PeakListResolver.get_upload_peak_list_dir(peak_list_store_dir,
+                                                                    upload_identifier)
+        # the dev test files are kept in place
+        PeakListResolver.store_peak_lists(id_parser.peak_list_readers, peak_list_store,
+                                          move=not dev)
+        logger.info('peak list files stored in {}'.format(peak_list_store))
 
     # delete uploaded files after they have been parsed
     if not dev:
@@ -295,8 +426,13 @@ if len(returnJSON["errors"]) > 0 or len(returnJSON["warnings"]) > 0:
     for err in returnJSON['errors']:
         logger.error(err)
 
+    resumable = checkpoint_path is not None and \
+        isinstance(id_parser, MzIdParser.MzIdParser) and os.path.exists(checkpoint_path)
+    if resumable:
+        logger.info('upload can be resumed with --resume')
+
     if len(returnJSON["errors"]) > 0:
-        if not dev:
+        if not dev and not resumable:
 
             try:
                 failed_dir = "../uploads/failed/"
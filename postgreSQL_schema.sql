@@ -142,7 +142,11 @@ CREATE TABLE public.spectra (
     peak_list_file_name text,
     scan_id text,
     frag_tol text,
-    spectrum_ref text
+    spectrum_ref text,
+    peak_list_offset bigint,
+    peak_list_length bigint,
+    peak_list_format text,
+    peak_list_binary bytea
 );
 
 
@@ -197,7 +201,8 @@ CREATE TABLE public.uploads (
     error_type text,
     upload_warnings json,
     origin text,
-    random_id character varying DEFAULT public.make_uid()
+    random_id character varying DEFAULT public.make_uid(),
+    content_hash text
 );
 
 
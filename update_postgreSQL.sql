@@ -0,0 +1,17 @@
+--
+-- Update an existing database to the current postgreSQL_schema.sql
+-- (databases created with postgreSQL_schema.sql are up to date already)
+--
+-- psql -d <database> -f update_postgreSQL.sql
+--
+
+-- content hash of the uploaded files, for copying duplicate uploads (see UploadHash)
+ALTER TABLE public.uploads ADD COLUMN IF NOT EXISTS content_hash text;
+
+-- peak list file references (spectra stored without peak lists, see PeakListResolver)
+ALTER TABLE public.spectra ADD COLUMN IF NOT EXISTS peak_list_offset bigint;
+ALTER TABLE public.spectra ADD COLUMN IF NOT EXISTS peak_list_length bigint;
+ALTER TABLE public.spectra ADD COLUMN IF NOT EXISTS peak_list_format text;
+
+-- binary encoded peak lists (see PeakListEncoding)
+ALTER TABLE public.spectra ADD COLUMN IF NOT EXISTS peak_list_binary bytea;
@@ -29,6 +29,20 @@ def update_database(con, db_name):
         cur.execute('ALTER TABLE spectra ADD COLUMN precursor_charge TEXT')
     except Exception:
         print('{}: spectrum precursor columns exist already - not updated'.format(db_name))
+
+    try:
+        # add peak list file references (spectra stored without peak lists)
+        cur.execute('ALTER TABLE spectra ADD COLUMN peak_list_offset INT')
+        cur.execute('ALTER TABLE spectra ADD COLUMN peak_list_length INT')
+        cur.execute('ALTER TABLE spectra ADD COLUMN peak_list_format TEXT')
+    except Exception:
+        print('{}: spectrum peak list reference columns exist already - not updated'.format(db_name))
+
+    try:
+        # add binary peak lists (see PeakListEncoding)
+        cur.execute('ALTER TABLE spectra ADD COLUMN peak_list_binary BLOB')
+    except Exception:
+        print('{}: spectrum binary peak list column exists already - not updated'.format(db_name))
     con.commit()
 
     return True